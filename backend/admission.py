@@ -0,0 +1,269 @@
+import os
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+from metrics import span
+
+load_dotenv()
+
+# Chat runs (LLM + Serper + pgvector calls) in progress at the same time in this process
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+# Chat requests allowed to wait for a slot before /api/chat answers 503
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", "32"))
+# Seconds a chat request may wait for a slot before giving up with 503
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+# Chats on the same conversation run one at a time (they share a LangGraph thread);
+# this many more may wait behind the running one before answering 429
+CHAT_CONVERSATION_QUEUE_SIZE = int(os.getenv("CHAT_CONVERSATION_QUEUE_SIZE", "2"))
+# Seconds a chat may wait for the previous turn of its conversation to finish
+CHAT_CONVERSATION_TIMEOUT = float(os.getenv("CHAT_CONVERSATION_TIMEOUT", "60"))
+# Synchronous /api/index-files batches run at the same time, waiting and wait deadline
+INDEX_FILES_MAX_CONCURRENCY = int(os.getenv("INDEX_FILES_MAX_CONCURRENCY", "1"))
+INDEX_FILES_QUEUE_SIZE = int(os.getenv("INDEX_FILES_QUEUE_SIZE", "2"))
+INDEX_FILES_QUEUE_TIMEOUT = float(os.getenv("INDEX_FILES_QUEUE_TIMEOUT", "30"))
+# Upper bound for the Retry-After we suggest
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", "60"))
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request can't get a slot: the wait queue is full or the wait deadline passed.
+    status_code is 429 when the caller is the one overloading (its own conversation),
+    503 when the whole service is; retry_after is a hint in seconds.
+    """
+
+    def __init__(self, message: str, status_code: int = 503, retry_after: int = 1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    At most max_concurrent holders, at most max_queue waiters (served in
+    arrival order), each waiting at most timeout seconds. A freed slot is
+    handed straight to the next waiter so late arrivals can't overtake it.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, timeout: float,
+                 rejected_status: int = 503):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self.rejected_status = rejected_status
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+        # Moving average of how long a slot is held, used for Retry-After
+        self.hold_seconds = None
+        self._waiters = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and not self._waiters
+
+    def retry_after(self) -> int:
+        """
+        Rough seconds until a new request would get a slot: the queue ahead of it
+        drained max_concurrent at a time, at the average hold time.
+        """
+        hold = self.hold_seconds if self.hold_seconds is not None else 1.0
+        seconds = hold * (self.queued + 1) / self.max_concurrent
+        return min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+    async def acquire(self):
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected(f"Too many {self.name} requests, try again later",
+                                    self.rejected_status, self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started = time.perf_counter()
+        try:
+            with span(f"admission.{self.name}"):
+                await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up: pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected_timeout += 1
+            raise AdmissionRejected(f"Timed out waiting for a {self.name} slot, try again later",
+                                    self.rejected_status, self.retry_after())
+        finally:
+            waited = time.perf_counter() - started
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.admitted += 1
+
+    def release(self, held: float = None):
+        if held is not None:
+            self.hold_seconds = held if self.hold_seconds is None else 0.8 * self.hold_seconds + 0.2 * held
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # in_flight stays the same: the slot changes hands
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_seconds_total": self.wait_seconds_total,
+            "max_wait_seconds": self.max_wait_seconds,
+            "hold_seconds": self.hold_seconds,
+        }
+
+
+class KeyedLimiter:
+    """
+    One AdmissionLimiter per key (a conversation), created on demand and dropped once idle.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, timeout: float,
+                 rejected_status: int = 429):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rejected_status = rejected_status
+        self.rejected = 0
+        self._limiters = {}
+
+    async def acquire(self, key: str) -> AdmissionLimiter:
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = AdmissionLimiter(
+                self.name, self.max_concurrent, self.max_queue, self.timeout, self.rejected_status)
+        try:
+            await limiter.acquire()
+        except AdmissionRejected:
+            self.rejected += 1
+            self._drop_if_idle(key, limiter)
+            raise
+        except BaseException:
+            self._drop_if_idle(key, limiter)
+            raise
+        return limiter
+
+    def release(self, key: str, limiter: AdmissionLimiter, held: float = None):
+        limiter.release(held)
+        self._drop_if_idle(key, limiter)
+
+    def _drop_if_idle(self, key: str, limiter: AdmissionLimiter):
+        if limiter.idle and self._limiters.get(key) is limiter:
+            del self._limiters[key]
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._limiters),
+            "in_flight": sum(limiter.in_flight for limiter in self._limiters.values()),
+            "queued": sum(limiter.queued for limiter in self._limiters.values()),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+        }
+
+
+class Admission:
+    """
+    A request's claim on its slots, acquired in order (conversation first, so a
+    chat waiting for its previous turn doesn't hold a chat slot) and released
+    exactly once, in reverse order.
+    """
+
+    def __init__(self, limiter: AdmissionLimiter, conversations: KeyedLimiter = None, key: str = None):
+        self.limiter = limiter
+        self.conversations = conversations
+        self.key = key
+        self._conversation = None
+        self._acquired = False
+        self._started = None
+
+    async def acquire(self) -> "Admission":
+        if self.conversations is not None:
+            self._conversation = await self.conversations.acquire(self.key)
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            if self._conversation is not None:
+                self.conversations.release(self.key, self._conversation)
+                self._conversation = None
+            raise
+        self._acquired = True
+        self._started = time.perf_counter()
+        return self
+
+    def release(self):
+        if not self._acquired:
+            return
+        self._acquired = False
+        held = time.perf_counter() - self._started
+        self.limiter.release(held)
+        if self._conversation is not None:
+            self.conversations.release(self.key, self._conversation, held)
+            self._conversation = None
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+chat_limiter = AdmissionLimiter("chat", CHAT_MAX_CONCURRENCY, CHAT_QUEUE_SIZE, CHAT_QUEUE_TIMEOUT)
+conversation_limiter = KeyedLimiter("conversation", 1, CHAT_CONVERSATION_QUEUE_SIZE, CHAT_CONVERSATION_TIMEOUT)
+index_files_limiter = AdmissionLimiter("index_files", INDEX_FILES_MAX_CONCURRENCY, INDEX_FILES_QUEUE_SIZE,
+                                       INDEX_FILES_QUEUE_TIMEOUT)
+
+
+def admit_chat(conversation_id: str) -> Admission:
+    """
+    Serializes chats per conversation, then bounds chats across conversations.
+    """
+    return Admission(chat_limiter, conversation_limiter, conversation_id)
+
+
+def admission_stats() -> dict:
+    return {
+        "chat": chat_limiter.stats(),
+        "conversation": conversation_limiter.stats(),
+        "index_files": index_files_limiter.stats(),
+    }
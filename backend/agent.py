@@ -0,0 +1,185 @@
+import re
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+from langchain.tools import tool, ToolRuntime
+from langchain.chat_models import init_chat_model
+from langchain.agents import create_agent
+from langchain.agents.middleware import AgentMiddleware
+from langchain.agents.structured_output import ToolStrategy
+from langchain_core.callbacks import dispatch_custom_event
+
+from caches import retrieval_cache
+from context_packing import pack_context, CONTEXT_MIN_SCORE_RATIO
+from chat_stream import SNIPPETS_EVENT
+from query_embedding import get_query_embed_model
+from db import get_db
+from hybrid_retrieval import HybridRetriever, HYBRID_SEARCH_ENABLED, HYBRID_CANDIDATES
+from rag_utils import get_shared_index, conversation_retriever_kwargs, conversation_filter_sql, hybrid_search_available
+from web_search import web_search_cache
+from metrics import span
+
+load_dotenv()
+
+# Chunks indexed before file names moved to metadata start with this sentence
+LEGACY_PREAMBLE = re.compile(
+    r"^The user uploaded a file called '.*?'\. The following is a chunk of the file '.*?':\n\n", re.DOTALL,
+)
+
+SYSTEM_PROMPT = """You are a document assistant. Answer user questions based on the retrieved documents first.
+    Only search the internet if the documents are insufficient."""
+
+
+@dataclass
+class ResponseFormat:
+    did_search_internet: bool
+    final_answer: str
+
+
+@dataclass
+class RagContext:
+    """
+    Per-request runtime context. The agent graph is built once per process,
+    so everything that depends on the request is passed in here.
+    """
+    conversation_id: str
+
+
+def hybrid_search_enabled() -> bool:
+    return HYBRID_SEARCH_ENABLED and hybrid_search_available()
+
+
+def get_conversation_retriever(conversation_id: str, similarity_top_k: int = 3):
+    """
+    Retriever over the shared index, restricted to one conversation's files.
+    Cheap to build: the index, its vector store and the cached query embed model are long-lived.
+    Once the full-text column exists, vector results are fused with a keyword search.
+    """
+    hybrid = hybrid_search_enabled()
+    vector_retriever = get_shared_index().as_retriever(
+        similarity_top_k=HYBRID_CANDIDATES if hybrid else similarity_top_k,
+        embed_model=get_query_embed_model(),
+        **conversation_retriever_kwargs(conversation_id),
+    )
+    if not hybrid:
+        return vector_retriever
+    return HybridRetriever(
+        vector_retriever,
+        get_db().engine,
+        conversation_id,
+        conversation_filter_sql(),
+        similarity_top_k=similarity_top_k,
+    )
+
+
+def format_snippets(nodes: list) -> str:
+    """
+    Renders retrieved nodes for the LLM, grouped by file: each file is named
+    once, followed by its snippets. Files come in the order of their best snippet.
+    """
+    groups = {}
+    for node in nodes:
+        metadata = node.node.metadata
+        groups.setdefault(metadata.get("file_id") or metadata.get("file_name"), []).append(node)
+
+    sections = []
+    number = 0
+    for group in groups.values():
+        lines = [f"=== File: {group[0].node.metadata.get('file_name', 'unknown')} ==="]
+        for node in group:
+            number += 1
+            page_number = node.node.metadata.get("page_number")
+            page = f" (page {page_number})" if page_number else ""
+            text = LEGACY_PREAMBLE.sub("", node.node.get_content(), count=1)
+            lines.append(f"--- Document Snippet {number}{page} ---\n{text}")
+        sections.append("\n\n".join(lines))
+    return "\n\n".join(sections)
+
+
+# --- Tools ---
+
+@tool
+def search_documents(query: str, runtime: ToolRuntime[RagContext]) -> str:
+    """Retrieve the top 3 nodes from the index based on the query."""
+    conversation_id = runtime.context.conversation_id
+    # Repeated queries in a conversation skip the embedding call + pgvector round trip
+    nodes = retrieval_cache.get_results(conversation_id, query)
+    if nodes is None:
+        generation = retrieval_cache.generation(conversation_id)
+        with span("chat.retrieval"):
+            nodes = get_conversation_retriever(conversation_id).retrieve(query)
+        retrieval_cache.put_results(conversation_id, query, nodes, generation)
+    context = "No relevant documents found."
+    if nodes:
+        # Fits the snippets into the context token budget: every call's result stays in the prompt
+        # for the rest of the turn, and model latency grows with input tokens
+        # Hybrid results carry fused rank / full-text scores, not similarities: no score cutoff
+        min_score_ratio = None if hybrid_search_enabled() else CONTEXT_MIN_SCORE_RATIO
+        with span("chat.context_packing"):
+            nodes, context = pack_context(nodes, format_snippets, min_score_ratio=min_score_ratio)
+    # Lets /api/chat/stream tell the client which chunks were used
+    dispatch_custom_event(SNIPPETS_EVENT, {"snippets": [
+        {
+            "id": node.node.node_id,
+            "file_id": node.node.metadata.get("file_id"),
+            "page_number": node.node.metadata.get("page_number"),
+            "score": node.score,
+        }
+        for node in nodes
+    ]})
+    return context
+
+
+@tool
+def search_internet(query: str) -> str:
+    """Returns search results from the internet."""
+    # Cached for a few minutes; concurrent identical searches share one request
+    return web_search_cache.search(query)
+
+
+# --- Agent ---
+
+class TimingMiddleware(AgentMiddleware):
+    """
+    Times every model call (the LLM's share of a chat) as the chat.llm stage.
+    """
+
+    def wrap_model_call(self, request, handler):
+        with span("chat.llm"):
+            return handler(request)
+
+    async def awrap_model_call(self, request, handler):
+        with span("chat.llm"):
+            return await handler(request)
+
+
+def create_rag_agent(checkpointer):
+    """
+    Builds the model client, tools and agent graph once, using the PERSISTENT checkpointer.
+    Invoke it with context=RagContext(conversation_id=...) and the conversation's thread_id.
+    """
+    model = init_chat_model("openai:gpt-4o", temperature=0.5)
+
+    return create_agent(
+        model=model,
+        system_prompt=SYSTEM_PROMPT,
+        tools=[search_documents, search_internet],
+        response_format=ToolStrategy(ResponseFormat),
+        context_schema=RagContext,
+        middleware=[TimingMiddleware()],
+        checkpointer=checkpointer # <--- NOW USING POSTGRES SAVER
+    )
+
+
+def format_chat_response(state: dict) -> dict:
+    """
+    Builds the /api/chat response body from the agent's final state.
+    """
+    structured_res = state.get('structured_response')
+    if structured_res:
+        return {
+            "answer": structured_res.final_answer,
+            "sources": "internet" if structured_res.did_search_internet else "documents"
+        }
+
+    return {"answer": "Error: Could not generate a structured response."}
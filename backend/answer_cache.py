@@ -0,0 +1,222 @@
+import os
+import math
+import time
+import operator
+import threading
+from array import array
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+from caches import Generations, normalize_query
+from metrics import span
+
+load_dotenv()
+
+# Opt-in: answer a repeated (or paraphrased) question from an earlier answer without running the agent
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+# Cosine similarity between question embeddings above which the earlier answer is reused
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# Answers kept per conversation (each lookup compares against all of them) and in total
+ANSWER_CACHE_MAX_PER_CONVERSATION = int(os.getenv("ANSWER_CACHE_MAX_PER_CONVERSATION", "32"))
+ANSWER_CACHE_MAX_CONVERSATIONS = int(os.getenv("ANSWER_CACHE_MAX_CONVERSATIONS", "1024"))
+# Answers that searched the internet go stale, so nothing is kept forever. Also bounds how
+# long an answer can outlive a file change made through another instance (only the
+# instance that indexed or deleted the file invalidates its cache).
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+
+
+def _unit(embedding) -> array:
+    norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    return array("f", (x / norm for x in embedding))
+
+
+def _cosine(a: array, b: array) -> float:
+    # Both are unit vectors
+    return sum(map(operator.mul, a, b))
+
+
+@dataclass
+class AnswerLookup:
+    """
+    Result of AnswerCache.lookup. On a miss it carries what store() needs, so
+    the question isn't embedded twice and an answer computed across an
+    invalidation isn't stored.
+    """
+    conversation_id: str
+    question: str
+    answer: dict = None
+    embedding: array = None
+    generation: int = 0
+    similarity: float = None
+
+
+@dataclass
+class _Entry:
+    expires_at: float
+    generation: int
+    question: str
+    embedding: array
+    answer: dict
+
+
+class AnswerCache:
+    """
+    Final answers keyed by (conversation, files generation, question embedding).
+    Indexing, updates and deletes call invalidate(conversation_id), which bumps
+    the conversation's generation (its indexed files changed). A lookup matches
+    an entry of the same conversation and generation whose question is the same
+    after normalization or whose embedding is at least `similarity` close.
+    """
+
+    def __init__(self, enabled: bool = ANSWER_CACHE_ENABLED, similarity: float = ANSWER_CACHE_SIMILARITY,
+                 max_per_conversation: int = ANSWER_CACHE_MAX_PER_CONVERSATION,
+                 max_conversations: int = ANSWER_CACHE_MAX_CONVERSATIONS, ttl: float = ANSWER_CACHE_TTL):
+        self.enabled = enabled
+        self.similarity = similarity
+        self.max_per_conversation = max_per_conversation
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = {}  # conversation_id -> [_Entry], oldest first; least recently stored conversation first
+        self._generations = Generations()
+        self._lock = threading.Lock()
+
+    def generation(self, conversation_id: str) -> int:
+        with self._lock:
+            return self._generations.get(conversation_id)
+
+    def _match(self, conversation_id: str, generation: int, question: str, embedding: array = None):
+        """
+        Best live entry for the question, and its similarity (1.0 for the same normalized question).
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = [e for e in self._entries.get(conversation_id, ()) if e.expires_at > now]
+            if entries:
+                self._entries[conversation_id] = entries
+            else:
+                self._entries.pop(conversation_id, None)
+        best, best_similarity = None, None
+        for entry in entries:
+            if entry.generation != generation:
+                continue
+            if entry.question == question:
+                return entry, 1.0
+            if embedding is not None:
+                similarity = _cosine(entry.embedding, embedding)
+                if similarity >= self.similarity and (best_similarity is None or similarity > best_similarity):
+                    best, best_similarity = entry, similarity
+        return best, best_similarity
+
+    async def lookup(self, conversation_id: str, question: str, embed_model) -> AnswerLookup:
+        """
+        Looks for an earlier answer; embed_model embeds the question (only
+        when no earlier question matches it word for word).
+        """
+        result = AnswerLookup(conversation_id, normalize_query(question),
+                              generation=self.generation(conversation_id))
+        with span("chat.answer_cache"):
+            entry, similarity = self._match(conversation_id, result.generation, result.question)
+            if entry is None:
+                result.embedding = _unit(await embed_model.aget_query_embedding(question))
+                entry, similarity = self._match(conversation_id, result.generation, result.question, result.embedding)
+
+        if entry is None:
+            self.misses += 1
+            return result
+        self.hits += 1
+        if similarity < 1.0:
+            self.semantic_hits += 1
+        result.answer = dict(entry.answer)
+        result.similarity = similarity
+        return result
+
+    def store(self, lookup: AnswerLookup, answer: dict):
+        """
+        Remembers the answer computed after a missed lookup, unless the
+        conversation's files changed in the meantime.
+        """
+        if lookup.embedding is None:
+            return
+        entry = _Entry(time.monotonic() + self.ttl, lookup.generation, lookup.question, lookup.embedding, dict(answer))
+        with self._lock:
+            if self._generations.get(lookup.conversation_id) != lookup.generation:
+                return
+            entries = self._entries.pop(lookup.conversation_id, [])
+            entries = [e for e in entries if e.question != entry.question] + [entry]
+            self._entries[lookup.conversation_id] = entries[-self.max_per_conversation:]
+            while len(self._entries) > self.max_conversations:
+                del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            self._generations.bump(conversation_id)
+            self._entries.pop(conversation_id, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "conversations": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+async def record_cached_turn(agent, config: dict, question: str, answer: dict):
+    """
+    Appends the question and the reused answer to the conversation's
+    checkpoint, as if the model had answered, so history and later turns see it.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    with span("chat.answer_cache.checkpoint"):
+        await agent.aupdate_state(
+            config,
+            {"messages": [HumanMessage(content=question), AIMessage(content=answer["answer"])]},
+            as_node="model",
+        )
+
+
+# Process-wide instance used by the chat endpoints and invalidated by the indexing/delete paths
+answer_cache = AnswerCache()
+
+
+async def cached_answer(agent, config: dict, conversation_id: str, question: str) -> tuple:
+    """
+    Returns (earlier answer or None, lookup for remember_answer). A hit is
+    already recorded in the conversation. Cache errors only mean a miss.
+    """
+    if not answer_cache.enabled:
+        return None, None
+    from query_embedding import get_query_embed_model
+    try:
+        lookup = await answer_cache.lookup(conversation_id, question, get_query_embed_model())
+        if lookup.answer is None:
+            return None, lookup
+        await record_cached_turn(agent, config, question, lookup.answer)
+        return lookup.answer, lookup
+    except Exception as e:
+        print(f"Answer cache lookup failed: {e}")
+        return None, None
+
+
+def remember_answer(lookup: AnswerLookup, answer: dict) -> dict:
+    """
+    Stores a freshly generated answer (not the fallback error answer) and returns it.
+    """
+    if lookup is not None and "sources" in answer:
+        answer_cache.store(lookup, answer)
+    return answer
@@ -0,0 +1,184 @@
+"""
+Measures what chunking costs per file: chunks, embedded tokens, bytes stored
+in pgvector and prompt tokens of a search_documents result, for the current
+parse_stage (file identity in metadata, per-type chunk sizes) versus the old
+one (filename preamble in every chunk, SentenceSplitter() defaults).
+Runs offline; no database or API key needed.
+
+Run from backend/ on your own files, or on generated ones:
+
+    python -m benchmarks.chunking papers/*.pdf notes/*.md --output chunking.json
+    python -m benchmarks.chunking --synthetic 20
+"""
+import os
+import json
+import random
+import argparse
+import tempfile
+from types import SimpleNamespace
+from dotenv import load_dotenv
+
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+os.environ.setdefault("SERPER_API_KEY", "offline-benchmark")
+
+from db import EMBED_DIM
+from file_loader import load_pages
+from indexing import IndexItem, parse_stage, chunk_settings
+from agent import format_snippets
+from benchmarks.end_to_end import make_document, make_pdf
+
+load_dotenv()
+
+# The tokenizer SentenceSplitter counts with (cl100k, as used by text-embedding-3-*)
+TOKENIZER = get_tokenizer()
+
+
+def request_for(path: str) -> SimpleNamespace:
+    name = os.path.basename(path)
+    return SimpleNamespace(
+        file_name=name, file_id=f"file_{name}", file_url=f"https://utfs.io/f/{name}", conversation_id="conv_bench",
+    )
+
+
+def spool_of(data: bytes):
+    spool = tempfile.SpooledTemporaryFile()
+    spool.write(data)
+    spool.seek(0)
+    return spool
+
+
+def legacy_nodes(data: bytes, req) -> list:
+    """
+    Chunking as it was before file names moved to metadata.
+    """
+    with spool_of(data) as spool:
+        pages = load_pages(spool, req.file_name)
+    documents = []
+    for page_number, page_text in pages:
+        clean_text = page_text.replace("\x00", "")
+        if not clean_text.strip():
+            continue
+        metadata = {"conversation_id": req.conversation_id, "file_id": req.file_id,
+                    "file_name": req.file_name, "file_url": req.file_url}
+        if page_number is not None:
+            metadata["page_number"] = page_number
+        documents.append(Document(text=clean_text, metadata=metadata,
+                                  excluded_embed_metadata_keys=["conversation_id", "file_id", "file_url", "page_number"]))
+    nodes = SentenceSplitter().get_nodes_from_documents(documents)
+    for node in nodes:
+        node.text = f"The user uploaded a file called '{req.file_name}'. The following is a chunk of the file '{req.file_name}':\n\n{node.text}"
+    return nodes
+
+
+def current_nodes(data: bytes, req) -> list:
+    item = IndexItem(request=req, spool=spool_of(data))
+    parse_stage(item)
+    return item.nodes
+
+
+def legacy_snippets(nodes: list) -> str:
+    snippets = []
+    for i, node in enumerate(nodes):
+        page_number = node.node.metadata.get("page_number")
+        page = f" (page {page_number})" if page_number else ""
+        snippets.append(f"--- Document Snippet {i+1}{page} ---\n{node.node.get_content()}")
+    return "\n\n".join(snippets)
+
+
+def tokens(text: str) -> int:
+    return len(TOKENIZER(text))
+
+
+def measure(nodes: list) -> dict:
+    embedded = sum(tokens(node.get_content(metadata_mode=MetadataMode.EMBED)) for node in nodes)
+    # Row size: text + metadata_ JSON (what PGVectorStore stores), plus a float4 vector
+    text_bytes = sum(
+        len(node.get_content().encode()) + len(json.dumps(node_to_metadata_dict(node, remove_text=True)).encode())
+        for node in nodes
+    )
+    return {
+        "chunks": len(nodes),
+        "embedded_tokens": embedded,
+        "text_bytes": text_bytes,
+        "stored_bytes": text_bytes + 4 * EMBED_DIM * len(nodes),
+    }
+
+
+def prompt_tokens(rng, nodes_by_file: dict, render, searches: int, top_k: int = 3) -> float:
+    """
+    Mean tokens of a search_documents result, for top_k chunks picked from one or two files.
+    """
+    files = [nodes for nodes in nodes_by_file.values() if nodes]
+    total = 0
+    for _ in range(searches):
+        picked = rng.sample(files, min(len(files), rng.choice([1, 2])))
+        pool = [node for nodes in picked for node in nodes]
+        results = [NodeWithScore(node=node, score=1.0) for node in rng.sample(pool, min(top_k, len(pool)))]
+        total += tokens(render(results))
+    return total / searches
+
+
+def synthetic_files(rng, count: int, words: int) -> list:
+    files = []
+    for i in range(count):
+        text = make_document(rng, words)
+        if i % 2:
+            files.append((f"synthetic_paper_{i}.pdf", make_pdf(text)))
+        else:
+            files.append((f"synthetic_notes_{i}.md", text.encode()))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="Files to chunk (PDF or text)")
+    parser.add_argument("--synthetic", type=int, default=0, help="Also chunk this many generated files")
+    parser.add_argument("--words-per-file", type=int, default=4000)
+    parser.add_argument("--searches", type=int, default=200, help="Simulated search_documents calls")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    inputs = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            inputs.append((os.path.basename(path), f.read()))
+    inputs += synthetic_files(rng, args.synthetic or (0 if inputs else 10), args.words_per_file)
+
+    legacy, current, per_file = {}, {}, []
+    for name, data in inputs:
+        req = request_for(name)
+        legacy[name] = legacy_nodes(data, req)
+        current[name] = current_nodes(data, req)
+        per_file.append({
+            "file": name,
+            "chunk_settings": chunk_settings(name),
+            "legacy": measure(legacy[name]),
+            "current": measure(current[name]),
+        })
+
+    results = {"config": vars(args), "files": per_file}
+    for label, nodes_by_file, render in (("legacy", legacy, legacy_snippets), ("current", current, format_snippets)):
+        totals = measure([node for nodes in nodes_by_file.values() for node in nodes])
+        totals["prompt_tokens_per_search"] = prompt_tokens(random.Random(args.seed), nodes_by_file, render, args.searches)
+        results[label] = totals
+    results["savings"] = {
+        key: 1 - results["current"][key] / results["legacy"][key] if results["legacy"][key] else 0.0
+        for key in ("embedded_tokens", "text_bytes", "stored_bytes", "prompt_tokens_per_search")
+    }
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Embeds the chunks of several files indexed at once against a stub embedding
+server that enforces a tokens-per-minute limit, the way indexing did before
+(each file calls aget_text_embedding_batch on its own, the OpenAI client
+retries 429s itself) and through the shared EmbeddingScheduler.
+Reports wall time, requests, 429s and failed files for each.
+Runs offline; no API key needed.
+
+Run from backend/:
+
+    python -m benchmarks.embedding_scheduler --files 8 --chunks-per-file 60 --tokens-per-minute 6000
+"""
+import time
+import json
+import random
+import asyncio
+import argparse
+
+from llama_index.embeddings.openai import OpenAIEmbedding
+
+from embedding_scheduler import EmbeddingScheduler
+from benchmarks.fakes import StubEmbeddingServer, VOCABULARY
+
+
+def make_files(rng, files: int, chunks: int, words: int) -> list:
+    return [
+        [" ".join(rng.choice(VOCABULARY) for _ in range(words)) for _ in range(chunks)]
+        for _ in range(files)
+    ]
+
+
+async def embed_files(files: list, embed) -> tuple:
+    """
+    Embeds every file concurrently; returns (seconds, files that failed).
+    """
+    started = time.perf_counter()
+    results = await asyncio.gather(*(embed(texts) for texts in files), return_exceptions=True)
+    return time.perf_counter() - started, sum(isinstance(r, Exception) for r in results)
+
+
+def run(label: str, args, files: list, make_embed) -> dict:
+    with StubEmbeddingServer(tokens_per_minute=args.tokens_per_minute, window=args.window,
+                             delay=args.latency, delay_per_token=args.latency_per_token) as server:
+        seconds, failed = asyncio.run(embed_files(files, make_embed(server)))
+        result = {
+            "label": label,
+            "seconds": round(seconds, 3),
+            "failed_files": failed,
+            "requests": server.requests,
+            "rate_limited": server.rate_limited,
+            "tokens_embedded": server.tokens,
+            "max_concurrent_requests": server.max_concurrent,
+        }
+    print(f"{label}: {result}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=8, help="Files indexed at the same time")
+    parser.add_argument("--chunks-per-file", type=int, default=60)
+    parser.add_argument("--words-per-chunk", type=int, default=100)
+    parser.add_argument("--tokens-per-minute", type=int, default=6000, help="Stub server limit per window")
+    parser.add_argument("--window", type=float, default=1.0, help="Seconds the limit applies to (60 on the real API)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub seconds per request")
+    parser.add_argument("--latency-per-token", type=float, default=0.00001)
+    parser.add_argument("--client-retries", type=int, default=10, help="OpenAI client retries in the legacy run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    files = make_files(random.Random(args.seed), args.files, args.chunks_per_file, args.words_per_chunk)
+    # The stub's limit is per `window`; scale it so the scheduler's batches fit it the same way
+    batch_tokens = max(args.tokens_per_minute // 4, args.words_per_chunk)
+
+    def legacy(server):
+        model = OpenAIEmbedding(api_base=f"{server.url}/v1", api_key="x", max_retries=args.client_retries)
+        return model.aget_text_embedding_batch
+
+    def scheduled(server):
+        model = OpenAIEmbedding(api_base=f"{server.url}/v1", api_key="x", max_retries=0, embed_batch_size=512)
+        scheduler = EmbeddingScheduler(batch_tokens=batch_tokens, retry_base_delay=args.window / 10,
+                                       latency_target=0)
+        scheduler.count_tokens = server.count_tokens
+        return lambda texts: scheduler.embed(texts, model)
+
+    results = {
+        "config": vars(args),
+        "legacy": run("legacy", args, files, legacy),
+        "scheduler": run("scheduler", args, files, scheduled),
+    }
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
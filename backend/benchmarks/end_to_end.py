@@ -0,0 +1,419 @@
+"""
+Runs the real FastAPI app (lifespan, job queue, agent, pgvector, checkpointer)
+against a local Postgres with every paid service replaced by a stand-in from
+benchmarks.fakes, and measures the endpoints the frontend calls:
+
+- /api/index-file (time to 202 and time until the job succeeded)
+- /api/chat (scripted model calling search_documents / search_internet)
+- /api/chat/{conversation_id}/history (full reads and If-None-Match revalidations)
+- /api/delete-file and /api/delete-conversation
+
+for every corpus size x concurrency level, reporting throughput and p50/p95/p99.
+
+Point DATABASE_URL at a scratch database (pgvector installed) and run from backend/:
+
+    python -m benchmarks.end_to_end --corpus-sizes 10,100 --concurrency 1,8,32 --output e2e.json
+
+Save the JSON per commit and pass an older file with --compare to flag p95 regressions:
+
+    python -m benchmarks.end_to_end --output e2e_new.json --compare e2e_old.json
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import subprocess
+from datetime import datetime, timezone
+from unittest.mock import patch
+from dotenv import load_dotenv
+
+load_dotenv()
+# Nothing below talks to OpenAI or Serper, but their clients want a key at import time
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+os.environ.setdefault("SERPER_API_KEY", "offline-benchmark")
+
+import fitz  # PyMuPDF
+import httpx
+import uvicorn
+from llama_index.core import Settings
+
+from db import EMBED_DIM
+from main import app
+from web_search import web_search_cache
+from benchmarks.fakes import HashingEmbedding, ScriptedAgentModel, StubSerperServer, StubFileServer, VOCABULARY
+
+TERMINAL_JOB_STATES = ("succeeded", "failed")
+
+
+def percentile(sorted_samples: list, q: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, round(q / 100 * len(sorted_samples)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+class Phase:
+    """
+    Latencies and status codes of one kind of request within a run.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.started = None
+        self.finished = None
+
+    async def call(self, request):
+        """
+        Awaits request() (an httpx coroutine), recording its latency and status.
+        """
+        now = time.perf_counter()
+        self.started = self.started or now
+        try:
+            response = await request()
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, type(e).__name__
+        elapsed = time.perf_counter() - now
+        self.finished = time.perf_counter()
+        self.latencies.append(elapsed * 1000)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        return response
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        wall = (self.finished - self.started) if self.started else 0.0
+        errors = sum(count for status, count in self.statuses.items() if not status.startswith(("2", "3")))
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "statuses": self.statuses,
+            "throughput_rps": len(latencies) / wall if wall else 0.0,
+            "mean_ms": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        }
+
+
+async def bounded(concurrency: int, calls: list):
+    """
+    Runs the coroutine factories in `calls` with at most `concurrency` in flight.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            return await call()
+
+    return await asyncio.gather(*(run(call) for call in calls))
+
+
+def make_document(rng, words: int) -> str:
+    paragraphs = []
+    while words > 0:
+        length = min(words, rng.randrange(40, 120))
+        paragraphs.append(" ".join(rng.choice(VOCABULARY) for _ in range(length)) + ".")
+        words -= length
+    return "\n\n".join(paragraphs)
+
+
+def make_pdf(text: str, words_per_page: int = 350) -> bytes:
+    doc = fitz.open()
+    words = text.split()
+    for start in range(0, len(words), words_per_page):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (40, 40, -40, -40), " ".join(words[start:start + words_per_page]), fontsize=8)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def make_corpus(rng, files: StubFileServer, run_id: str, size: int, files_per_conversation: int,
+                words: int, pdf_every: int) -> list:
+    """
+    `size` files spread over conversations of files_per_conversation files.
+    Every document is new text (seeded by the run), so nothing comes from the embedding cache.
+    """
+    corpus = []
+    for i in range(size):
+        text = make_document(rng, words)
+        if pdf_every and i % pdf_every == pdf_every - 1:
+            name, data, content_type = f"paper_{i}.pdf", make_pdf(text), "application/pdf"
+        else:
+            name, data, content_type = f"notes_{i}.txt", text.encode(), "text/plain"
+        corpus.append({
+            "file_name": name,
+            "file_id": f"{run_id}_file_{i}",
+            "file_url": files.add(name, data, content_type),
+            "conversation_id": f"{run_id}_conv_{i // files_per_conversation}",
+            "text": text,
+        })
+    return corpus
+
+
+async def wait_for_job(client, job_id: str, submitted: float, poll_interval: float, timeout: float) -> dict:
+    while True:
+        response = await client.get(f"/api/index-jobs/{job_id}")
+        if response.status_code == 200 and response.json()["status"] in TERMINAL_JOB_STATES:
+            job = response.json()
+            job["seconds"] = time.perf_counter() - submitted
+            return job
+        if time.perf_counter() - submitted > timeout:
+            return {"id": job_id, "status": "timed_out", "seconds": timeout, "chunks_total": 0}
+        await asyncio.sleep(poll_interval)
+
+
+async def run_once(client, rng, files: StubFileServer, size: int, concurrency: int, args) -> dict:
+    run_id = f"bench_{size}_{concurrency}_{rng.randrange(16 ** 8):08x}"
+    corpus = make_corpus(rng, files, run_id, size, args.files_per_conversation, args.words_per_file, args.pdf_every)
+    conversations = sorted({f["conversation_id"] for f in corpus})
+    print(f"Run {run_id}: {size} files, {len(conversations)} conversations, concurrency {concurrency}")
+
+    # 1. Index: time to 202, then time until every job finished
+    submit, jobs = Phase(), []
+    started = time.perf_counter()
+
+    async def index(file):
+        body = {key: file[key] for key in ("file_name", "file_id", "file_url", "conversation_id")}
+        while True:
+            submitted = time.perf_counter()
+            response = await submit.call(lambda: client.post("/api/index-file", json=body))
+            if response is not None and response.status_code == 503:
+                await asyncio.sleep(float(response.headers.get("retry-after", "1")))
+                continue
+            if response is None or response.status_code != 202:
+                return
+            jobs.append(await wait_for_job(client, response.json()["job_id"], submitted,
+                                           args.poll_interval, args.job_timeout))
+            return
+
+    await bounded(concurrency, [lambda file=file: index(file) for file in corpus])
+    index_wall = time.perf_counter() - started
+    job_seconds = sorted(job["seconds"] * 1000 for job in jobs)
+    chunks = sum(job.get("chunks_total", 0) for job in jobs)
+    index_summary = {
+        "submit": submit.summary(),
+        "jobs": {
+            "succeeded": sum(job["status"] == "succeeded" for job in jobs),
+            "failed": sum(job["status"] != "succeeded" for job in jobs),
+            "chunks": chunks,
+            "files_per_second": len(jobs) / index_wall if index_wall else 0.0,
+            "chunks_per_second": chunks / index_wall if index_wall else 0.0,
+            "p50_ms": percentile(job_seconds, 50),
+            "p95_ms": percentile(job_seconds, 95),
+            "p99_ms": percentile(job_seconds, 99),
+        },
+    }
+
+    # 2. Chat: each conversation asks its questions in order, conversations run concurrently
+    chat = Phase()
+    texts = {}
+    for file in corpus:
+        texts.setdefault(file["conversation_id"], []).append(file["text"].split())
+    for turn in range(args.chats_per_conversation):
+        calls = []
+        for cid in conversations:
+            if args.internet_every and turn % args.internet_every == args.internet_every - 1:
+                message = f"search the internet for {' '.join(rng.sample(VOCABULARY, 3))}"
+            else:
+                words = rng.choice(texts[cid])
+                start = rng.randrange(max(1, len(words) - 8))
+                message = "what does the paper say about " + " ".join(words[start:start + 8])
+            body = {"message": message, "conversation_id": cid}
+            calls.append(lambda body=body: chat.call(lambda: client.post("/api/chat", json=body)))
+        await bounded(concurrency, calls)
+
+    # 3. History: full reads, then revalidation with the ETag the client got
+    history, not_modified = Phase(), Phase()
+    etags = {}
+
+    async def read_history(cid):
+        response = await history.call(lambda: client.get(f"/api/chat/{cid}/history", params={"limit": 20}))
+        if response is not None and "etag" in response.headers:
+            etags[cid] = response.headers["etag"]
+
+    for _ in range(args.history_reads):
+        await bounded(concurrency, [lambda cid=cid: read_history(cid) for cid in conversations])
+        await bounded(concurrency, [
+            lambda cid=cid: not_modified.call(lambda: client.get(
+                f"/api/chat/{cid}/history", params={"limit": 20}, headers={"If-None-Match": etags.get(cid, "")}))
+            for cid in conversations
+        ])
+
+    # 4. Deletes: one file per conversation, then the conversations
+    delete_file, delete_conversation = Phase(), Phase()
+    first_files = {}
+    for file in corpus:
+        first_files.setdefault(file["conversation_id"], file["file_id"])
+    await bounded(concurrency, [
+        lambda cid=cid, file_id=file_id: delete_file.call(lambda: client.post(
+            "/api/delete-file", json={"file_id": file_id, "conversation_id": cid}))
+        for cid, file_id in first_files.items()
+    ])
+    await bounded(concurrency, [
+        lambda cid=cid: delete_conversation.call(lambda: client.post(
+            "/api/delete-conversation", json={"conversation_id": cid}))
+        for cid in conversations
+    ])
+
+    return {
+        "corpus_files": size,
+        "conversations": len(conversations),
+        "concurrency": concurrency,
+        "index": index_summary,
+        "chat": chat.summary(),
+        "history": history.summary(),
+        "history_not_modified": not_modified.summary(),
+        "delete_file": delete_file.summary(),
+        "delete_conversation": delete_conversation.summary(),
+    }
+
+
+def p95_by_phase(run: dict) -> dict:
+    values = {"index_job": run["index"]["jobs"]["p95_ms"], "index_submit": run["index"]["submit"]["p95_ms"]}
+    for phase in ("chat", "history", "history_not_modified", "delete_file", "delete_conversation"):
+        values[phase] = run[phase]["p95_ms"]
+    return values
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list:
+    """
+    p95 ratio (current / baseline) for every phase of every run present in both.
+    """
+    previous = {(run["corpus_files"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    rows = []
+    for run in results["runs"]:
+        old = previous.get((run["corpus_files"], run["concurrency"]))
+        if old is None:
+            continue
+        old_p95 = p95_by_phase(old)
+        for phase, p95 in p95_by_phase(run).items():
+            if not old_p95.get(phase):
+                continue
+            ratio = p95 / old_p95[phase]
+            rows.append({
+                "corpus_files": run["corpus_files"], "concurrency": run["concurrency"], "phase": phase,
+                "baseline_p95_ms": old_p95[phase], "p95_ms": p95, "ratio": ratio, "regression": ratio > threshold,
+            })
+    return rows
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def start_server(port: int) -> tuple:
+    """
+    Serves the app with uvicorn in a background thread (the lifespan runs there too)
+    and returns once it reports ready.
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Server failed to start (see the output above)")
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+    # Measure a warm instance: wait for the startup warm-up to finish
+    while httpx.get(f"{base_url}/health/ready").status_code != 200:
+        time.sleep(0.1)
+    return server, thread, base_url
+
+
+async def run_all(base_url: str, files: StubFileServer, args) -> dict:
+    rng = random.Random(args.seed)
+    results = {"runs": []}
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        for size in args.corpus_sizes:
+            for concurrency in args.concurrency:
+                results["runs"].append(await run_once(client, rng, files, size, concurrency, args))
+        results["cache_stats"] = (await client.get("/api/cache-stats")).json()
+        results["db_stats"] = (await client.get("/api/db-stats")).json()
+    return results
+
+
+def int_list(value: str) -> list:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus-sizes", type=int_list, default=[10, 50], help="Files per run, comma separated")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8], help="Requests in flight, comma separated")
+    parser.add_argument("--files-per-conversation", type=int, default=2)
+    parser.add_argument("--words-per-file", type=int, default=3000)
+    parser.add_argument("--pdf-every", type=int, default=4, help="Every Nth file is a PDF (0: text files only)")
+    parser.add_argument("--chats-per-conversation", type=int, default=4)
+    parser.add_argument("--internet-every", type=int, default=4, help="Every Nth chat turn searches the internet")
+    parser.add_argument("--history-reads", type=int, default=3)
+    parser.add_argument("--model-latency", type=float, default=0.0, help="Seconds per chat model call")
+    parser.add_argument("--serper-latency", type=float, default=0.3, help="Seconds per stub Serper response")
+    parser.add_argument("--file-latency", type=float, default=0.0, help="Seconds before the file server answers")
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--job-timeout", type=float, default=600)
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--compare", help="Earlier results to compare p95 latencies against")
+    parser.add_argument("--regression-threshold", type=float, default=1.2,
+                        help="p95 ratio above which a phase is reported as a regression")
+    args = parser.parse_args()
+
+    if not os.getenv("DATABASE_URL"):
+        raise ValueError("DATABASE_URL not set")
+
+    embed_model = HashingEmbedding(dim=EMBED_DIM)
+    Settings.embed_model = embed_model
+    model = ScriptedAgentModel(latency=args.model_latency)
+
+    with StubSerperServer(delay=args.serper_latency) as serper, StubFileServer(delay=args.file_latency) as files, \
+            patch("agent.init_chat_model", return_value=model):
+        web_search_cache.client.base_url = serper.url
+        server, thread, base_url = start_server(args.port)
+        try:
+            results = {
+                "commit": git_commit(),
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "config": vars(args),
+            }
+            results.update(asyncio.run(run_all(base_url, files, args)))
+            results["stand_ins"] = {
+                "embedding_calls": embed_model.calls,
+                "serper_requests": sum(serper.requests.values()),
+                "file_downloads": sum(files.downloads.values()),
+            }
+        finally:
+            server.should_exit = True
+            thread.join()
+
+    if args.compare:
+        with open(args.compare) as f:
+            results["comparison"] = compare(json.load(f), results, args.regression_threshold)
+        for row in results["comparison"]:
+            flag = "REGRESSION" if row["regression"] else "ok"
+            print(f"{row['corpus_files']:>6} files  c={row['concurrency']:<4} {row['phase']:<22} "
+                  f"p95 {row['baseline_p95_ms']:9.1f} -> {row['p95_ms']:9.1f} ms  x{row['ratio']:.2f}  {flag}")
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
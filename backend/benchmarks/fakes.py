@@ -0,0 +1,308 @@
+"""
+Deterministic stand-ins for paid services, so benchmarks run offline and repeatably.
+"""
+import re
+import json
+import base64
+import time
+import uuid
+import zlib
+import math
+import asyncio
+import threading
+from array import array
+from collections import Counter, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from llama_index.core.embeddings import BaseEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+# Words synthetic documents and queries are made of
+VOCABULARY = (
+    "model data network training layer result method paper table figure value error loss "
+    "accuracy dataset feature system process memory cache query index vector search token "
+    "graph node edge weight batch sample gradient score metric baseline experiment analysis"
+).split()
+
+
+class HashingEmbedding(BaseEmbedding):
+    """
+    Bag-of-words feature hashing: texts sharing words get similar vectors, which
+    is enough to exercise vector search without calling an embedding API.
+    Counts calls so benchmarks can report how many embeddings were needed.
+    """
+    dim: int = 256
+    _calls: int = PrivateAttr(default=0)
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def _vector(self, text: str) -> list:
+        self._calls += 1
+        vector = [0.0] * self.dim
+        for word in re.findall(r"\w+", text.lower()):
+            h = zlib.crc32(word.encode())
+            vector[h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> list:
+        return self._vector(query)
+
+    def _get_text_embedding(self, text: str) -> list:
+        return self._vector(text)
+
+    async def _aget_query_embedding(self, query: str) -> list:
+        return self._vector(query)
+
+
+class ScriptedAgentModel(BaseChatModel):
+    """
+    Chat model that drives the RAG agent like a well-behaved LLM, without an API:
+    a user message becomes one search_documents call (search_internet when the
+    message mentions "internet"), a tool result becomes the ResponseFormat answer.
+    It only looks at the messages, so one instance can serve concurrent requests.
+    `latency` seconds are spent on every call to stand in for the model's response time.
+    """
+    latency: float = 0.0
+    answer_chars: int = 200
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-agent"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages: list) -> AIMessage:
+        last = messages[-1]
+        if last.type == "tool":
+            name, args = "ResponseFormat", {
+                "did_search_internet": last.name == "search_internet",
+                "final_answer": str(last.content)[:self.answer_chars],
+            }
+        else:
+            query = str(last.content)
+            name = "search_internet" if "internet" in query.lower() else "search_documents"
+            args = {"query": query}
+        return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{uuid.uuid4().hex}"}])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+
+class LocalServer:
+    """
+    ThreadingHTTPServer on a free local port, run in a daemon thread while
+    used as a context manager. Subclasses implement handle(request).
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        raise NotImplementedError
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(server.delay)
+                server.handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    @staticmethod
+    def reply(request: BaseHTTPRequestHandler, status: int, payload: bytes, content_type: str):
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StubSerperServer(LocalServer):
+    """
+    Answers like google.serper.dev; point SerperSearch(base_url=server.url) at it.
+    Each response takes `delay` seconds; `fail_next` makes that many requests
+    return 500. Requests are counted per query in `requests`.
+    """
+
+    def __init__(self, delay: float = 0.0, api_key: str = None):
+        super().__init__(delay)
+        self.api_key = api_key
+        self.fail_next = 0
+        self.requests = Counter()
+
+    def handle(self, request):
+        query = parse_qs(urlparse(request.path).query).get("q", [""])[0]
+        with self._lock:
+            self.requests[query] += 1
+            fail = self.fail_next > 0
+            self.fail_next -= fail
+        if self.api_key is not None and request.headers.get("X-API-KEY") != self.api_key:
+            return self._json(request, 403, {"message": "Unauthorized."})
+        if fail:
+            return self._json(request, 500, {"message": "Stub failure."})
+        self._json(request, 200, {
+            "searchParameters": {"q": query},
+            "organic": [
+                {"title": f"{query} ({i})", "link": f"https://example.com/{i}", "snippet": f"Result {i} about {query}."}
+                for i in range(1, 4)
+            ],
+        })
+
+    def _json(self, request, status: int, body: dict):
+        self.reply(request, status, json.dumps(body).encode(), "application/json")
+
+
+class StubFileServer(LocalServer):
+    """
+    Serves in-memory files, standing in for the UploadThing CDN.
+    add() returns the URL to put in an index request; unknown paths are 404s.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        super().__init__(delay)
+        self.files = {}  # path -> (content type, bytes)
+        self.downloads = Counter()
+
+    def add(self, name: str, data: bytes, content_type: str = "application/octet-stream") -> str:
+        path = f"/f/{uuid.uuid4().hex}/{name}"
+        self.files[path] = (content_type, data)
+        return f"{self.url}{path}"
+
+    def handle(self, request):
+        entry = self.files.get(urlparse(request.path).path)
+        if entry is None:
+            return self.reply(request, 404, b"Not found", "text/plain")
+        with self._lock:
+            self.downloads[request.path] += 1
+        self.reply(request, 200, entry[1], entry[0])
+
+
+class StubEmbeddingServer(LocalServer):
+    """
+    Answers like OpenAI's /v1/embeddings with HashingEmbedding vectors and
+    enforces a tokens-per-minute limit over a sliding `window` (60s like the
+    real one; shorten it in tests). Requests over the limit get a 429 with
+    Retry-After, like the API. Point OpenAIEmbedding(api_base=f"{server.url}/v1") at it.
+    Tokens are counted as words. Each request takes `delay` seconds plus
+    `delay_per_token` per token.
+    """
+
+    def __init__(self, tokens_per_minute: int = 0, window: float = 60.0, delay: float = 0.0,
+                 delay_per_token: float = 0.0, dim: int = 256):
+        super().__init__()
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.request_delay = delay
+        self.delay_per_token = delay_per_token
+        self.embedding = HashingEmbedding(dim=dim)
+        self.requests = 0
+        self.rate_limited = 0
+        self.tokens = 0
+        self.inputs = 0
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self._used = deque()  # (time, tokens) of accepted requests inside the window
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return max(len(text.split()), 1)
+
+    def _admit(self, tokens: int):
+        """
+        Returns None if the request fits in the limit, else the seconds until it would.
+        """
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self._used and self._used[0][0] <= now - self.window:
+                self._used.popleft()
+            used = sum(t for _, t in self._used)
+            if self.tokens_per_minute and used + tokens > self.tokens_per_minute:
+                self.rate_limited += 1
+                freed, wait = 0, self.window
+                for at, t in self._used:
+                    freed += t
+                    if used - freed + tokens <= self.tokens_per_minute:
+                        wait = at + self.window - now
+                        break
+                return max(wait, 0.001)
+            self._used.append((now, tokens))
+            self.tokens += tokens
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+            return None
+
+    def handle(self, request):
+        body = json.loads(request.rfile.read(int(request.headers.get("Content-Length", 0))) or b"{}")
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(self.count_tokens(text) for text in texts)
+
+        retry_after = self._admit(tokens)
+        if retry_after is not None:
+            payload = json.dumps({"error": {
+                "message": "Rate limit reached for tokens per min (TPM).", "type": "tokens", "code": "rate_limit_exceeded",
+            }}).encode()
+            request.send_response(429)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(payload)))
+            request.send_header("Retry-After", f"{retry_after:.3f}")
+            request.end_headers()
+            request.wfile.write(payload)
+            return
+
+        try:
+            time.sleep(self.request_delay + self.delay_per_token * tokens)
+            data = []
+            for i, text in enumerate(texts):
+                vector = self.embedding.get_text_embedding(text)
+                if body.get("encoding_format") == "base64":
+                    vector = base64.b64encode(array("f", vector).tobytes()).decode()
+                data.append({"object": "embedding", "index": i, "embedding": vector})
+            with self._lock:
+                self.inputs += len(texts)
+            payload = json.dumps({
+                "object": "list", "data": data, "model": body.get("model", "stub"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }).encode()
+            self.reply(request, 200, payload, "application/json")
+        finally:
+            with self._lock:
+                self.concurrent -= 1
@@ -0,0 +1,184 @@
+"""
+Benchmarks conversation-filtered vector search and file/conversation deletes
+before and after the migrations in migrations.py, on a synthetic table.
+
+Point DATABASE_URL at a scratch database (pgvector installed) and run from backend/:
+
+    python -m benchmarks.filter_columns --rows 2000000 --output filter_columns.json
+
+The table mirrors the one PGVectorStore creates. "before" is the current
+layout (filters on metadata_->>'...', no vector index); "after" is the same
+table once the filter columns, their btree indexes and the HNSW index exist.
+Deletes run inside a rolled-back transaction so every sample deletes the same rows.
+"""
+import os
+import json
+import time
+import random
+import argparse
+import statistics
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+import migrations
+
+load_dotenv()
+
+
+def create_table(engine, table: str, rows: int, dim: int, conversations: int, files: int, batch: int):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        conn.execute(text(f"""
+            CREATE TABLE {table} (
+                id BIGSERIAL PRIMARY KEY,
+                text VARCHAR NOT NULL,
+                metadata_ JSON,
+                node_id VARCHAR,
+                embedding VECTOR({dim})
+            )
+        """))
+    for start in range(1, rows + 1, batch):
+        stop = min(start + batch - 1, rows)
+        with engine.begin() as conn:
+            # "WHERE g > 0" makes the subquery correlated, so every row gets its own vector
+            conn.execute(text(f"""
+                INSERT INTO {table} (text, metadata_, node_id, embedding)
+                SELECT
+                    'chunk ' || g,
+                    json_build_object(
+                        'conversation_id', 'conv_' || (g % :conversations),
+                        'file_id', 'file_' || (g % :conversations) || '_' || ((g / :conversations) % :files),
+                        'file_name', 'file.pdf'
+                    ),
+                    md5(g::text),
+                    (SELECT array_agg(random()::real) FROM generate_series(1, :dim) WHERE g > 0)::vector
+                FROM generate_series(:start, :stop) AS g
+            """), {"conversations": conversations, "files": files, "dim": dim, "start": start, "stop": stop})
+        print(f"Inserted {stop}/{rows} rows")
+    with engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {table}"))
+
+
+def timed(fn, samples: int) -> dict:
+    latencies = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "samples": samples,
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def run_workload(engine, table: str, use_columns: bool, conversations: int, files: int, samples: int, rng) -> dict:
+    conversation_col = "conversation_id" if use_columns else "metadata_->>'conversation_id'"
+    file_col = "file_id" if use_columns else "metadata_->>'file_id'"
+
+    with engine.connect() as conn:
+        query_vectors = list(conn.execute(text(
+            f"SELECT embedding::text FROM {table} ORDER BY random() LIMIT :n"
+        ), {"n": samples}).scalars())
+
+    def search():
+        cid = rng.randrange(conversations)
+        with engine.begin() as conn:
+            conn.execute(text(f"SET LOCAL hnsw.ef_search = {migrations.HNSW_EF_SEARCH}"))
+            conn.execute(text(f"""
+                SELECT id FROM {table}
+                WHERE {conversation_col} = :cid
+                ORDER BY embedding <=> CAST(:q AS vector) LIMIT 3
+            """), {"cid": f"conv_{cid}", "q": rng.choice(query_vectors)}).all()
+
+    def delete(column_sql: str, value: str):
+        with engine.connect() as conn:
+            trans = conn.begin()
+            conn.execute(text(f"DELETE FROM {table} WHERE {column_sql} = :v"), {"v": value})
+            trans.rollback()
+
+    def delete_file():
+        cid = rng.randrange(conversations)
+        delete(file_col, f"file_{cid}_{rng.randrange(files)}")
+
+    def delete_conversation():
+        delete(conversation_col, f"conv_{rng.randrange(conversations)}")
+
+    return {
+        "filtered_search": timed(search, samples),
+        "delete_file": timed(delete_file, samples),
+        "delete_conversation": timed(delete_conversation, samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table", default="bench_paperparrot_embeddings")
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--conversations", type=int, default=20_000)
+    parser.add_argument("--files-per-conversation", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--insert-batch", type=int, default=50_000)
+    parser.add_argument("--reuse", action="store_true", help="Skip table creation (table must be un-migrated)")
+    parser.add_argument("--keep", action="store_true", help="Don't drop the table afterwards")
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise ValueError("DATABASE_URL not set")
+    engine = create_engine(db_url)
+    rng = random.Random(0)
+    table = args.table
+    results = {"config": vars(args), "hnsw": {
+        "m": migrations.HNSW_M,
+        "ef_construction": migrations.HNSW_EF_CONSTRUCTION,
+        "ef_search": migrations.HNSW_EF_SEARCH,
+    }}
+
+    try:
+        if not args.reuse:
+            started = time.perf_counter()
+            create_table(engine, table, args.rows, args.dim, args.conversations,
+                         args.files_per_conversation, args.insert_batch)
+            results["load_seconds"] = time.perf_counter() - started
+
+        results["before"] = run_workload(engine, table, False, args.conversations,
+                                         args.files_per_conversation, args.samples, rng)
+
+        steps = {}
+        for name, step in [
+            ("add_filter_columns", lambda: migrations.add_filter_columns(engine, table)),
+            ("backfill_filter_columns", lambda: migrations.backfill_filter_columns(engine, table)),
+            ("create_filter_indexes", lambda: migrations.create_filter_indexes(engine, table)),
+            ("create_hnsw_index", lambda: migrations.create_hnsw_index(engine, table)),
+        ]:
+            started = time.perf_counter()
+            step()
+            steps[name] = time.perf_counter() - started
+        with engine.begin() as conn:
+            conn.execute(text(f"ANALYZE {table}"))
+        results["migration_seconds"] = steps
+
+        results["after"] = run_workload(engine, table, True, args.conversations,
+                                        args.files_per_conversation, args.samples, rng)
+    finally:
+        if not args.keep:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+                conn.execute(text(f"DROP FUNCTION IF EXISTS {table}_filter_columns()"))
+        engine.dispose()
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Compares pure vector retrieval with HybridRetriever (full-text + vector, RRF,
+lexical fast path) on a synthetic corpus: recall@k, latency and how many
+query embeddings each needed.
+
+Point DATABASE_URL at a scratch database (pgvector installed) and run from backend/:
+
+    python -m benchmarks.hybrid_retrieval --conversations 200 --output hybrid.json
+
+Embeddings come from benchmarks.fakes.HashingEmbedding, so no API key is needed.
+Two kinds of queries are generated, each with one known relevant chunk:
+- lookups of an identifier planted in a single chunk (an error code, a function name, an author)
+- paraphrase-like questions made of a handful of words taken from one chunk
+"""
+import os
+import json
+import time
+import random
+import argparse
+import statistics
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from dotenv import load_dotenv
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.schema import TextNode
+from llama_index.vector_stores.postgres import PGVectorStore
+
+import migrations
+from hybrid_retrieval import HybridRetriever, HYBRID_CANDIDATES
+from benchmarks.fakes import HashingEmbedding, VOCABULARY as WORDS
+
+load_dotenv()
+
+SURNAMES = ["Okafor", "Lindqvist", "Tanaka", "Moreau", "Haddad", "Kowalski", "Ferreira", "Nguyen"]
+
+
+def make_corpus(rng, conversations: int, chunks: int, words: int) -> tuple:
+    """
+    Returns (nodes, queries). Each query is (conversation_id, kind, text, relevant node id).
+    """
+    nodes, queries = [], []
+    for c in range(conversations):
+        cid = f"conv_{c}"
+        for i in range(chunks):
+            node_id = f"{cid}_chunk_{i}"
+            body = [rng.choice(WORDS) for _ in range(words)]
+            if i % 3 == 0:
+                kind = rng.choice(["error", "function", "author"])
+                planted = {
+                    "error": f"ERR_{rng.randrange(10_000, 99_999)}",
+                    "function": f"parse_{rng.choice(WORDS)}_{rng.choice(WORDS)}_v{rng.randrange(10)}",
+                    "author": f"{rng.choice(SURNAMES)}{rng.randrange(100)}",
+                }[kind]
+                body.insert(rng.randrange(len(body)), planted)
+                queries.append((cid, "lookup", planted, node_id))
+            else:
+                picked = rng.sample(body, min(6, len(body)))
+                queries.append((cid, "question", " ".join(picked), node_id))
+            nodes.append(TextNode(
+                id_=node_id,
+                text=" ".join(body),
+                metadata={"conversation_id": cid, "file_id": f"{cid}_file", "file_name": "paper.pdf"},
+            ))
+    return nodes, queries
+
+
+def summarize(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def evaluate(name: str, build_retriever, queries: list, embed_model, top_k: int) -> dict:
+    results = {}
+    for kind in ("lookup", "question"):
+        subset = [q for q in queries if q[1] == kind]
+        calls_before = embed_model.calls
+        latencies, hits = [], 0
+        for cid, _, query, relevant in subset:
+            retriever = build_retriever(cid)
+            started = time.perf_counter()
+            retrieved = retriever.retrieve(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += any(r.node.node_id == relevant for r in retrieved[:top_k])
+        results[kind] = {
+            "queries": len(subset),
+            f"recall@{top_k}": hits / len(subset) if subset else 0.0,
+            "query_embeddings": embed_model.calls - calls_before,
+            **summarize(latencies or [0.0]),
+        }
+        print(f"{name} / {kind}: {results[kind]}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--table-name", default="bench_hybrid", help="PGVectorStore table name (gets a data_ prefix)")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--chunks-per-conversation", type=int, default=60)
+    parser.add_argument("--words-per-chunk", type=int, default=120)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--keep", action="store_true", help="Don't drop the table afterwards")
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    db_url = os.getenv("DATABASE_URL")
+    if not db_url:
+        raise ValueError("DATABASE_URL not set")
+    engine = create_engine(db_url)
+    async_engine = create_async_engine(db_url.replace("postgresql://", "postgresql+asyncpg://"))
+    table = f"data_{args.table_name}"
+    rng = random.Random(0)
+    embed_model = HashingEmbedding(dim=args.dim)
+
+    store = PGVectorStore(
+        table_name=args.table_name,
+        embed_dim=args.dim,
+        engine=engine,
+        async_engine=async_engine,
+        hnsw_kwargs=migrations.hnsw_kwargs(),
+        customize_query_fn=migrations.filter_by_columns,
+    )
+    results = {"config": vars(args)}
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        store._initialize()
+        # Columns + trigger before the load, indexes after (faster to build once)
+        migrations.add_filter_columns(engine, table)
+        migrations.add_text_search_column(engine, table)
+
+        nodes, queries = make_corpus(rng, args.conversations, args.chunks_per_conversation, args.words_per_chunk)
+        started = time.perf_counter()
+        for i in range(0, len(nodes), 1000):
+            batch = nodes[i:i + 1000]
+            for node, embedding in zip(batch, embed_model.get_text_embedding_batch([n.text for n in batch])):
+                node.embedding = embedding
+            store.add(batch)
+        migrations.create_filter_indexes(engine, table)
+        migrations.create_text_search_index(engine, table)
+        with engine.begin() as conn:
+            conn.execute(text(f"ANALYZE {table}"))
+        results["load_seconds"] = time.perf_counter() - started
+        results["chunks"] = len(nodes)
+
+        queries = rng.sample(queries, min(args.queries, len(queries)))
+        index = VectorStoreIndex.from_vector_store(store, embed_model=embed_model)
+
+        def vector_retriever(cid, top_k):
+            return index.as_retriever(similarity_top_k=top_k, vector_store_kwargs={"conversation_id": cid})
+
+        results["vector"] = evaluate(
+            "vector", lambda cid: vector_retriever(cid, args.top_k), queries, embed_model, args.top_k,
+        )
+        results["hybrid"] = evaluate(
+            "hybrid",
+            lambda cid: HybridRetriever(
+                vector_retriever(cid, HYBRID_CANDIDATES), engine, cid, "conversation_id",
+                similarity_top_k=args.top_k, table=table,
+            ),
+            queries, embed_model, args.top_k,
+        )
+    finally:
+        if not args.keep:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+                conn.execute(text(f"DROP FUNCTION IF EXISTS {table}_filter_columns()"))
+        engine.dispose()
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    main()
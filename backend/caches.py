@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "1024"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))
+# Conversations whose invalidation counter is kept (the least recently invalidated are dropped)
+CACHE_GENERATIONS_MAX = int(os.getenv("CACHE_GENERATIONS_MAX", "10000"))
+
+
+def normalize_query(query: str) -> str:
+    """
+    Case and whitespace insensitive form of a query, used as a cache key.
+    """
+    return " ".join(query.casefold().split())
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache whose entries also expire after ttl seconds.
+    Tools run in worker threads, so every access goes through a lock.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        # Caller holds self._lock
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else None
+
+    def _evict_oldest(self):
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+class Generations:
+    """
+    Per-conversation invalidation counters, kept for at most max_entries
+    conversations. Values come from one increasing counter, and a conversation
+    that isn't (or is no longer) in the map reads as the highest value dropped
+    so far: never lower than its own, so a result computed before an
+    invalidation is still never stored (at worst a fresh one isn't).
+    Not locked: callers hold their cache's lock.
+    """
+
+    def __init__(self, max_entries: int = CACHE_GENERATIONS_MAX):
+        self.max_entries = max_entries
+        self._last = 0
+        self._dropped = 0
+        self._values = OrderedDict()  # conversation_id -> value, least recently bumped first
+
+    def get(self, conversation_id: str) -> int:
+        return self._values.get(conversation_id, self._dropped)
+
+    def bump(self, conversation_id: str):
+        self._last += 1
+        self._values[conversation_id] = self._last
+        self._values.move_to_end(conversation_id)
+        while len(self._values) > self.max_entries:
+            _, self._dropped = self._values.popitem(last=False)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class RetrievalCache(TTLCache):
+    """
+    search_documents results keyed by (conversation_id, normalized query).
+    Indexing and deletes call invalidate(conversation_id) to drop exactly that
+    conversation's entries. A per-conversation generation counter stops a
+    retrieval that started before an invalidation from caching its stale result.
+    """
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES, ttl: float = RETRIEVAL_CACHE_TTL):
+        super().__init__(max_entries, ttl)
+        self.invalidations = 0
+        self._keys_by_conversation = {}  # conversation_id -> set of keys
+        self._generations = Generations()
+
+    def generation(self, conversation_id: str) -> int:
+        with self._lock:
+            return self._generations.get(conversation_id)
+
+    def get_results(self, conversation_id: str, query: str):
+        return self.get((conversation_id, normalize_query(query)))
+
+    def put_results(self, conversation_id: str, query: str, results, generation: int):
+        key = (conversation_id, normalize_query(query))
+        # One critical section: an invalidate() can't slip in between the check and the insert
+        with self._lock:
+            if self._generations.get(conversation_id) != generation:
+                return
+            self._keys_by_conversation.setdefault(conversation_id, set()).add(key)
+            self._put(key, results)
+
+    def _evict_oldest(self):
+        (conversation_id, _) = key = next(iter(self._entries))
+        super()._evict_oldest()
+        keys = self._keys_by_conversation.get(conversation_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_conversation[conversation_id]
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            self._generations.bump(conversation_id)
+            for key in self._keys_by_conversation.pop(conversation_id, ()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["invalidations"] = self.invalidations
+        return stats
+
+
+# Process-wide instance shared by search_documents and the indexing/delete paths
+retrieval_cache = RetrievalCache()
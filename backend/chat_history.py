@@ -0,0 +1,110 @@
+import os
+import hashlib
+from dotenv import load_dotenv
+
+from caches import TTLCache
+
+load_dotenv()
+
+# Largest page a client can ask for with ?limit= (without a limit the whole history is returned)
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "256"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "600"))
+
+# (conversation_id, checkpoint_id) -> turns. A checkpoint never changes once
+# written, so paging through older turns doesn't deserialize it again.
+history_cache = TTLCache(HISTORY_CACHE_MAX_ENTRIES, HISTORY_CACHE_TTL)
+
+
+async def latest_checkpoint_id(checkpointer, config: dict):
+    """
+    Id of the conversation's latest checkpoint, without loading the checkpoint.
+    For the Postgres saver that's one primary-key lookup; other savers
+    (InMemorySaver in tests) go through aget_tuple.
+    """
+    from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+    if isinstance(checkpointer, AsyncPostgresSaver):
+        async with checkpointer.conn.connection() as conn:
+            cur = await conn.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = %s AND checkpoint_ns = '' "
+                "ORDER BY checkpoint_id DESC LIMIT 1",
+                (config["configurable"]["thread_id"],),
+            )
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+    checkpoint_tuple = await checkpointer.aget_tuple(config)
+    if checkpoint_tuple is None:
+        return None
+    return checkpoint_tuple.config["configurable"]["checkpoint_id"]
+
+
+def message_turns(messages: list) -> list:
+    """
+    Keeps only what the chat UI shows: user messages and assistant answers
+    (including the final_answer of the structured response). Tool calls,
+    tool results and retrieved snippets are dropped.
+    """
+    history = []
+    for i, msg in enumerate(messages):
+        # 1. Handle User Messages
+        if msg.type == "human":
+            content_to_show = msg.content
+            role = "user"
+
+        # 2. Handle AI Messages
+        elif msg.type == "ai":
+            content_to_show = msg.content
+            role = "assistant"
+
+            # Extract Structured Output (Hidden content)
+            if not content_to_show and getattr(msg, "tool_calls", None):
+                for tool_call in msg.tool_calls:
+                    args = tool_call.get("args", {})
+                    if "final_answer" in args:
+                        content_to_show = args["final_answer"]
+                        break
+            if not content_to_show:
+                continue
+        else:
+            continue
+
+        history.append({
+            "id": msg.id or str(i),
+            "role": role,
+            "content": content_to_show,
+        })
+    return history
+
+
+def paginate(turns: list, limit: int = None, before: str = None) -> dict:
+    """
+    Returns the `limit` most recent turns (all of them if limit is None) older
+    than the turn with id `before` (the newest turns if before is None), oldest first. next_before is the
+    cursor for the previous page, or None when there is nothing older.
+    Message ids are used as cursors so pages stay stable when turns are appended.
+    """
+    end = len(turns)
+    if before is not None:
+        end = next((i for i, turn in enumerate(turns) if turn["id"] == before), 0)
+    start = 0 if limit is None else max(0, end - limit)
+    page = turns[start:end]
+    return {
+        "history": page,
+        "next_before": page[0]["id"] if page and start > 0 else None,
+    }
+
+
+def history_etag(checkpoint_id: str, limit: int = None, before: str = None) -> str:
+    """
+    The page is fully determined by the checkpoint it was read from and the query.
+    """
+    digest = hashlib.sha1(f"{checkpoint_id}|{limit or ''}|{before or ''}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
@@ -0,0 +1,81 @@
+import json
+
+# Name of the custom event search_documents dispatches with the snippets it retrieved
+SNIPPETS_EVENT = "retrieved_snippets"
+
+
+def sse_event(event: str, data) -> str:
+    """
+    Formats one server-sent event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class FinalAnswerStream:
+    """
+    Turns the streamed tool-call chunks of the structured-response tool into
+    final_answer text deltas. The model streams the tool arguments as partial
+    JSON, so we re-parse the accumulated arguments and emit whatever part of
+    final_answer is new.
+    """
+
+    def __init__(self, answer_tool_name: str):
+        self.answer_tool_name = answer_tool_name
+        self.calls = {}  # (model run id, tool call index) -> {"name", "args", "emitted"}
+
+    def feed(self, run_id: str, chunk) -> str:
+        from langchain_core.utils.json import parse_partial_json
+        delta = ""
+        for tool_chunk in getattr(chunk, "tool_call_chunks", None) or []:
+            key = (run_id, tool_chunk.get("index"))
+            call = self.calls.setdefault(key, {"name": None, "args": "", "emitted": 0})
+            if tool_chunk.get("name"):
+                call["name"] = tool_chunk["name"]
+            call["args"] += tool_chunk.get("args") or ""
+            if call["name"] != self.answer_tool_name:
+                continue
+
+            parsed = parse_partial_json(call["args"]) if call["args"] else None
+            answer = parsed.get("final_answer") if isinstance(parsed, dict) else None
+            if isinstance(answer, str) and len(answer) > call["emitted"]:
+                delta += answer[call["emitted"]:]
+                call["emitted"] = len(answer)
+        return delta
+
+
+async def agent_event_stream(agent, inputs: dict, config: dict, context, answer_tool_name: str, build_final):
+    """
+    Runs the agent with astream_events and yields SSE strings:
+    tool_start / tool_end around every tool call, snippets for retrieved
+    document chunks, token for final-answer text as it is generated, and one
+    final event built by build_final(state values) once the run (and its
+    checkpoint) is complete. Errors are reported as an error event.
+    """
+    answers = FinalAnswerStream(answer_tool_name)
+    try:
+        async for event in agent.astream_events(inputs, config=config, context=context, version="v2"):
+            kind = event["event"]
+            if kind == "on_chat_model_stream":
+                delta = answers.feed(event["run_id"], event["data"]["chunk"])
+                if delta:
+                    yield sse_event("token", {"text": delta})
+            elif kind == "on_tool_start":
+                yield sse_event("tool_start", {"tool": event["name"], "input": event["data"].get("input")})
+            elif kind == "on_tool_end":
+                yield sse_event("tool_end", {"tool": event["name"]})
+            elif kind == "on_custom_event" and event["name"] == SNIPPETS_EVENT:
+                yield sse_event("snippets", event["data"])
+
+        state = await agent.aget_state(config)
+        yield sse_event("final", build_final(state.values))
+    except Exception as e:
+        print(f"Error in chat stream: {e}")
+        yield sse_event("error", {"detail": str(e)})
+
+
+async def cached_answer_stream(answer: dict):
+    """
+    Events of a turn answered by the answer cache: the whole answer as one token event, then final.
+    """
+    yield sse_event("token", {"text": answer["answer"]})
+    yield sse_event("final", answer)
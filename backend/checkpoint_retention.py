@@ -0,0 +1,286 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+from db import get_db
+
+load_dotenv()
+
+CHECKPOINT_RETENTION_ENABLED = os.getenv("CHECKPOINT_RETENTION_ENABLED", "true").lower() == "true"
+# Checkpoints kept per thread (and namespace). The newest one is all a chat needs;
+# the others are only used for time travel / debugging.
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", "20"))
+# Seconds between two background passes
+CHECKPOINT_RETENTION_INTERVAL = float(os.getenv("CHECKPOINT_RETENTION_INTERVAL", "3600"))
+# Threads pruned per transaction
+CHECKPOINT_RETENTION_BATCH = int(os.getenv("CHECKPOINT_RETENTION_BATCH", "50"))
+# Report what a pass would reclaim without deleting anything
+CHECKPOINT_RETENTION_DRY_RUN = os.getenv("CHECKPOINT_RETENTION_DRY_RUN", "false").lower() == "true"
+
+# Optional: replace old turns (and their tool outputs) with a summary
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "false").lower() == "true"
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "openai:gpt-4o-mini")
+# Most recent user turns kept verbatim
+COMPACTION_KEEP_TURNS = int(os.getenv("COMPACTION_KEEP_TURNS", "10"))
+# Threads are only compacted when nobody has written to them for this long
+COMPACTION_IDLE_SECONDS = float(os.getenv("COMPACTION_IDLE_SECONDS", "600"))
+
+SUMMARY_MESSAGE_ID = "conversation-summary"
+
+# Only one instance runs a pass at a time
+RETENTION_LOCK_ID = 72_014_001
+
+CANDIDATE_THREADS_SQL = """
+    SELECT thread_id FROM checkpoints
+    WHERE thread_id > %(after)s
+    GROUP BY thread_id HAVING count(*) > %(keep)s
+    ORDER BY thread_id LIMIT %(limit)s
+"""
+
+# Every checkpoint but the newest `keep` of each thread/namespace
+PRUNE_CHECKPOINTS_SQL = """
+    WITH deleted AS (
+        DELETE FROM checkpoints c USING (
+            SELECT thread_id, checkpoint_ns, checkpoint_id,
+                   row_number() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS rn
+            FROM checkpoints WHERE thread_id = ANY(%(threads)s)
+        ) ranked
+        WHERE c.thread_id = ranked.thread_id AND c.checkpoint_ns = ranked.checkpoint_ns
+          AND c.checkpoint_id = ranked.checkpoint_id AND ranked.rn > %(keep)s
+        RETURNING octet_length(c.checkpoint::text) + octet_length(c.metadata::text) AS size
+    )
+    SELECT count(*), coalesce(sum(size), 0) FROM deleted
+"""
+
+# Writes of checkpoints older than the oldest one kept. Checkpoint ids are
+# time-ordered, so writes of checkpoints being saved right now are never touched.
+PRUNE_WRITES_SQL = """
+    WITH deleted AS (
+        DELETE FROM checkpoint_writes w USING (
+            SELECT thread_id, checkpoint_ns, min(checkpoint_id) AS oldest
+            FROM checkpoints WHERE thread_id = ANY(%(threads)s)
+            GROUP BY thread_id, checkpoint_ns
+        ) kept
+        WHERE w.thread_id = kept.thread_id AND w.checkpoint_ns = kept.checkpoint_ns
+          AND w.checkpoint_id < kept.oldest
+        RETURNING octet_length(w.blob) AS size
+    )
+    SELECT count(*), coalesce(sum(size), 0) FROM deleted
+"""
+
+# Channel values superseded by the oldest version any kept checkpoint references.
+# Versions only grow, so a blob written for a checkpoint in flight is never older.
+PRUNE_BLOBS_SQL = """
+    WITH deleted AS (
+        DELETE FROM checkpoint_blobs b USING (
+            SELECT c.thread_id, c.checkpoint_ns, v.key AS channel, min(v.value) AS oldest
+            FROM checkpoints c, jsonb_each_text(c.checkpoint -> 'channel_versions') v
+            WHERE c.thread_id = ANY(%(threads)s)
+            GROUP BY c.thread_id, c.checkpoint_ns, v.key
+        ) kept
+        WHERE b.thread_id = kept.thread_id AND b.checkpoint_ns = kept.checkpoint_ns
+          AND b.channel = kept.channel AND b.version < kept.oldest
+        RETURNING coalesce(octet_length(b.blob), 0) AS size
+    )
+    SELECT count(*), coalesce(sum(size), 0) FROM deleted
+"""
+
+SUMMARY_PROMPT = """Summarize the earlier part of this conversation between a user and a document assistant.
+Keep every question the user asked, the facts and answers given (including which came from the documents
+and which from the internet) and anything the user said they care about. Be concise. Output only the summary."""
+
+
+def empty_report(dry_run: bool) -> dict:
+    return {
+        "dry_run": dry_run,
+        "threads": 0,
+        "checkpoints": 0,
+        "writes": 0,
+        "blobs": 0,
+        "bytes": 0,
+        "compacted_threads": 0,
+        "seconds": 0.0,
+    }
+
+
+def render_for_summary(messages: list) -> str:
+    lines = []
+    for msg in messages:
+        if msg.type == "system" and msg.id == SUMMARY_MESSAGE_ID:
+            lines.append(f"Earlier summary: {msg.content}")
+        elif msg.type == "human":
+            lines.append(f"User: {msg.content}")
+        elif msg.type == "ai":
+            for tool_call in getattr(msg, "tool_calls", None) or []:
+                answer = tool_call.get("args", {}).get("final_answer")
+                if answer:
+                    lines.append(f"Assistant: {answer}")
+                else:
+                    lines.append(f"Assistant called {tool_call['name']}({tool_call.get('args')})")
+            if msg.content:
+                lines.append(f"Assistant: {msg.content}")
+        elif msg.type == "tool":
+            # Tool outputs (retrieved snippets, search results) are the bulk of a thread
+            lines.append(f"Tool result: {str(msg.content)[:500]}")
+    return "\n".join(lines)
+
+
+async def compact_thread(agent, model, thread_id: str, keep_turns: int = COMPACTION_KEEP_TURNS,
+                         idle_seconds: float = COMPACTION_IDLE_SECONDS, dry_run: bool = False) -> bool:
+    """
+    Replaces everything before the last keep_turns user turns with one summary
+    message (a previous summary is folded into the new one). Cuts at a user
+    message so a tool call is never separated from its result. Returns True
+    if the thread was (or in dry-run mode would have been) compacted.
+    """
+    config = {"configurable": {"thread_id": thread_id}}
+    state = await agent.aget_state(config)
+    if state.created_at:
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(state.created_at)
+        if age.total_seconds() < idle_seconds:
+            return False
+
+    messages = state.values.get("messages", [])
+    user_turns = [i for i, msg in enumerate(messages) if msg.type == "human"]
+    if len(user_turns) <= keep_turns:
+        return False
+    cut = user_turns[-keep_turns] if keep_turns else len(messages)
+    old, kept = messages[:cut], messages[cut:]
+    if dry_run:
+        return True
+
+    from langchain_core.messages import SystemMessage, RemoveMessage
+    from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+    summary = await model.ainvoke([
+        SystemMessage(content=SUMMARY_PROMPT),
+        ("user", render_for_summary(old)),
+    ])
+    await agent.aupdate_state(config, {"messages": [
+        RemoveMessage(id=REMOVE_ALL_MESSAGES),
+        SystemMessage(content=summary.content, id=SUMMARY_MESSAGE_ID),
+        *kept,
+    ]})
+    return True
+
+
+class CheckpointRetention:
+    """
+    Background task that prunes LangGraph checkpoints (and optionally compacts
+    long threads first) in batches of threads. Started and stopped by main.lifespan.
+    """
+
+    def __init__(self, keep_last: int = CHECKPOINT_KEEP_LAST, batch_size: int = CHECKPOINT_RETENTION_BATCH,
+                 interval: float = CHECKPOINT_RETENTION_INTERVAL):
+        self.keep_last = keep_last
+        self.batch_size = batch_size
+        self.interval = interval
+        self.agent = None
+        self.agent_factory = None
+        self.runs = 0
+        self.last_run_at = None
+        self.last_report = None
+        self.totals = empty_report(False)
+        del self.totals["dry_run"]
+        self._task = None
+        self._model = None
+
+    async def start(self, agent=None, agent_factory=None):
+        # Without an agent, agent_factory() builds it for the first compaction
+        self.agent = agent
+        self.agent_factory = agent_factory
+        if CHECKPOINT_RETENTION_ENABLED:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once(dry_run=CHECKPOINT_RETENTION_DRY_RUN, compact=COMPACTION_ENABLED)
+            except Exception as e:
+                print(f"Error pruning checkpoints: {e}")
+
+    def _summary_model(self):
+        if self._model is None:
+            from langchain.chat_models import init_chat_model
+            self._model = init_chat_model(COMPACTION_MODEL, temperature=0)
+        return self._model
+
+    async def run_once(self, dry_run: bool = False, compact: bool = False) -> dict:
+        """
+        One pass over every thread with more than keep_last checkpoints.
+        Dry runs execute the same deletes and roll them back, so the report
+        shows exactly what a real pass would reclaim.
+        """
+        report = empty_report(dry_run)
+        started = time.perf_counter()
+        if compact and self.agent is None and self.agent_factory is not None:
+            self.agent = self.agent_factory()
+        async with get_db().pool.connection() as conn:
+            cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_ID,))
+            if not (await cur.fetchone())[0]:
+                report["skipped"] = "another instance is running a pass"
+                return report
+            try:
+                after = ""
+                while True:
+                    cur = await conn.execute(CANDIDATE_THREADS_SQL, {
+                        "after": after, "keep": self.keep_last, "limit": self.batch_size,
+                    })
+                    threads = [row[0] for row in await cur.fetchall()]
+                    if not threads:
+                        break
+                    after = threads[-1]
+
+                    if compact and self.agent is not None:
+                        for thread_id in threads:
+                            try:
+                                if await compact_thread(self.agent, self._summary_model(), thread_id, dry_run=dry_run):
+                                    report["compacted_threads"] += 1
+                            except Exception as e:
+                                print(f"Error compacting thread {thread_id}: {e}")
+
+                    await self._prune(conn, threads, report, dry_run)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_ID,))
+
+        report["seconds"] = time.perf_counter() - started
+        self.runs += 1
+        self.last_run_at = datetime.now(timezone.utc).isoformat()
+        self.last_report = report
+        if not dry_run:
+            for key in self.totals:
+                self.totals[key] += report[key]
+        print(f"Checkpoint retention pass: {report}")
+        return report
+
+    async def _prune(self, conn, threads: list, report: dict, dry_run: bool):
+        params = {"threads": threads, "keep": self.keep_last}
+        async with conn.transaction(force_rollback=dry_run):
+            for key, sql in (("checkpoints", PRUNE_CHECKPOINTS_SQL), ("writes", PRUNE_WRITES_SQL),
+                             ("blobs", PRUNE_BLOBS_SQL)):
+                cur = await conn.execute(sql, params)
+                rows, size = await cur.fetchone()
+                report[key] += rows
+                report["bytes"] += size
+        report["threads"] += len(threads)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CHECKPOINT_RETENTION_ENABLED,
+            "keep_last": self.keep_last,
+            "interval": self.interval,
+            "compaction": COMPACTION_ENABLED,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_report": self.last_report,
+            "reclaimed": self.totals,
+        }
@@ -0,0 +1,205 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+from metrics import context_tokens
+
+load_dotenv()
+
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+# Tokens search_documents may hand the model per call (snippet text plus headers)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Results scoring below this fraction of the best result are dropped (vector similarity
+# scores only: fused rank scores don't measure relevance)
+CONTEXT_MIN_SCORE_RATIO = float(os.getenv("CONTEXT_MIN_SCORE_RATIO", "0.5"))
+# A snippet is only cut to fit the budget if at least this many tokens of it would be left
+CONTEXT_MIN_SNIPPET_TOKENS = int(os.getenv("CONTEXT_MIN_SNIPPET_TOKENS", "64"))
+
+# Tokens of the "--- Document Snippet n (page p) ---" and "=== File: ... ===" lines
+SNIPPET_HEADER_TOKENS = 12
+FILE_HEADER_TOKENS = 12
+# Chunks of the same page at most this many characters apart are merged into one snippet
+MERGE_GAP_CHARS = 2
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """
+    Token count with LlamaIndex's default tokenizer (tiktoken, built once).
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from llama_index.core.utils import get_tokenizer
+                _tokenizer = get_tokenizer()
+    return len(_tokenizer(text))
+
+
+class _Snippet:
+    """
+    One packed snippet: a retrieved chunk, or several overlapping/adjacent
+    chunks of the same page merged, with the best score among them.
+    """
+
+    def __init__(self, result):
+        node = result.node
+        self.node = node
+        self.score = result.score
+        self.text = node.get_content()
+        self.start = node.start_char_idx
+        self.end = node.end_char_idx
+        # Offsets are only usable if they describe the text (same page, unchanged text)
+        if self.start is None or self.end is None or self.end - self.start != len(self.text):
+            self.start = self.end = None
+        metadata = node.metadata
+        self.file = metadata.get("file_id") or metadata.get("file_name")
+        self.page = metadata.get("page_number")
+
+    def absorb(self, other: "_Snippet") -> bool:
+        """
+        Takes in `other` if it duplicates, overlaps or directly follows/precedes this snippet.
+        """
+        if (other.file, other.page) != (self.file, self.page):
+            return False
+        if self.start is None or other.start is None:
+            # No usable offsets: only exact duplicates and contained chunks can go
+            if other.text in self.text:
+                self._keep_best(other)
+                return True
+            if self.text in other.text:
+                self.text, self.start, self.end = other.text, other.start, other.end
+                self._keep_best(other)
+                return True
+            return False
+
+        first, second = (self, other) if self.start <= other.start else (other, self)
+        gap = second.start - first.end
+        if gap > MERGE_GAP_CHARS:
+            return False
+        if second.end > first.end:
+            # Overlapping chunks share text; the whitespace between adjacent ones isn't in either
+            self.text = first.text + " " * gap + second.text[max(-gap, 0):]
+        else:
+            self.text = first.text
+        self.start, self.end = first.start, max(first.end, second.end)
+        self._keep_best(other)
+        return True
+
+    def token_count(self, counts: dict) -> int:
+        """
+        Tokens of the text, memoized in counts (text -> tokens).
+        """
+        if self.text not in counts:
+            counts[self.text] = count_tokens(self.text)
+        return counts[self.text]
+
+    def _keep_best(self, other: "_Snippet"):
+        # The merged snippet is named (id, metadata) after its best-scoring chunk
+        if (other.score or 0.0) > (self.score or 0.0):
+            self.node, self.score = other.node, other.score
+
+    def to_result(self):
+        from llama_index.core.schema import NodeWithScore, TextNode
+
+        if self.text == self.node.get_content():
+            return NodeWithScore(node=self.node, score=self.score)
+        node = TextNode(id_=self.node.node_id, text=self.text, metadata=dict(self.node.metadata),
+                        start_char_idx=self.start, end_char_idx=self.end)
+        return NodeWithScore(node=node, score=self.score)
+
+
+def _trim(text: str, max_tokens: int) -> tuple:
+    """
+    Cuts text at a word boundary so it fits in max_tokens (marked with an ellipsis).
+    Returns (text, tokens).
+    """
+    tokens = count_tokens(text)
+    while tokens > max_tokens and text:
+        # Shrink proportionally, a little more than needed so this rarely loops
+        keep = int(len(text) * max_tokens / tokens * 0.95)
+        cut = text.rfind(" ", 0, keep)
+        text = text[:cut if cut > 0 else keep].rstrip()
+        tokens = count_tokens(text + " …")
+    return text + " …", tokens
+
+
+def _pack(results: list, budget: int, min_score_ratio: float) -> tuple:
+    """
+    Does the packing for pack_nodes. Returns (packed snippets, tokens retrieved,
+    tokens packed), both counts including headers. Every distinct chunk is
+    tokenized once; the cost of the packed snippets comes from the budget loop.
+    """
+    counts = {}
+    snippets = [_Snippet(r) for r in sorted(results, key=lambda r: r.score or 0.0, reverse=True)]
+    retrieved = FILE_HEADER_TOKENS * len({s.file for s in snippets})
+    retrieved += sum(SNIPPET_HEADER_TOKENS + s.token_count(counts) for s in snippets)
+
+    best = snippets[0].score
+    if min_score_ratio and best and best > 0:
+        snippets = [s for s in snippets if (s.score or 0.0) >= best * min_score_ratio]
+
+    merged = []
+    for snippet in snippets:
+        # A merged snippet can now reach one that was kept separately before
+        while True:
+            host = next((s for s in merged if s.absorb(snippet)), None)
+            if host is None:
+                break
+            merged.remove(host)
+            snippet = host
+        merged.append(snippet)
+    merged.sort(key=lambda s: s.score or 0.0, reverse=True)
+
+    packed = []
+    files = set()
+    remaining = budget
+    for snippet in merged:
+        cost = SNIPPET_HEADER_TOKENS + (0 if snippet.file in files else FILE_HEADER_TOKENS)
+        tokens = snippet.token_count(counts)
+        if cost + tokens > remaining:
+            room = remaining - cost
+            if room >= CONTEXT_MIN_SNIPPET_TOKENS or not packed:
+                snippet.text, tokens = _trim(snippet.text, max(room, 1))
+                remaining -= cost + tokens
+                packed.append(snippet)
+            break
+        remaining -= cost + tokens
+        files.add(snippet.file)
+        packed.append(snippet)
+    return packed, retrieved, budget - remaining
+
+
+def pack_nodes(results: list, budget: int = CONTEXT_TOKEN_BUDGET,
+               min_score_ratio: float = CONTEXT_MIN_SCORE_RATIO) -> list:
+    """
+    Fits retrieved nodes into `budget` tokens, best first:
+    1. drops results scoring below min_score_ratio x the best score (None skips
+       this, for scores that aren't similarities, e.g. RRF)
+    2. merges duplicate, overlapping and adjacent chunks of the same page
+    3. keeps snippets while they fit, cutting the first one that doesn't
+    Returns NodeWithScore items, best first.
+    """
+    if not results:
+        return []
+    packed, _, _ = _pack(results, budget, min_score_ratio)
+    return [snippet.to_result() for snippet in packed]
+
+
+def pack_context(results: list, render, budget: int = CONTEXT_TOKEN_BUDGET,
+                 min_score_ratio: float = CONTEXT_MIN_SCORE_RATIO) -> tuple:
+    """
+    Packs results and renders them with render(results). Returns (packed results,
+    rendered text) and records the tokens retrieved, sent and saved (as counted
+    while packing, so the unpacked results are never rendered).
+    """
+    if not CONTEXT_PACKING_ENABLED or not results:
+        return results, render(results)
+    snippets, retrieved, sent = _pack(results, budget, min_score_ratio)
+    packed = [snippet.to_result() for snippet in snippets]
+    context_tokens.observe("retrieved", retrieved)
+    context_tokens.observe("packed", sent)
+    context_tokens.observe("saved", max(retrieved - sent, 0))
+    return packed, render(packed)
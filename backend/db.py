@@ -0,0 +1,199 @@
+import os
+import threading
+from psycopg_pool import AsyncConnectionPool
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from dotenv import load_dotenv
+
+from migrations import hnsw_kwargs, filter_by_columns
+
+load_dotenv()
+
+# Total number of Postgres connections this process is allowed to hold.
+# Neon (and most hosted Postgres) cap connections per role, so every pool
+# below gets a slice of this one budget instead of picking its own size.
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "12"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_MAX_LIFETIME = int(os.getenv("DB_MAX_LIFETIME", "300"))
+
+VECTOR_TABLE_NAME = "paperparrot_embeddings"
+EMBED_DIM = 1536
+
+
+def split_budget(budget: int) -> dict:
+    """
+    Splits the connection budget between the three pools.
+    The checkpointer gets half (every chat step writes a checkpoint),
+    the async vector engine (retrieval) and the sync engine (inserts/deletes)
+    share the rest. Every pool gets at least one connection.
+    """
+    if budget < 3:
+        raise ValueError("DB_CONNECTION_BUDGET must be at least 3")
+    checkpointer = budget // 2
+    sync_engine = (budget - checkpointer) // 2
+    async_engine = budget - checkpointer - sync_engine
+    return {
+        "checkpointer": checkpointer,
+        "sync_engine": sync_engine,
+        "async_engine": async_engine,
+    }
+
+
+class DatabaseManager:
+    """
+    Owns every Postgres connection the backend uses:
+    - a psycopg pool for the LangGraph checkpointer
+    - one sync + one asyncpg SQLAlchemy engine shared by PGVectorStore and the delete helpers
+    - a long-lived PGVectorStore / VectorStoreIndex handed to every endpoint,
+      built on first use (or by the startup warm-up): importing LlamaIndex is slow
+    It is opened once in the FastAPI lifespan and closed on shutdown.
+    """
+
+    def __init__(self, db_url: str = None, budget: int = DB_CONNECTION_BUDGET):
+        self.db_url = db_url
+        self.budget = budget
+        self.pool = None
+        self.engine = None
+        self.async_engine = None
+        self._vector_store = None
+        self._index = None
+        self._build_lock = threading.Lock()
+        # Set by migrations.check_schema once conversation_id/file_id columns are usable
+        self.filter_columns = False
+        # Set by migrations.check_schema when the table is partitioned by conversation
+        self.partitioned = False
+        # Set by migrations.check_schema once the text_search_tsv column is usable
+        self.text_search = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.pool is not None
+
+    async def open(self):
+        db_url = self.db_url or os.getenv("DATABASE_URL")
+        if not db_url:
+            raise ValueError("DATABASE_URL not set")
+        self.db_url = db_url
+
+        sizes = split_budget(self.budget)
+
+        # 1. psycopg pool for the checkpointer
+        self.pool = AsyncConnectionPool(
+            conninfo=db_url,
+            min_size=1,
+            max_size=sizes["checkpointer"],
+            timeout=DB_POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            max_lifetime=DB_MAX_LIFETIME,
+            kwargs={
+                "autocommit": True,
+                "prepare_threshold": None,
+            },
+            open=False,
+        )
+        await self.pool.open()
+
+        # 2. SQLAlchemy engines (max_overflow=0 so the budget is a hard cap)
+        self.engine = create_engine(
+            db_url,
+            pool_size=sizes["sync_engine"],
+            max_overflow=0,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_MAX_LIFETIME,
+            pool_pre_ping=True,
+        )
+        self.async_engine = create_async_engine(
+            db_url.replace("postgresql://", "postgresql+asyncpg://"),
+            pool_size=sizes["async_engine"],
+            max_overflow=0,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_MAX_LIFETIME,
+            pool_pre_ping=True,
+        )
+
+    @property
+    def vector_store(self):
+        """
+        The PGVectorStore, built once on the engines above.
+        """
+        if self._vector_store is None and self.is_open:
+            with self._build_lock:
+                if self._vector_store is None:
+                    from llama_index.vector_stores.postgres import PGVectorStore
+                    self._vector_store = PGVectorStore(
+                        table_name=VECTOR_TABLE_NAME,
+                        embed_dim=EMBED_DIM,
+                        cache_ok=True,  # Optimization for frequent queries
+                        engine=self.engine,
+                        async_engine=self.async_engine,
+                        hnsw_kwargs=hnsw_kwargs(),
+                        customize_query_fn=filter_by_columns,
+                    )
+        return self._vector_store
+
+    @property
+    def index(self):
+        """
+        The VectorStoreIndex on top of vector_store, built once.
+        """
+        if self._index is None and self.is_open:
+            vector_store = self.vector_store
+            with self._build_lock:
+                if self._index is None:
+                    from llama_index.core import VectorStoreIndex
+                    self._index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+        return self._index
+
+    async def close(self):
+        # PGVectorStore.close() only disposes the engines it was given,
+        # so dispose them here directly (works even if the store was never used).
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        if self.engine is not None:
+            self.engine.dispose()
+        if self.pool is not None:
+            await self.pool.close()
+        self.pool = None
+        self.engine = None
+        self.async_engine = None
+        self._vector_store = None
+        self._index = None
+        self.filter_columns = False
+        self.partitioned = False
+        self.text_search = False
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of every pool's utilization.
+        """
+        if not self.is_open:
+            return {"open": False, "budget": self.budget}
+
+        def engine_stats(engine):
+            pool = engine.pool
+            return {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            }
+
+        sizes = split_budget(self.budget)
+        return {
+            "open": True,
+            "budget": self.budget,
+            "limits": sizes,
+            "checkpointer": self.pool.get_stats(),
+            "sync_engine": engine_stats(self.engine),
+            "async_engine": engine_stats(self.async_engine.sync_engine),
+        }
+
+
+# Process-wide instance, opened in main.lifespan
+db = DatabaseManager()
+
+
+def get_db() -> DatabaseManager:
+    if not db.is_open:
+        raise RuntimeError("Database manager is not open (is the app lifespan running?)")
+    return db
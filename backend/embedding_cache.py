@@ -0,0 +1,199 @@
+import os
+import time
+import hashlib
+from dotenv import load_dotenv
+from sqlalchemy import text as sql_text
+
+from embedding_scheduler import embedding_scheduler
+from db import get_db
+
+load_dotenv()
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+# Total size of cached vectors kept in Postgres before least recently used entries are evicted (default 1 GB)
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Minimum seconds between two eviction passes
+EMBEDDING_CACHE_EVICT_INTERVAL = float(os.getenv("EMBEDDING_CACHE_EVICT_INTERVAL", "60"))
+
+CACHE_TABLE = "paperparrot_embedding_cache"
+# Rough per-row overhead (key, model, timestamps, tuple header) added to the vector size
+ROW_OVERHEAD_BYTES = 128
+
+
+GET_SQL = f"UPDATE {CACHE_TABLE} SET last_used_at = now() WHERE key = ANY(%(keys)s) RETURNING key, embedding"
+PUT_SQL = (
+    f"INSERT INTO {CACHE_TABLE} (key, model, embedding, size_bytes) "
+    f"VALUES (%(key)s, %(model)s, %(embedding)s, %(size_bytes)s) "
+    f"ON CONFLICT (key) DO UPDATE SET last_used_at = now()"
+)
+EVICT_SQL = f"""DELETE FROM {CACHE_TABLE} WHERE key IN (
+    SELECT key FROM (
+        SELECT key, sum(size_bytes) OVER (ORDER BY last_used_at DESC, key) AS running_bytes
+        FROM {CACHE_TABLE}
+    ) ranked WHERE running_bytes > %(max_bytes)s
+)"""
+
+
+def _to_sqlalchemy(sql: str) -> str:
+    """
+    The same statements run through psycopg (async pool) and SQLAlchemy (sync engine).
+    """
+    return sql.replace("%(", ":").replace(")s", "")
+
+
+def _rows(model_name: str, entries: dict) -> list:
+    return [
+        {"key": key, "model": model_name, "embedding": list(embedding),
+         "size_bytes": 4 * len(embedding) + ROW_OVERHEAD_BYTES}
+        for key, embedding in entries.items()
+    ]
+
+
+def cache_key(model_name: str, text: str) -> str:
+    """
+    Content address of one embedding: the same text embedded by the same model
+    always maps to the same key, whichever file or conversation it came from.
+    """
+    return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache in Postgres, keyed by cache_key(model, text).
+    Lookups are done in bulk and refresh last_used_at, which drives the size-based LRU eviction.
+    """
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES, enabled: bool = EMBEDDING_CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._last_eviction = 0.0
+
+    async def setup(self):
+        if not self.enabled:
+            return
+        async with get_db().pool.connection() as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    embedding REAL[] NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    last_used_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            await conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {CACHE_TABLE}_last_used_idx
+                ON {CACHE_TABLE} (last_used_at)
+            """)
+
+    async def get_many(self, keys: list) -> dict:
+        """
+        Returns {key: embedding} for every key found, marking them as recently used.
+        """
+        if not keys:
+            return {}
+        async with get_db().pool.connection() as conn:
+            cur = await conn.execute(GET_SQL, {"keys": list(set(keys))})
+            return {key: list(embedding) for key, embedding in await cur.fetchall()}
+
+    async def put_many(self, model_name: str, entries: dict):
+        """
+        Stores {key: embedding} entries, then evicts if an eviction pass is due.
+        """
+        if not entries:
+            return
+        async with get_db().pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(PUT_SQL, _rows(model_name, entries))
+        if self._eviction_due():
+            await self.evict()
+
+    async def evict(self) -> int:
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes.
+        """
+        self._last_eviction = time.monotonic()
+        async with get_db().pool.connection() as conn:
+            cur = await conn.execute(EVICT_SQL, {"max_bytes": self.max_bytes})
+            deleted = cur.rowcount
+        self.evicted += deleted
+        return deleted
+
+    # Sync variants for callers running in worker threads (the retriever's query embedding)
+
+    def get_many_sync(self, keys: list) -> dict:
+        if not keys:
+            return {}
+        with get_db().engine.begin() as conn:
+            rows = conn.execute(sql_text(_to_sqlalchemy(GET_SQL)), {"keys": list(set(keys))})
+            return {key: list(embedding) for key, embedding in rows}
+
+    def put_many_sync(self, model_name: str, entries: dict):
+        if not entries:
+            return
+        with get_db().engine.begin() as conn:
+            conn.execute(sql_text(_to_sqlalchemy(PUT_SQL)), _rows(model_name, entries))
+            if self._eviction_due():
+                self._last_eviction = time.monotonic()
+                deleted = conn.execute(sql_text(_to_sqlalchemy(EVICT_SQL)), {"max_bytes": self.max_bytes}).rowcount
+                self.evicted += deleted
+
+    def _eviction_due(self) -> bool:
+        return time.monotonic() - self._last_eviction >= EMBEDDING_CACHE_EVICT_INTERVAL
+
+    async def embed_texts(self, texts: list, embed_model) -> tuple:
+        """
+        Embeds texts, only sending cache misses to embed_model (through the
+        process-wide scheduler, which batches and paces them with other requests' texts).
+        Returns (embeddings in input order, hits, misses).
+        If the cache table can't be reached we fall back to embedding everything.
+        """
+        model_name = getattr(embed_model, "model_name", type(embed_model).__name__)
+        keys = [cache_key(model_name, text) for text in texts]
+
+        found = {}
+        if self.enabled and texts:
+            try:
+                found = await self.get_many(keys)
+            except Exception as e:
+                print(f"Embedding cache lookup failed: {e}")
+
+        # Deduplicate misses so repeated chunks inside one batch are embedded once
+        miss_texts = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in miss_texts:
+                miss_texts[key] = text
+
+        if miss_texts:
+            new_embeddings = await embedding_scheduler.embed(list(miss_texts.values()), embed_model)
+            computed = dict(zip(miss_texts.keys(), new_embeddings))
+            if self.enabled:
+                try:
+                    await self.put_many(model_name, computed)
+                except Exception as e:
+                    print(f"Embedding cache store failed: {e}")
+            found.update(computed)
+
+        hits = len(texts) - len(miss_texts)
+        self.hits += hits
+        self.misses += len(miss_texts)
+        return [found[key] for key in keys], hits, len(miss_texts)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# Process-wide instance, set up in main.lifespan
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,351 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+from metrics import stage_seconds
+
+load_dotenv()
+
+EMBED_SCHEDULER_ENABLED = os.getenv("EMBED_SCHEDULER_ENABLED", "true").lower() == "true"
+# Tokens / texts packed into one embedding request (OpenAI allows 300k tokens and 2048 inputs)
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "20000"))
+EMBED_BATCH_MAX_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", "512"))
+# Seconds a small batch waits for chunks of other files before it is sent
+EMBED_BATCH_WAIT = float(os.getenv("EMBED_BATCH_WAIT", "0.02"))
+# Concurrent embedding requests: starts at EMBED_CONCURRENCY, halves on a 429,
+# grows back by about one per round of successful batches, within these bounds
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MIN_CONCURRENCY = int(os.getenv("EMBED_MIN_CONCURRENCY", "1"))
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "16"))
+# A batch slower than this (seconds) also lowers the concurrency by one (0 disables)
+EMBED_LATENCY_TARGET = float(os.getenv("EMBED_LATENCY_TARGET", "10"))
+# The provider's tokens-per-minute limit, if known: batches are paced to stay under it (0 = rely on 429s)
+EMBED_TOKENS_PER_MINUTE = int(os.getenv("EMBED_TOKENS_PER_MINUTE", "0"))
+# Attempts per batch (rate limits, timeouts, 5xx) before its texts fail, and the backoff between them
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", "8"))
+EMBED_RETRY_BASE_DELAY = float(os.getenv("EMBED_RETRY_BASE_DELAY", "1"))
+EMBED_RETRY_MAX_DELAY = float(os.getenv("EMBED_RETRY_MAX_DELAY", "60"))
+# Retries the OpenAI client makes on its own inside one scheduled batch request. The scheduler
+# retries failed batches itself, and needs to see the 429s to adapt (query embeddings keep
+# the embed model's own retries).
+EMBED_CLIENT_MAX_RETRIES = int(os.getenv("EMBED_CLIENT_MAX_RETRIES", "0"))
+
+
+_batch_models = {}  # id(embed model) -> (embed model, its copy for scheduled batches)
+_batch_models_lock = threading.Lock()
+
+
+def batch_embed_model(embed_model):
+    """
+    The model the scheduler's batches are sent with. For an OpenAI embed model
+    that is a copy with EMBED_CLIENT_MAX_RETRIES client retries and the
+    scheduler's batch size; embed_model itself (shared with the query path)
+    keeps its own retries. Other models are used as they are.
+    """
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    if not isinstance(embed_model, OpenAIEmbedding):
+        return embed_model
+    with _batch_models_lock:
+        entry = _batch_models.get(id(embed_model))
+        if entry is None or entry[0] is not embed_model:
+            batch_model = OpenAIEmbedding(
+                model_name=embed_model.model_name,
+                embed_batch_size=min(EMBED_BATCH_MAX_INPUTS, 2048),
+                dimensions=embed_model.dimensions,
+                additional_kwargs=dict(embed_model.additional_kwargs),
+                api_key=embed_model.api_key,
+                api_base=embed_model.api_base,
+                api_version=embed_model.api_version,
+                max_retries=EMBED_CLIENT_MAX_RETRIES,
+                timeout=embed_model.timeout,
+                default_headers=embed_model.default_headers,
+            )
+            entry = _batch_models[id(embed_model)] = (embed_model, batch_model)
+        return entry[1]
+
+
+def status_code(error: Exception):
+    """
+    HTTP status of a failed embedding call (openai or httpx errors), if any.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after(error: Exception):
+    """
+    Seconds the provider asked us to wait (Retry-After / retry-after-ms), if it said.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    status = status_code(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    import httpx
+    import openai
+    return isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError, openai.APIConnectionError))
+
+
+class _Pending:
+    """
+    One text waiting to be embedded, and the future its caller awaits.
+    """
+    __slots__ = ("model", "text", "tokens", "future", "queued_at", "attempts")
+
+    def __init__(self, model, text: str, tokens: int, future):
+        self.model = model
+        self.text = text
+        self.tokens = tokens
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class EmbeddingScheduler:
+    """
+    Process-wide queue in front of the embedding API.
+    Texts from every concurrent caller are packed into token-sized batches and
+    sent with a bounded, adaptive number of concurrent requests: a 429 halves
+    the concurrency and pauses sending for the Retry-After the provider asked
+    for, slow batches lower it by one, successful ones raise it slowly again.
+    Only the batches that failed are retried; their texts go back to the front of the queue.
+    """
+
+    def __init__(self, batch_tokens: int = EMBED_BATCH_TOKENS, max_inputs: int = EMBED_BATCH_MAX_INPUTS,
+                 batch_wait: float = EMBED_BATCH_WAIT, concurrency: int = EMBED_CONCURRENCY,
+                 min_concurrency: int = EMBED_MIN_CONCURRENCY, max_concurrency: int = EMBED_MAX_CONCURRENCY,
+                 latency_target: float = EMBED_LATENCY_TARGET, tokens_per_minute: int = EMBED_TOKENS_PER_MINUTE,
+                 max_attempts: int = EMBED_MAX_ATTEMPTS, retry_base_delay: float = EMBED_RETRY_BASE_DELAY,
+                 retry_max_delay: float = EMBED_RETRY_MAX_DELAY, enabled: bool = EMBED_SCHEDULER_ENABLED):
+        self.batch_tokens = batch_tokens
+        self.max_inputs = max_inputs
+        self.batch_wait = batch_wait
+        self.min_concurrency = max(min_concurrency, 1)
+        self.max_concurrency = max(max_concurrency, self.min_concurrency)
+        self.limit = float(min(max(concurrency, self.min_concurrency), self.max_concurrency))
+        self.latency_target = latency_target
+        self.tokens_per_minute = tokens_per_minute
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.enabled = enabled
+        self.in_flight = 0
+        self.batches = 0
+        self.texts = 0
+        self.tokens = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.failures = 0
+        self.slow_batches = 0
+        self._tokenizer = None
+        self._pending = deque()
+        self._paused_until = 0.0
+        self._budget = float(tokens_per_minute)  # token bucket, when the TPM limit is known
+        self._budget_at = time.monotonic()
+        self._loop = None
+        self._wake = None
+        self._dispatcher = None
+        self._running = set()
+
+    def count_tokens(self, text: str) -> int:
+        if self._tokenizer is None:
+            from llama_index.core.utils import get_tokenizer
+            self._tokenizer = get_tokenizer()
+        return len(self._tokenizer(text))
+
+    async def embed(self, texts: list, embed_model) -> list:
+        """
+        Embeds texts with embed_model, in input order. Raises the error of the
+        first batch that could not be embedded (after its retries).
+        """
+        if not texts:
+            return []
+        if not self.enabled:
+            return await embed_model.aget_text_embedding_batch(texts)
+
+        loop = self._ensure_dispatcher()
+        embed_model = batch_embed_model(embed_model)
+        items = [_Pending(embed_model, text, self.count_tokens(text), loop.create_future()) for text in texts]
+        self._pending.extend(items)
+        self._wake.set()
+        results = await asyncio.gather(*(item.future for item in items), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _ensure_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # First use, or a new event loop (tests): state tied to the old loop is useless
+            self._loop = loop
+            self._wake = asyncio.Event()
+            self._pending.clear()
+            self._running.clear()
+            self.in_flight = 0
+            self._dispatcher = None
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        return loop
+
+    # --- Dispatching ---
+
+    async def _dispatch(self):
+        while True:
+            while self._pending and self._pending[0].future.done():
+                self._pending.popleft()  # caller went away
+            count, tokens = self._next_batch() if self._pending else (0, 0)
+            delay = self._delay(count, tokens) if count else None
+            if delay is None or delay > 0:
+                # Nothing to send yet: wait for new texts, a finished batch or the delay
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = [self._pending.popleft() for _ in range(count)]
+            self._spend(tokens)
+            self.in_flight += 1
+            task = asyncio.create_task(self._run(batch, tokens))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    def _next_batch(self) -> tuple:
+        """
+        (texts, tokens) of the next batch: texts at the front of the queue for
+        the same model, up to the token and input budgets (at least one text).
+        """
+        model = self._pending[0].model
+        max_inputs = self.max_inputs
+        model_batch_size = getattr(model, "embed_batch_size", None)
+        if isinstance(model_batch_size, int) and model_batch_size > 0:
+            # aget_text_embedding_batch splits larger lists into several requests
+            max_inputs = min(max_inputs, model_batch_size)
+
+        count, tokens = 0, 0
+        for item in self._pending:
+            if item.model is not model or count >= max_inputs:
+                break
+            if count and tokens + item.tokens > self.batch_tokens:
+                break
+            count += 1
+            tokens += item.tokens
+        return count, tokens
+
+    def _delay(self, count: int, tokens: int):
+        """
+        Seconds before the next batch may be sent, or None to wait for a running batch to finish.
+        """
+        if self.in_flight >= int(self.limit):
+            return None
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        full = tokens >= self.batch_tokens or count >= self.max_inputs or count < len(self._pending)
+        linger = self._pending[0].queued_at + self.batch_wait - now
+        if not full and linger > 0:
+            return linger
+        if self.tokens_per_minute:
+            self._refill(now)
+            needed = min(tokens, self.tokens_per_minute)
+            if self._budget < needed:
+                return (needed - self._budget) * 60 / self.tokens_per_minute
+        return 0
+
+    def _refill(self, now: float):
+        rate = self.tokens_per_minute / 60
+        self._budget = min(self.tokens_per_minute, self._budget + (now - self._budget_at) * rate)
+        self._budget_at = now
+
+    def _spend(self, tokens: int):
+        if self.tokens_per_minute:
+            self._budget -= tokens
+
+    async def _run(self, batch: list, tokens: int):
+        started = time.monotonic()
+        try:
+            embeddings = await batch[0].model.aget_text_embedding_batch([item.text for item in batch])
+        except Exception as e:
+            self._on_failure(batch, tokens, e)
+        else:
+            latency = time.monotonic() - started
+            stage_seconds.observe("embed.batch", latency)
+            self._on_success(batch, tokens, latency)
+            for item, embedding in zip(batch, embeddings):
+                if not item.future.done():
+                    item.future.set_result(embedding)
+        finally:
+            self.in_flight -= 1
+            self._wake.set()
+
+    def _on_success(self, batch: list, tokens: int, latency: float):
+        self.batches += 1
+        self.texts += len(batch)
+        self.tokens += tokens
+        if self.latency_target and latency > self.latency_target:
+            self.slow_batches += 1
+            self.limit = max(self.min_concurrency, self.limit - 1)
+        else:
+            # Additive increase: about +1 once every running slot has completed a batch
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def _on_failure(self, batch: list, tokens: int, error: Exception):
+        attempts = max(item.attempts for item in batch) + 1
+        if not is_retryable(error) or attempts >= self.max_attempts:
+            self.failures += 1
+            print(f"Embedding batch of {len(batch)} texts failed after {attempts} attempt(s): {error}")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(error)
+            return
+
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+        if status_code(error) == 429:
+            self.rate_limited += 1
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            delay = retry_after(error) or delay
+            # The provider says the minute's budget is spent
+            self._budget = min(self._budget, 0)
+        self.retries += 1
+        for item in batch:
+            item.attempts = attempts
+        self._pending.extendleft(reversed(batch))
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "concurrency_limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "pending_texts": len(self._pending),
+            "batches": self.batches,
+            "texts": self.texts,
+            "tokens": self.tokens,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "failures": self.failures,
+            "slow_batches": self.slow_batches,
+            "paused_seconds": round(max(self._paused_until - time.monotonic(), 0.0), 3),
+        }
+
+
+# Process-wide instance every indexing request embeds through
+embedding_scheduler = EmbeddingScheduler()
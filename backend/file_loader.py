@@ -0,0 +1,215 @@
+import os
+import mmap
+import codecs
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Files bigger than this are rejected while downloading (default 100 MB)
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+# Total seconds allowed for one download (connect + read)
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+# Downloads stay in memory up to this size, then spill to a temp file (default 8 MB)
+DOWNLOAD_SPOOL_THRESHOLD = int(os.getenv("DOWNLOAD_SPOOL_THRESHOLD", str(8 * 1024 * 1024)))
+
+# Processes used to extract large PDFs (one page range per task)
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+# PDFs with fewer pages are extracted in the calling thread (not worth the IPC)
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "32"))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+TEXT_EXTENSIONS = {".txt", ".json", ".ts", ".js", ".py", ".md", ".csv", ".html", ".css"}
+
+
+class FileTooLargeError(ValueError):
+    pass
+
+
+async def download_file(
+    url: str,
+    max_bytes: int = DOWNLOAD_MAX_BYTES,
+    timeout: float = DOWNLOAD_TIMEOUT,
+    spool_threshold: int = DOWNLOAD_SPOOL_THRESHOLD,
+    client: httpx.AsyncClient = None,
+    on_progress=None,
+) -> tempfile.SpooledTemporaryFile:
+    """
+    Streams a file into a SpooledTemporaryFile without blocking the event loop.
+    Small files stay in memory, large ones are spooled to disk, and anything
+    over max_bytes is aborted as soon as we know about it.
+    on_progress(bytes_downloaded) is called after every chunk if given.
+    The caller owns (and must close) the returned file.
+    """
+    owns_client = client is None
+    if owns_client:
+        client = httpx.AsyncClient(timeout=timeout, follow_redirects=True)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    try:
+        async with client.stream("GET", url, timeout=timeout) as response:
+            response.raise_for_status()
+
+            # 1. Fail fast when the server tells us the size up front
+            content_length = response.headers.get("content-length")
+            if content_length and int(content_length) > max_bytes:
+                raise FileTooLargeError(f"File is {content_length} bytes, limit is {max_bytes}")
+
+            # 2. Stream chunks, enforcing the limit as we go
+            downloaded = 0
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                downloaded += len(chunk)
+                if downloaded > max_bytes:
+                    raise FileTooLargeError(f"File exceeds the {max_bytes} byte limit")
+                spool.write(chunk)
+                if on_progress:
+                    on_progress(downloaded)
+
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+    finally:
+        if owns_client:
+            await client.aclose()
+
+
+def _buffer_view(spool):
+    """
+    Returns (view, mapping) exposing the spool's bytes without copying them:
+    the BytesIO buffer when the file is still in memory, a read-only mmap otherwise.
+    """
+    # SpooledTemporaryFile has no public "rolled over" flag
+    if not spool._rolled:
+        return spool._file.getbuffer(), None
+    spool.flush()
+    mapping = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapping), mapping
+
+
+_pdf_pool = None
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Lazily starts the process pool used for large PDFs.
+    "spawn" avoids forking a process that has event loop and DB pool threads running.
+    """
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(cancel_futures=True)
+        _pdf_pool = None
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> list:
+    """
+    Runs in a pool process: returns [(page_number, text)] for pages [start, stop).
+    """
+    import fitz  # PyMuPDF
+    with fitz.open(path) as doc:
+        return [(number + 1, doc[number].get_text()) for number in range(start, stop)]
+
+
+def _read_pdf_pages(spool) -> list:
+    # Imported on the first PDF: PyMuPDF isn't needed to start the server
+    import fitz  # PyMuPDF
+    view, mapping = _buffer_view(spool)
+    try:
+        if len(view) == 0:
+            return []
+        with fitz.open(stream=view, filetype="pdf") as doc:
+            page_count = doc.page_count
+            if page_count < PDF_PARALLEL_MIN_PAGES or PDF_EXTRACT_WORKERS <= 1:
+                return [(page.number + 1, page.get_text()) for page in doc]
+
+        # Large PDF: give the pool processes a named copy to open, one page range per task
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as copy:
+            copy.write(view)
+            copy.flush()
+            pool = get_pdf_pool()
+            futures = [
+                pool.submit(_extract_page_range, copy.name, start, min(start + PDF_PAGES_PER_TASK, page_count))
+                for start in range(0, page_count, PDF_PAGES_PER_TASK)
+            ]
+            pages = []
+            for future in futures:
+                pages.extend(future.result())
+            return pages
+    finally:
+        view.release()
+        if mapping is not None:
+            mapping.close()
+
+
+def _read_text(spool, encoding: str) -> str:
+    spool.seek(0)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    parts = []
+    while True:
+        chunk = spool.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+
+def load_pages(spool, file_name: str) -> list:
+    """
+    Intelligently extracts text based on file extension from a downloaded (spooled) file.
+    Returns [(page_number, text)]: one entry per page for PDFs, a single
+    (None, text) entry for text formats.
+    This is CPU bound, so async callers should run it in a worker thread.
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+
+    # 1. BINARY FORMATS (Need special parsers)
+    if ext == ".pdf":
+        return _read_pdf_pages(spool)
+
+    # Add other binaries here if needed (e.g., .docx using python-docx)
+
+    # 2. TEXT FORMATS (Code, JSON, Markdown, etc.)
+    # Decoded chunk by chunk so we never hold a second full copy of the raw bytes
+    if ext in TEXT_EXTENSIONS or not ext:
+        try:
+            return [(None, _read_text(spool, "utf-8"))]
+        except UnicodeDecodeError:
+            # Fallback if utf-8 fails (sometimes happens with weird windows encoding)
+            return [(None, _read_text(spool, "latin-1"))]
+
+    # 3. UNSUPPORTED
+    raise ValueError(f"Unsupported file type: {ext}")
+
+
+def load_file(spool, file_name: str) -> str:
+    """
+    Same as load_pages, joined into one string.
+    """
+    return "".join(text for _, text in load_pages(spool, file_name))
+
+
+def load_file_from_memory(file_bytes: bytes, file_name: str) -> str:
+    """
+    Same as load_file, for callers that already hold the whole file as bytes.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=len(file_bytes) + 1)
+    spool.write(file_bytes)
+    spool.seek(0)
+    with spool:
+        return load_file(spool, file_name)
@@ -0,0 +1,162 @@
+import os
+import re
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from migrations import EMBEDDINGS_TABLE, TEXT_SEARCH_CONFIG
+
+load_dotenv()
+
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+# Candidates taken from each side before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+# k of reciprocal rank fusion: score = sum(1 / (k + rank))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Answer exact lookups (identifiers, error codes, quoted phrases, names) from
+# the full-text index alone, without embedding the query
+LEXICAL_FAST_PATH = os.getenv("LEXICAL_FAST_PATH", "true").lower() == "true"
+LEXICAL_FAST_PATH_MAX_TERMS = int(os.getenv("LEXICAL_FAST_PATH_MAX_TERMS", "4"))
+
+LEXICAL_SQL = """
+    SELECT node_id, text, metadata_,
+           ts_rank_cd(text_search_tsv, any_terms) AS rank,
+           text_search_tsv @@ all_terms AS exact
+    FROM {table},
+         websearch_to_tsquery('{config}', :all_terms) AS all_terms,
+         websearch_to_tsquery('{config}', :any_terms) AS any_terms
+    WHERE {conversation_filter} = :cid AND text_search_tsv @@ any_terms
+    ORDER BY exact DESC, rank DESC
+    LIMIT :limit
+"""
+
+IDENTIFIER = re.compile(r"\d|_|\w\.\w|::|\(\)|[a-z][A-Z]|^[A-Z]{2,}$")
+
+
+class HybridStats:
+    """
+    How search_documents queries were answered.
+    """
+
+    def __init__(self):
+        self.lexical_only = 0
+        self.fused = 0
+        self._lock = threading.Lock()
+
+    def record(self, lexical_only: bool):
+        with self._lock:
+            if lexical_only:
+                self.lexical_only += 1
+            else:
+                self.fused += 1
+
+    def stats(self) -> dict:
+        total = self.lexical_only + self.fused
+        return {
+            "enabled": HYBRID_SEARCH_ENABLED,
+            "lexical_only": self.lexical_only,
+            "fused": self.fused,
+            "embedding_calls_skipped_rate": self.lexical_only / total if total else 0.0,
+        }
+
+
+hybrid_stats = HybridStats()
+
+
+def query_terms(query: str) -> list:
+    return re.findall(r"[\w.:/-]*\w", query)
+
+
+def is_exact_lookup(query: str) -> bool:
+    """
+    Short queries that name something (quoted phrases, identifiers such as
+    parse_config or ERR_4711, version numbers, capitalized names) are what a
+    keyword match answers better than a similarity search.
+    """
+    if '"' in query:
+        return True
+    terms = query_terms(query)
+    if not terms or len(terms) > LEXICAL_FAST_PATH_MAX_TERMS:
+        return False
+    return any(IDENTIFIER.search(term) for term in terms) or any(term[0].isupper() for term in terms[1:])
+
+
+def reciprocal_rank_fusion(result_lists: list, top_k: int, k: int = RRF_K) -> list:
+    """
+    Merges ranked NodeWithScore lists: every list a node appears in adds 1 / (k + rank).
+    """
+    scores = {}
+    nodes = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            node_id = result.node.node_id
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+            nodes.setdefault(node_id, result.node)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[node_id], score=scores[node_id]) for node_id in ranked]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Conversation-scoped full-text search over text_search_tsv fused (RRF) with
+    the vector retriever. Exact lookups with a full-text match skip the
+    vector side, and with it the query embedding.
+    """
+
+    def __init__(self, vector_retriever, engine, conversation_id: str, conversation_filter: str,
+                 similarity_top_k: int = 3, table: str = EMBEDDINGS_TABLE,
+                 candidates: int = HYBRID_CANDIDATES, fast_path: bool = LEXICAL_FAST_PATH):
+        super().__init__()
+        self.vector_retriever = vector_retriever
+        self.engine = engine
+        self.conversation_id = conversation_id
+        self.conversation_filter = conversation_filter
+        self.similarity_top_k = similarity_top_k
+        self.table = table
+        self.candidates = candidates
+        self.fast_path = fast_path
+
+    def lexical_search(self, query: str) -> list:
+        """
+        Returns [(NodeWithScore, matches_all_terms)], best first. Any term may
+        match (for recall in the fusion); chunks matching all of them come first.
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        sql = LEXICAL_SQL.format(table=self.table, config=TEXT_SEARCH_CONFIG,
+                                 conversation_filter=self.conversation_filter)
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(sql), {
+                "all_terms": query,
+                "any_terms": " or ".join(term.lstrip("-") for term in terms),
+                "cid": self.conversation_id,
+                "limit": self.candidates,
+            }).all()
+
+        results = []
+        for row in rows:
+            node = metadata_dict_to_node(row.metadata_)
+            node.set_content(str(row.text))
+            results.append((NodeWithScore(node=node, score=float(row.rank)), row.exact))
+        return results
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list:
+        query = query_bundle.query_str
+        lexical = self.lexical_search(query)
+
+        exact = [result for result, matches_all in lexical if matches_all]
+        if self.fast_path and exact and is_exact_lookup(query):
+            hybrid_stats.record(lexical_only=True)
+            return exact[:self.similarity_top_k]
+
+        hybrid_stats.record(lexical_only=False)
+        vector = self.vector_retriever.retrieve(query_bundle)
+        return reciprocal_rank_fusion(
+            [[result for result, _ in lexical], vector],
+            top_k=self.similarity_top_k,
+        )
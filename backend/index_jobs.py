@@ -0,0 +1,314 @@
+import os
+import time
+import uuid
+import asyncio
+from dataclasses import dataclass, field, asdict
+from psycopg.rows import dict_row
+from dotenv import load_dotenv
+
+from db import get_db
+from metrics import DEBUG_TIMINGS, collect_timings, timing_breakdown
+
+load_dotenv()
+
+# Jobs indexed at the same time by this process
+INDEX_JOB_WORKERS = int(os.getenv("INDEX_JOB_WORKERS", "2"))
+# Jobs allowed to wait for a worker before /api/index-file answers 503
+INDEX_JOB_QUEUE_SIZE = int(os.getenv("INDEX_JOB_QUEUE_SIZE", "100"))
+# Minimum seconds between two progress writes of the same job
+INDEX_JOB_PROGRESS_INTERVAL = float(os.getenv("INDEX_JOB_PROGRESS_INTERVAL", "1"))
+# Unfinished jobs not updated for this long are picked up again on startup
+INDEX_JOB_STALE_SECONDS = int(os.getenv("INDEX_JOB_STALE_SECONDS", "600"))
+
+JOBS_TABLE = "paperparrot_index_jobs"
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+@dataclass
+class IndexJob:
+    """
+    A queued /api/index-file (mode "index") or /api/update-file (mode "update") request plus its progress.
+    Has the same fields as IndexFileRequest so it can be fed to the indexing stages directly.
+    """
+    file_name: str
+    file_id: str
+    file_url: str
+    conversation_id: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    mode: str = "index"
+    status: str = "queued"
+    bytes_downloaded: int = 0
+    chunks_total: int = 0
+    chunks_embedded: int = 0
+    chunks_inserted: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0
+    error: str = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class IndexJobStore:
+    """
+    Persists jobs in Postgres (through the checkpointer's psycopg pool)
+    so their status survives a restart and any instance can answer a poll.
+    """
+
+    async def setup(self):
+        async with get_db().pool.connection() as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+                    id TEXT PRIMARY KEY,
+                    file_name TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    file_url TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    bytes_downloaded BIGINT NOT NULL DEFAULT 0,
+                    chunks_total INTEGER NOT NULL DEFAULT 0,
+                    chunks_embedded INTEGER NOT NULL DEFAULT 0,
+                    chunks_inserted INTEGER NOT NULL DEFAULT 0,
+                    cache_hits INTEGER NOT NULL DEFAULT 0,
+                    cache_misses INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # Columns added after the table was first created
+            await conn.execute(f"""
+                ALTER TABLE {JOBS_TABLE}
+                ADD COLUMN IF NOT EXISTS cache_hits INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS cache_misses INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS mode TEXT NOT NULL DEFAULT 'index',
+                ADD COLUMN IF NOT EXISTS chunks_unchanged INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS chunks_deleted INTEGER NOT NULL DEFAULT 0
+            """)
+            await conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {JOBS_TABLE}_unfinished_idx
+                ON {JOBS_TABLE} (updated_at) WHERE status NOT IN ('succeeded', 'failed')
+            """)
+
+    async def create(self, job: IndexJob):
+        async with get_db().pool.connection() as conn:
+            await conn.execute(
+                f"""INSERT INTO {JOBS_TABLE}
+                    (id, file_name, file_id, file_url, conversation_id, mode, status)
+                    VALUES (%(id)s, %(file_name)s, %(file_id)s, %(file_url)s, %(conversation_id)s, %(mode)s, %(status)s)""",
+                job.to_dict(),
+            )
+
+    async def update(self, job: IndexJob):
+        async with get_db().pool.connection() as conn:
+            await conn.execute(
+                f"""UPDATE {JOBS_TABLE} SET
+                    status = %(status)s,
+                    bytes_downloaded = %(bytes_downloaded)s,
+                    chunks_total = %(chunks_total)s,
+                    chunks_embedded = %(chunks_embedded)s,
+                    chunks_inserted = %(chunks_inserted)s,
+                    cache_hits = %(cache_hits)s,
+                    cache_misses = %(cache_misses)s,
+                    chunks_unchanged = %(chunks_unchanged)s,
+                    chunks_deleted = %(chunks_deleted)s,
+                    error = %(error)s,
+                    updated_at = now()
+                    WHERE id = %(id)s""",
+                job.to_dict(),
+            )
+
+    async def claim(self, job: IndexJob) -> bool:
+        """
+        Moves a queued job to running. Returns False if another worker/instance got it first.
+        """
+        async with get_db().pool.connection() as conn:
+            cur = await conn.execute(
+                f"UPDATE {JOBS_TABLE} SET status = 'running', updated_at = now() "
+                f"WHERE id = %s AND status = 'queued' RETURNING id",
+                (job.id,),
+            )
+            return await cur.fetchone() is not None
+
+    async def get(self, job_id: str) -> dict:
+        async with get_db().pool.connection() as conn:
+            cur = conn.cursor(row_factory=dict_row)
+            await cur.execute(
+                f"""SELECT id, file_name, file_id, file_url, conversation_id, mode, status,
+                    bytes_downloaded, chunks_total, chunks_embedded, chunks_inserted,
+                    cache_hits, cache_misses, chunks_unchanged, chunks_deleted, error
+                    FROM {JOBS_TABLE} WHERE id = %s""",
+                (job_id,),
+            )
+            return await cur.fetchone()
+
+    async def requeue_stale(self, stale_seconds: int) -> list:
+        """
+        Resets unfinished jobs that nobody has touched for stale_seconds (e.g. the
+        process running them was restarted) back to queued, and returns them.
+        Fresh 'queued' jobs are included: a claim makes sure only one worker runs them.
+        """
+        async with get_db().pool.connection() as conn:
+            cur = conn.cursor(row_factory=dict_row)
+            await cur.execute(
+                f"""UPDATE {JOBS_TABLE} SET
+                    status = 'queued', bytes_downloaded = 0, chunks_total = 0,
+                    chunks_embedded = 0, chunks_inserted = 0, cache_hits = 0, cache_misses = 0,
+                    chunks_unchanged = 0, chunks_deleted = 0,
+                    updated_at = now()
+                    WHERE status = 'queued'
+                       OR (status NOT IN ('succeeded', 'failed')
+                           AND updated_at < now() - make_interval(secs => %s))
+                    RETURNING id, file_name, file_id, file_url, conversation_id, mode""",
+                (stale_seconds,),
+            )
+            return await cur.fetchall()
+
+
+class IndexJobManager:
+    """
+    Runs indexing jobs on a bounded pool of asyncio workers.
+    Started and stopped by main.lifespan.
+    """
+
+    def __init__(self, store=None, workers: int = INDEX_JOB_WORKERS, queue_size: int = INDEX_JOB_QUEUE_SIZE):
+        self.store = store or IndexJobStore()
+        self.num_workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.active = {}  # job id -> IndexJob, for live progress of jobs in this process
+        self.recovered = set()  # ids of jobs picked up again on start, which may have inserted chunks already
+        self._workers = []
+
+    async def start(self):
+        await self.store.setup()
+        for row in await self.store.requeue_stale(INDEX_JOB_STALE_SECONDS):
+            job = IndexJob(**row)
+            self.active[job.id] = job
+            self.recovered.add(job.id)
+            try:
+                self.queue.put_nowait(job)
+            except asyncio.QueueFull:
+                # Still 'queued' in Postgres, so the next restart picks it up
+                self.active.pop(job.id)
+                self.recovered.discard(job.id)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, request, mode: str = "index") -> IndexJob:
+        if self.queue.full():
+            raise JobQueueFullError("Too many indexing jobs queued, try again later")
+        job = IndexJob(
+            file_name=request.file_name,
+            file_id=request.file_id,
+            file_url=request.file_url,
+            conversation_id=request.conversation_id,
+            mode=mode,
+        )
+        await self.store.create(job)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # Lost a race for the last slot while the row was being written
+            job.status = "failed"
+            job.error = "Too many indexing jobs queued"
+            await self.store.update(job)
+            raise JobQueueFullError("Too many indexing jobs queued, try again later")
+        self.active[job.id] = job
+        return job
+
+    def stats(self) -> dict:
+        queued = self.queue.qsize()
+        return {
+            "in_flight": len(self.active) - queued,
+            "queued": queued,
+            "max_concurrent": self.num_workers,
+            "max_queue": self.queue.maxsize,
+        }
+
+    async def get(self, job_id: str) -> dict:
+        job = self.active.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return await self.store.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                print(f"Error running index job {job.id}: {e}")
+            finally:
+                self.active.pop(job.id, None)
+                self.recovered.discard(job.id)
+                self.queue.task_done()
+
+    async def _run(self, job: IndexJob):
+        if not await self.store.claim(job):
+            return
+
+        last_flush = 0.0
+        pending_flush = None
+
+        def on_progress(item):
+            nonlocal last_flush, pending_flush
+            stage_changed = job.status != item.stage
+            job.status = item.stage
+            job.bytes_downloaded = item.bytes_downloaded
+            job.chunks_total = item.chunks_total
+            job.chunks_embedded = item.chunks_embedded
+            job.chunks_inserted = item.chunks_inserted
+            job.cache_hits = item.cache_hits
+            job.cache_misses = item.cache_misses
+            job.chunks_unchanged = item.chunks_unchanged
+            job.chunks_deleted = item.chunks_deleted
+            # Persist on every stage change, and at most once per interval otherwise.
+            # Counters are always live in self.active for polls served by this process.
+            now = time.monotonic()
+            if stage_changed or now - last_flush >= INDEX_JOB_PROGRESS_INTERVAL:
+                last_flush = now
+                pending_flush = True
+
+        # Imported by the first job (LlamaIndex is slow to import), usually already loaded by the warm-up
+        from indexing import IndexItem, run_index_item, run_update_item
+        item = IndexItem(request=job, on_progress=on_progress)
+        # The task copies the context, so spans recorded while indexing end up in `timings`
+        with collect_timings() as timings:
+            # A recovered job may have stopped after some insert batches: the update path
+            # diffs against the chunks already stored instead of inserting them a second time
+            recovered = job.id in self.recovered
+            run = run_update_item if job.mode == "update" or recovered else run_index_item
+            stages = asyncio.create_task(run(item))
+        try:
+            # Flush progress from the event loop (on_progress may run in a worker thread)
+            while not stages.done():
+                await asyncio.wait({stages}, timeout=INDEX_JOB_PROGRESS_INTERVAL)
+                if pending_flush and not stages.done():
+                    pending_flush = None
+                    await self.store.update(job)
+            await stages
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so the next start runs it again
+            job.status = "queued"
+            await self.store.update(job)
+            raise
+        except Exception as e:
+            print(f"Error indexing {job.file_id}: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            if not stages.done():
+                stages.cancel()
+        await self.store.update(job)
+        if DEBUG_TIMINGS:
+            print(f"Index job {job.id} {job.status}: {timing_breakdown(timings)}")
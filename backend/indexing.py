@@ -0,0 +1,404 @@
+import os
+import asyncio
+import hashlib
+from functools import lru_cache
+from dataclasses import dataclass, field
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+
+from llama_index.core import Document, Settings
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.core.utils import iter_batch
+
+from file_loader import download_file, load_pages, DOWNLOAD_TIMEOUT, TEXT_EXTENSIONS
+from embedding_cache import embedding_cache
+from caches import retrieval_cache
+from answer_cache import answer_cache
+from rag_utils import get_vector_store, prepare_conversation_storage, file_chunk_rows, replace_file_chunks
+from metrics import span
+
+load_dotenv()
+
+# Workers per pipeline stage for /api/index-files
+INDEX_DOWNLOAD_CONCURRENCY = int(os.getenv("INDEX_DOWNLOAD_CONCURRENCY", "4"))
+INDEX_PARSE_CONCURRENCY = int(os.getenv("INDEX_PARSE_CONCURRENCY", "2"))
+INDEX_EMBED_CONCURRENCY = int(os.getenv("INDEX_EMBED_CONCURRENCY", "4"))
+INDEX_INSERT_CONCURRENCY = int(os.getenv("INDEX_INSERT_CONCURRENCY", "2"))
+# Max items waiting between two stages (bounds memory held by downloaded/parsed files)
+INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", "4"))
+# Max files accepted by a single /api/index-files call
+INDEX_MAX_FILES = int(os.getenv("INDEX_MAX_FILES", "50"))
+# Chunks per embedding call / per insert transaction (progress is reported per batch)
+INDEX_EMBED_BATCH_SIZE = int(os.getenv("INDEX_EMBED_BATCH_SIZE", "100"))
+INDEX_INSERT_BATCH_SIZE = int(os.getenv("INDEX_INSERT_BATCH_SIZE", "500"))
+# Chunk size / overlap in tokens (SentenceSplitter's defaults). Override them for one
+# file type with CHUNK_SIZE_<EXT> / CHUNK_OVERLAP_<EXT>, e.g. CHUNK_SIZE_PDF=768 CHUNK_OVERLAP_CSV=0
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1024"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+CHUNK_SETTINGS = {
+    ext: (
+        int(os.getenv(f"CHUNK_SIZE_{ext[1:].upper()}", str(CHUNK_SIZE))),
+        int(os.getenv(f"CHUNK_OVERLAP_{ext[1:].upper()}", str(CHUNK_OVERLAP))),
+    )
+    for ext in sorted({".pdf", *TEXT_EXTENSIONS})
+}
+
+
+@dataclass
+class IndexItem:
+    """
+    One file travelling through the indexing pipeline.
+    Each stage fills in the next field; once `error` is set the remaining stages skip it.
+    on_progress(item) is called whenever the stage or one of the counters changes.
+    """
+    request: object  # IndexFileRequest (or anything with the same fields)
+    spool: object = None
+    nodes: list = field(default_factory=list)
+    error: Exception = None
+    stage: str = "queued"
+    bytes_downloaded: int = 0
+    chunks_total: int = 0
+    chunks_embedded: int = 0
+    chunks_inserted: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Updates only: stored chunks kept as they are / deleted, and the stored rows compared against
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0
+    stored_ids: list = field(default_factory=list)
+    delete_ids: list = field(default_factory=list)
+    # Task preparing the conversation's storage (its partition), started with the download
+    storage_ready: object = None
+    on_progress: object = None
+
+    def report(self, stage: str = None):
+        if stage is not None:
+            self.stage = stage
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def result(self) -> dict:
+        if self.error is not None:
+            return {"file_id": self.request.file_id, "status": "error", "message": str(self.error)}
+        return {
+            "file_id": self.request.file_id,
+            "status": "success",
+            "message": f"Indexed {self.request.file_name}",
+            "embedding_cache_hits": self.cache_hits,
+            "embedding_cache_misses": self.cache_misses,
+        }
+
+
+def chunk_hash(text: str, file_name: str, page_number=None) -> str:
+    """
+    Identity of a stored chunk: its text plus the file name and page shown with it.
+    """
+    page = "" if page_number is None else str(page_number)
+    return hashlib.sha256(f"{file_name}\x00{page}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def chunk_settings(file_name: str) -> tuple:
+    """
+    (chunk_size, chunk_overlap) used for a file, based on its extension.
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    return CHUNK_SETTINGS.get(ext, (CHUNK_SIZE, CHUNK_OVERLAP))
+
+
+@lru_cache(maxsize=None)
+def get_splitter(chunk_size: int, chunk_overlap: int) -> SentenceSplitter:
+    # Building one loads the tokenizer: share them between files
+    return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+# --- Stages ---
+# Each stage works on one IndexItem. They are used one after another by
+# index_file_request and as concurrent workers by run_index_pipeline.
+
+async def download_stage(item: IndexItem, client: httpx.AsyncClient = None):
+    print(f"Downloading {item.request.file_url}...")
+    item.report("downloading")
+    # A conversation's first file gets its partition while it downloads, not when its chunks are inserted
+    item.storage_ready = asyncio.ensure_future(
+        run_in_threadpool(prepare_conversation_storage, item.request.conversation_id)
+    )
+    # Collected by the insert stage; an item that fails before then mustn't log it as never retrieved
+    item.storage_ready.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def on_bytes(downloaded):
+        item.bytes_downloaded = downloaded
+        item.report()
+
+    # download file from uploadthing (streamed, spooled to disk past a threshold)
+    with span("index.download"):
+        item.spool = await download_file(item.request.file_url, client=client, on_progress=on_bytes)
+
+
+def parse_stage(item: IndexItem):
+    """
+    Extracts text and splits it into nodes. CPU bound: run it in a worker thread.
+    """
+    req = item.request
+    item.report("parsing")
+    with item.spool, span("index.extract"):
+        pages = load_pages(item.spool, req.file_name)
+    item.spool = None
+
+    # 1. Create one Document per page (a single one for text files)
+    # File identity lives in metadata only: it is neither embedded nor stored in the
+    # chunk text (search_documents names each file once), so identical chunks embed
+    # identically (and hit the embedding cache) whatever the upload is called
+    documents = []
+    for page_number, page_text in pages:
+        # We perform the NUL byte cleaning here once (for postgres/pgvector)
+        clean_text = page_text.replace("\x00", "")
+        if not clean_text.strip():
+            continue
+        metadata = {
+            "conversation_id": req.conversation_id,
+            "file_id": req.file_id,
+            "file_name": req.file_name,
+            "file_url": req.file_url,
+        }
+        if page_number is not None:
+            metadata["page_number"] = page_number
+        documents.append(Document(
+            text=clean_text,
+            metadata=metadata,
+            excluded_embed_metadata_keys=[*metadata, "chunk_hash"],
+            excluded_llm_metadata_keys=[*metadata, "chunk_hash"],
+        ))
+
+    # 2. Split into Nodes (Chunks) with the file type's chunk size
+    with span("index.split"):
+        nodes = get_splitter(*chunk_settings(req.file_name)).get_nodes_from_documents(documents)
+        # Lets a later update of the file tell which chunks are already stored
+        for node in nodes:
+            node.metadata["chunk_hash"] = chunk_hash(node.text, req.file_name, node.metadata.get("page_number"))
+
+    item.nodes = nodes
+    item.chunks_total = len(nodes)
+    item.report()
+
+
+async def embed_nodes(nodes: list) -> tuple:
+    """
+    Embeds nodes in place with the global LlamaIndex embed model
+    (same text VectorStoreIndex would embed), reusing cached embeddings
+    of identical chunks. Returns (cache hits, cache misses).
+    """
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    with span("index.embed"):
+        embeddings, hits, misses = await embedding_cache.embed_texts(texts, Settings.embed_model)
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return hits, misses
+
+
+async def insert_nodes(nodes: list):
+    """
+    Inserts already embedded nodes into pgvector through the shared vector store.
+    """
+    if nodes:
+        with span("index.insert"):
+            # A partitioned table needs the conversation's partition before its first insert
+            for conversation_id in {node.metadata["conversation_id"] for node in nodes}:
+                await run_in_threadpool(prepare_conversation_storage, conversation_id)
+            await run_in_threadpool(get_vector_store().add, nodes)
+
+
+async def embed_stage(item: IndexItem):
+    item.report("embedding")
+    for batch in iter_batch(item.nodes, INDEX_EMBED_BATCH_SIZE):
+        hits, misses = await embed_nodes(batch)
+        item.cache_hits += hits
+        item.cache_misses += misses
+        item.chunks_embedded += len(batch)
+        item.report()
+
+
+async def wait_for_storage(item: IndexItem):
+    if item.storage_ready is not None:
+        await item.storage_ready
+
+
+async def insert_stage(item: IndexItem):
+    item.report("inserting")
+    await wait_for_storage(item)
+    for batch in iter_batch(item.nodes, INDEX_INSERT_BATCH_SIZE):
+        await insert_nodes(batch)
+        # New chunks are searchable now: cached results for this conversation are stale
+        retrieval_cache.invalidate(item.request.conversation_id)
+        answer_cache.invalidate(item.request.conversation_id)
+        item.chunks_inserted += len(batch)
+        item.report()
+
+
+async def diff_stage(item: IndexItem):
+    """
+    Compares the new version's chunks with the ones stored for the file.
+    Leaves only the new chunks in item.nodes and the rows no longer in the file in item.delete_ids.
+    """
+    req = item.request
+    item.report("comparing")
+    rows = await run_in_threadpool(file_chunk_rows, req.file_id, req.conversation_id)
+
+    stored = {}  # chunk hash -> ids of the rows holding it (a chunk can repeat)
+    for row in rows:
+        key = row.chunk_hash or chunk_hash(row.text, row.file_name, row.page_number)
+        stored.setdefault(key, []).append(row.id)
+
+    new_nodes = []
+    for node in item.nodes:
+        ids = stored.get(node.metadata["chunk_hash"])
+        if ids:
+            ids.pop()
+            item.chunks_unchanged += 1
+        else:
+            new_nodes.append(node)
+
+    item.stored_ids = [row.id for row in rows]
+    item.delete_ids = [row_id for ids in stored.values() for row_id in ids]
+    item.nodes = new_nodes
+    item.report()
+
+
+async def apply_stage(item: IndexItem):
+    """
+    Deletes the removed chunks and inserts the new ones in one transaction.
+    """
+    req = item.request
+    item.report("inserting")
+    await wait_for_storage(item)
+    if item.nodes:
+        await run_in_threadpool(prepare_conversation_storage, req.conversation_id)
+    if item.nodes or item.delete_ids:
+        with span("index.apply"):
+            await run_in_threadpool(
+                replace_file_chunks, req.file_id, req.conversation_id, item.stored_ids, item.delete_ids, item.nodes,
+            )
+        retrieval_cache.invalidate(req.conversation_id)
+        answer_cache.invalidate(req.conversation_id)
+    item.chunks_inserted = len(item.nodes)
+    item.chunks_deleted = len(item.delete_ids)
+    item.report()
+
+
+async def run_update_item(item: IndexItem) -> dict:
+    """
+    Indexes a new version of an already indexed file: only chunks that changed
+    are embedded and inserted, chunks that disappeared are deleted.
+    """
+    await download_stage(item)
+    await run_in_threadpool(parse_stage, item)
+    await diff_stage(item)
+    await embed_stage(item)
+    await apply_stage(item)
+    item.report("succeeded")
+    return item.result()
+
+
+async def run_index_item(item: IndexItem) -> dict:
+    """
+    Runs a single file through every stage, one after another.
+    Raises on failure so the caller can map it to an HTTP error / failed job.
+    """
+    await download_stage(item)
+    await run_in_threadpool(parse_stage, item)
+    await embed_stage(item)
+    await insert_stage(item)
+    item.report("succeeded")
+    return item.result()
+
+
+async def index_file_request(request) -> dict:
+    return await run_index_item(IndexItem(request=request))
+
+
+# --- Pipeline ---
+
+_DONE = object()
+
+
+async def _stage_worker(name, handler, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+    while True:
+        item = await in_queue.get()
+        if item is _DONE:
+            return
+        if item.error is None:
+            try:
+                await handler(item)
+            except Exception as e:
+                print(f"Error in {name} stage for {item.request.file_id}: {e}")
+                item.error = e
+        if item.error is not None and item.spool is not None:
+            item.spool.close()
+            item.spool = None
+        await out_queue.put(item)
+
+
+async def _run_stage(name, handler, concurrency, in_queue, out_queue, downstream_workers):
+    workers = [
+        asyncio.create_task(_stage_worker(name, handler, in_queue, out_queue))
+        for _ in range(concurrency)
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+    # Every worker of this stage is done: tell each worker of the next stage to stop
+    for _ in range(downstream_workers):
+        await out_queue.put(_DONE)
+
+
+async def run_index_pipeline(requests: list) -> list:
+    """
+    Indexes many files through download -> parse -> embed -> insert stages
+    connected by bounded queues, so one file can be downloading while another
+    is being embedded and a third inserted.
+    Returns one result dict per request, in the same order.
+    """
+    items = [IndexItem(request=r) for r in requests]
+    if not items:
+        return []
+
+    async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT, follow_redirects=True) as client:
+        async def download(item):
+            await download_stage(item, client=client)
+
+        async def parse(item):
+            await run_in_threadpool(parse_stage, item)
+
+        stages = [
+            ("download", download, INDEX_DOWNLOAD_CONCURRENCY),
+            ("parse", parse, INDEX_PARSE_CONCURRENCY),
+            ("embed", embed_stage, INDEX_EMBED_CONCURRENCY),
+            ("insert", insert_stage, INDEX_INSERT_CONCURRENCY),
+        ]
+
+        # queues[i] feeds stage i; the last queue collects finished items
+        queues = [asyncio.Queue(maxsize=max(INDEX_QUEUE_SIZE, 1)) for _ in stages]
+        queues.append(asyncio.Queue())
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            for _ in range(stages[0][2]):
+                await queues[0].put(_DONE)
+
+        tasks = [asyncio.create_task(feed())]
+        for i, (name, handler, concurrency) in enumerate(stages):
+            downstream_workers = stages[i + 1][2] if i + 1 < len(stages) else 0
+            tasks.append(asyncio.create_task(
+                _run_stage(name, handler, concurrency, queues[i], queues[i + 1], downstream_workers)
+            ))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return [item.result() for item in items]
@@ -1,61 +1,92 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 import os
-import tempfile
-import requests
-import fitz  # PyMuPDF
+import asyncio
+from typing import List, Optional
 from dotenv import load_dotenv
 
-from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, StorageContext, Document
-from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
-from llama_index.core.node_parser import SentenceSplitter # Import this
+# LlamaIndex, LangChain, LangGraph and PyMuPDF take seconds to import: modules
+# that need them are imported where they are used (and by the startup warm-up),
+# so the server starts listening quickly
 
-from langchain.tools import tool
-from langchain.chat_models import init_chat_model
-from langchain.agents.structured_output import ToolStrategy
-# NEW IMPORTS FOR PERSISTENCE
-from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
-from psycopg_pool import AsyncConnectionPool
-
-from langchain.agents import create_agent
-from langchain_community.utilities import GoogleSerperAPIWrapper
-from dataclasses import dataclass
-
-from rag_utils import get_vector_store, delete_file_by_id, delete_conversation_by_id
+from db import db
+from migrations import check_schema, migrations_pending, migrate_in_background, SCHEMA_AUTO_MIGRATE
+from chat_stream import agent_event_stream, cached_answer_stream
+from chat_history import (
+    history_cache, latest_checkpoint_id, message_turns, paginate, history_etag, etag_matches,
+    HISTORY_MAX_PAGE_SIZE,
+)
+from file_loader import shutdown_pdf_pool
+from index_jobs import IndexJobManager, JobQueueFullError
+from checkpoint_retention import CheckpointRetention
+from embedding_cache import embedding_cache
+from embedding_scheduler import embedding_scheduler
+from caches import retrieval_cache
+from answer_cache import answer_cache, cached_answer, remember_answer
+from web_search import web_search_cache
+from admission import AdmissionRejected, admit_chat, index_files_limiter, admission_stats
+from startup import startup_report, warm_up, WARMUP_ENABLED
+from metrics import DEBUG_TIMINGS, span, collect_timings, timing_breakdown, server_timing_header, render_metrics
+from rag_utils import delete_file_by_id, delete_conversation_by_id
 
 load_dotenv()
-search = GoogleSerperAPIWrapper()
+index_jobs = IndexJobManager()
+checkpoint_retention = CheckpointRetention()
 
 # --- LIFESPAN MANAGER (The Database Keeper) ---
 # This replaces the global "checkpointer = InMemorySaver()"
-# It ensures the database connection opens when the server starts 
-# and closes when the server stops.
+# It opens the process-wide DatabaseManager (checkpointer pool, vector store
+# engines and shared index) when the server starts and closes it when the server stops.
+# Only what requests can't do without happens here; the agent, vector store,
+# tokenizers and warm connections are built by the warm-up task afterwards.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise ValueError("DATABASE_URL not set")
-    
-    async with AsyncConnectionPool(
-        conninfo=db_url,
-        max_size=10,
-        
-        # Keep these stability settings
-        check=AsyncConnectionPool.check_connection,
-        max_lifetime=300,
-        
-        # --- FIX: Change 'client_kwargs' to 'kwargs' ---
-        kwargs={
-            "autocommit": True, 
-            "prepare_threshold": None,
-        }
-    ) as pool:
-        checkpointer = AsyncPostgresSaver(pool)
-        await checkpointer.setup()
+    startup_report.begin()
+    with startup_report.step("db.open"):
+        await db.open()
+    try:
+        # Reads which schema migrations are usable; pending ones never block startup
+        with startup_report.step("db.schema"):
+            schema = await asyncio.to_thread(check_schema, db)
+        with startup_report.step("checkpointer"):
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+            checkpointer = AsyncPostgresSaver(db.pool)
+            await checkpointer.setup()
+        app.state.db = db
         app.state.checkpointer = checkpointer
-        yield
+        with startup_report.step("cache_tables"):
+            await embedding_cache.setup()
+            await web_search_cache.setup()
+        with startup_report.step("index_jobs"):
+            await index_jobs.start()
+        app.state.index_jobs = index_jobs
+        await checkpoint_retention.start(agent_factory=get_rag_agent)
+
+        migration = None
+        if SCHEMA_AUTO_MIGRATE and migrations_pending(schema):
+            migration = asyncio.create_task(migrate_in_background(db))
+
+        warmup = None
+        if WARMUP_ENABLED:
+            warmup = asyncio.create_task(warm_up(db, get_rag_agent))
+        else:
+            startup_report.mark_ready()
+        try:
+            yield
+        finally:
+            for task in (warmup, migration):
+                if task is not None:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+            await checkpoint_retention.stop()
+            await index_jobs.stop()
+    finally:
+        shutdown_pdf_pool()
+        await db.close()
 
 # Initialize FastAPI with the lifespan
 app = FastAPI(lifespan=lifespan)
@@ -67,55 +98,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # Allows GET, POST, DELETE, etc.
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# --- Agent & Tool Setup Helpers ---
-@dataclass
-class ResponseFormat:
-    did_search_internet: bool
-    final_answer: str
-
-def create_rag_agent(conversation_id: str, checkpointer):
+@app.middleware("http")
+async def timing_breakdown_middleware(request: Request, call_next):
+    # Debug mode: per-request stage breakdown in a Server-Timing header (shown by browser dev tools)
+    if not DEBUG_TIMINGS:
+        return await call_next(request)
+    with collect_timings() as timings:
+        response = await call_next(request)
+    if timings:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+        print(f"{request.method} {request.url.path} timings: {timing_breakdown(timings)}")
+    return response
+
+# --- Agent ---
+def get_rag_agent():
     """
-    Creates the agent using the PERSISTENT checkpointer passed from the request.
+    Returns the process-wide agent, building it on first use.
+    Per-request data (the conversation) is passed as runtime context, not baked into the graph.
     """
-    
-    # 1. Setup Retriever (Same as before)
-    vector_store = get_vector_store()
-    index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-    filters = MetadataFilters(
-        filters=[ExactMatchFilter(key="conversation_id", value=conversation_id)]
-    )
-    retriever = index.as_retriever(similarity_top_k=3, filters=filters)
-
-    # 2. Define Tools (Same as before)
-    @tool
-    def search_documents(query: str) -> str:
-        """Retrieve the top 3 nodes from the index based on the query."""
-        nodes = retriever.retrieve(query)
-        if not nodes:
-            return "No relevant documents found."
-        return "\n\n".join([f"--- Document Snippet {i+1} ---\n{node.node.get_content()}" for i, node in enumerate(nodes)])
-
-    @tool
-    def search_internet(query: str) -> str:
-        """Returns search results from the internet."""
-        return search.run(query)
-
-    # 3. Create Agent
-    SYSTEM_PROMPT = """You are a document assistant. Answer user questions based on the retrieved documents first.
-    Only search the internet if the documents are insufficient."""
-
-    model = init_chat_model("openai:gpt-4o", temperature=0.5)
-
-    agent = create_agent(
-        model=model,
-        system_prompt=SYSTEM_PROMPT,
-        tools=[search_documents, search_internet],
-        response_format=ToolStrategy(ResponseFormat),
-        checkpointer=checkpointer # <--- NOW USING POSTGRES SAVER
-    )
-    
+    agent = getattr(app.state, "agent", None)
+    if agent is None:
+        from agent import create_rag_agent
+        agent = create_rag_agent(app.state.checkpointer)
+        app.state.agent = agent
     return agent
 
 
@@ -127,6 +135,9 @@ class IndexFileRequest(BaseModel):
     file_url: str
     conversation_id: str
 
+class IndexFilesRequest(BaseModel):
+    files: List[IndexFileRequest]
+
 class ChatRequest(BaseModel):
     message: str
     conversation_id: str
@@ -138,107 +149,135 @@ class DeleteFileRequest(BaseModel):
 class DeleteConversationRequest(BaseModel):
     conversation_id: str
 
+class CheckpointRetentionRequest(BaseModel):
+    dry_run: bool = True
+    compact: bool = False
+
 # --- Endpoints ---
 
 @app.get("/")
 def read_root():
     return {"message": "PaperParrot Backend is running"}
 
-def load_file_from_memory(file_bytes: bytes, file_name: str) -> str:
-    """
-    Intelligently extracts text based on file extension from bytes.
-    """
-    ext = os.path.splitext(file_name)[1].lower()
-    
-    # 1. BINARY FORMATS (Need special parsers)
-    if ext == ".pdf":
-        text_content = ""
-        # Open PDF from memory stream
-        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-            for page in doc:
-                text_content += page.get_text()
-        return text_content
-        
-    # Add other binaries here if needed (e.g., .docx using python-docx)
-
-    # 2. TEXT FORMATS (Code, JSON, Markdown, etc.)
-    # All these can simply be decoded from UTF-8
-    text_extensions = {".txt", ".json", ".ts", ".js", ".py", ".md", ".csv", ".html", ".css"}
-    
-    if ext in text_extensions or not ext:
-        try:
-            return file_bytes.decode("utf-8")
-        except UnicodeDecodeError:
-            # Fallback if utf-8 fails (sometimes happens with weird windows encoding)
-            return file_bytes.decode("latin-1")
-
-    # 3. UNSUPPORTED
-    raise ValueError(f"Unsupported file type: {ext}")
-
+@app.get("/health/ready")
+def health_ready():
+    # Readiness probe: 503 until the lifespan and the warm-up have finished; the body is the startup report
+    return JSONResponse(startup_report.report(), status_code=200 if startup_report.ready else 503)
+
+@app.get("/api/db-stats")
+def db_stats():
+    return db.stats()
+
+@app.get("/api/cache-stats")
+def cache_stats():
+    from hybrid_retrieval import hybrid_stats
+    from query_embedding import query_embedding_cache_stats
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "query_embedding_cache": query_embedding_cache_stats(),
+        "history_cache": history_cache.stats(),
+        "hybrid_retrieval": hybrid_stats.stats(),
+        "web_search_cache": web_search_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+    }
+
+@app.get("/api/scheduler-stats")
+def scheduler_stats():
+    return {
+        "embedding": embedding_scheduler.stats(),
+    }
+
+@app.get("/api/admission-stats")
+def get_admission_stats():
+    # Slots in use, queue depth and wait times per limiter, for tuning the limits
+    return {
+        **admission_stats(),
+        "index_jobs": index_jobs.stats(),
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # Prometheus scrape target: stage latency histograms, pool utilization, cache statistics
+    return PlainTextResponse(render_metrics(db.stats(), cache_stats(), scheduler_stats(), get_admission_stats()), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/checkpoint-retention")
+def checkpoint_retention_stats():
+    return checkpoint_retention.stats()
+
+@app.post("/api/checkpoint-retention/run")
+async def run_checkpoint_retention(request: CheckpointRetentionRequest):
+    # Manual pass; dry run unless asked otherwise
+    try:
+        return await checkpoint_retention.run_once(dry_run=request.dry_run, compact=request.compact)
+    except Exception as e:
+        print(f"Error pruning checkpoints: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/index-file")
+@app.post("/api/index-file", status_code=202)
 async def index_file(request: IndexFileRequest):
+    # Indexing runs as a background job; poll /api/index-jobs/{job_id} for progress
     try:
-        print(f"Downloading {request.file_url}...")
-        # download file from uploadthing
-        response = requests.get(request.file_url)
-        response.raise_for_status()
-        
-        # extract text from file (in memory)
-        # SimpleDirectoryReader can only read from disk (not from memory)
-        # so it's only really used for hobby/tutorial projects
-        extracted_text = load_file_from_memory(response.content, request.file_name)
-        
-        # We perform the NUL byte cleaning here once (for postgres/pgvector)
-        clean_text = extracted_text.replace("\x00", "")
-        
-        # # create llamaindex document
-        # new_doc = Document(
-        #     text=clean_text,
-            # metadata={
-            #     "conversation_id": request.conversation_id,
-            #     "file_id": request.file_id,
-            #     "file_name": request.file_name,
-            #     "file_url": request.file_url,
-            # })
-        
-        # # Index
-        # vector_store = get_vector_store()
-        # storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        # VectorStoreIndex.from_documents([new_doc], storage_context=storage_context)
-        
-        # 1. Create Base Document
-        base_doc = Document(text=clean_text, metadata={
-                "conversation_id": request.conversation_id,
-                "file_id": request.file_id,
-                "file_name": request.file_name,
-                "file_url": request.file_url,
-            })
-
-        # 2. Manually Split into Nodes (Chunks) so that we can add custom message to each chunk
-        parser = SentenceSplitter()
-        nodes = parser.get_nodes_from_documents([base_doc])
-
-        # 3. Modify Every Node
-        for node in nodes:
-            # Prepend your custom sentence to the actual text content of every chunk
-            node.text = f"The user uploaded a file called '{request.file_name}'. The following is a chunk of the file '{request.file_name}':\n\n{node.text}"
-
-        # 4. Index the Nodes directly
-        vector_store = get_vector_store()
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        VectorStoreIndex(nodes, storage_context=storage_context) # use VectorStoreIndex(...) not .from_documents
-
-        return {"status": "success", "message": f"Indexed {request.file_name}"}
+        job = await index_jobs.submit(request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "queued", "job_id": job.id, "message": f"Queued {request.file_name} for indexing"}
+
+@app.post("/api/update-file", status_code=202)
+async def update_file(request: IndexFileRequest):
+    # New version of an indexed file: only changed chunks are embedded, removed ones deleted
+    try:
+        job = await index_jobs.submit(request, mode="update")
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "queued", "job_id": job.id, "message": f"Queued {request.file_name} for updating"}
 
+@app.get("/api/index-jobs/{job_id}")
+async def get_index_job(job_id: str):
+    try:
+        job = await index_jobs.get(job_id)
+    except Exception as e:
+        print(f"Error fetching index job: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Index job {job_id} not found")
+    return job
+
+@app.post("/api/index-files")
+async def index_files(request: IndexFilesRequest):
+    from indexing import run_index_pipeline, INDEX_MAX_FILES
+    if len(request.files) > INDEX_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {INDEX_MAX_FILES} files per request")
+    try:
+        async with index_files_limiter.slot():
+            results = await run_index_pipeline(request.files)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    failed = sum(1 for r in results if r["status"] == "error")
+    if failed == 0:
+        status = "success"
+    elif failed == len(results):
+        status = "error"
+    else:
+        status = "partial"
+    return {"status": status, "results": results}
+
 @app.post("/api/delete-file")
 def delete_file(request: DeleteFileRequest):
     try:
-        delete_file_by_id(request.file_id)
+        delete_file_by_id(request.file_id, request.conversation_id)
+        retrieval_cache.invalidate(request.conversation_id)
+        answer_cache.invalidate(request.conversation_id)
         return {"status": "success", "message": f"Deleted file {request.file_id}"}
     except Exception as e:
         print(f"Error deleting file: {e}")
@@ -248,6 +287,8 @@ def delete_file(request: DeleteFileRequest):
 def delete_conversation(request: DeleteConversationRequest):
     try:
         delete_conversation_by_id(request.conversation_id)
+        retrieval_cache.invalidate(request.conversation_id)
+        answer_cache.invalidate(request.conversation_id)
         return {"status": "success", "message": f"Deleted conversation {request.conversation_id}"}
     except Exception as e:
         print(f"Error deleting conversation: {e}")
@@ -255,89 +296,138 @@ def delete_conversation(request: DeleteConversationRequest):
 
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
+    from agent import format_chat_response, RagContext
     try:
-        # 1. Retrieve the checkpointer from app.state
-        checkpointer = app.state.checkpointer
-        
-        # 2. Pass it to the agent creator
-        agent = create_rag_agent(request.conversation_id, checkpointer)
+        # 1. Get the cached agent (built once with the Postgres checkpointer)
+        agent = get_rag_agent()
         
-        # 3. Thread ID is CRITICAL for persistence
+        # 2. Thread ID is CRITICAL for persistence
         config = {"configurable": {"thread_id": request.conversation_id}}
         
-        # 4. Await the invoke (since AsyncPostgresSaver is async)
+        # 3. Await the invoke (since AsyncPostgresSaver is async)
         # Note: LangGraph's invoke can be sync or async. 
         # Since we use AsyncPostgresSaver, we should use `ainvoke` (async invoke).
-        response = await agent.ainvoke(
-            {"messages": [{"role": "user", "content": request.message}]},
-            config=config,
-        )
-        
-        structured_res = response.get('structured_response')
-        if structured_res:
-            return {
-                "answer": structured_res.final_answer,
-                "sources": "internet" if structured_res.did_search_internet else "documents" 
-            }
+        # The conversation goes in the runtime context so search_documents filters on it.
+        # Admission first: one turn per conversation at a time (they share the
+        # checkpointer thread), and a bounded number of turns overall.
+        async with admit_chat(request.conversation_id):
+            # 4. A repeated question against the same files reuses the earlier answer (opt-in)
+            answer, lookup = await cached_answer(agent, config, request.conversation_id, request.message)
+            if answer is not None:
+                return JSONResponse(answer, headers={"X-Answer-Cache": "hit"})
+
+            with span("chat.total"):
+                response = await agent.ainvoke(
+                    {"messages": [{"role": "user", "content": request.message}]},
+                    config=config,
+                    context=RagContext(conversation_id=request.conversation_id),
+                )
         
-        return {"answer": "Error: Could not generate a structured response."}
+        return remember_answer(lookup, format_chat_response(response))
 
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Error in chat: {e}")
         # In production, check logs to see if it's a DB connection error
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Same as /api/chat, but streams agent events over SSE while the run is in progress.
+    """
+    from agent import format_chat_response, RagContext, ResponseFormat
+    try:
+        agent = get_rag_agent()
+    except Exception as e:
+        print(f"Error in chat: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # Admitted before the response starts, so a rejection is still a plain 429/503.
+    # The slots are held until the stream ends (or the client goes away).
+    try:
+        admission = await admit_chat(request.conversation_id).acquire()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    # Until the StreamingResponse owns the slots, anything that escapes (including
+    # CancelledError when the client disconnects, which isn't an Exception) releases them
+    try:
+        config = {"configurable": {"thread_id": request.conversation_id}}
+        answer, lookup = await cached_answer(agent, config, request.conversation_id, request.message)
+        if answer is not None:
+            events = cached_answer_stream(answer)
+        else:
+            events = agent_event_stream(
+                agent,
+                {"messages": [{"role": "user", "content": request.message}]},
+                config,
+                RagContext(conversation_id=request.conversation_id),
+                answer_tool_name=ResponseFormat.__name__,
+                build_final=lambda values: remember_answer(lookup, format_chat_response(values)),
+            )
+
+        async def admitted_events():
+            try:
+                async for event in events:
+                    yield event
+            finally:
+                admission.release()
+
+        return StreamingResponse(
+            admitted_events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # Backstop for a response that never started streaming; release() is idempotent
+            background=BackgroundTask(admission.release),
+        )
+    except BaseException:
+        admission.release()
+        raise
+
 @app.get("/api/chat/{conversation_id}/history")
-async def get_chat_history(conversation_id: str):
+async def get_chat_history(
+    conversation_id: str,
+    # Omitted: the whole history (what the frontend loads); set it to page with `before`
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
     try:
         # 1. Get the checkpointer directly
         checkpointer = app.state.checkpointer
         config = {"configurable": {"thread_id": conversation_id}}
-        
-        # 2. Fetch the raw checkpoint from the database
-        # We DO NOT need to create the agent or vector store here.
-        # This bypasses the asyncpg connection entirely.
-        checkpoint = await checkpointer.aget(config)
-        
-        if not checkpoint:
-            return {"history": []}
-            
-        # 3. Extract messages from the checkpoint data
-        # 'channel_values' holds the state variables (like "messages")
-        messages = checkpoint.get("channel_values", {}).get("messages", [])
-        
-        history = []
-        for msg in messages:
-            # 1. Handle User Messages
-            if msg.type == "human":
-                history.append({
-                    "role": "user",
-                    "content": msg.content
-                })
-            
-            # 2. Handle AI Messages
-            elif msg.type == "ai":
-                content_to_show = msg.content
-                
-                # Extract Structured Output (Hidden content)
-                if not content_to_show and hasattr(msg, 'tool_calls') and msg.tool_calls:
-                    for tool_call in msg.tool_calls:
-                        args = tool_call.get("args", {})
-                        if "final_answer" in args:
-                            content_to_show = args["final_answer"]
-                            break
-                
-                if content_to_show:
-                    history.append({
-                        "role": "assistant",
-                        "content": content_to_show
-                    })
-        
-        return {"history": history}
+
+        # 2. Look up the latest checkpoint id only. If the client already has
+        # this page of this checkpoint, answer 304 without loading any messages.
+        checkpoint_id = await latest_checkpoint_id(checkpointer, config)
+        if checkpoint_id is None:
+            return {"history": [], "next_before": None}
+
+        etag = history_etag(checkpoint_id, limit, before)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        # 3. Extract the human/assistant turns from the checkpoint
+        # (once per checkpoint, older pages reuse them)
+        cache_key = (conversation_id, checkpoint_id)
+        turns = history_cache.get(cache_key)
+        if turns is None:
+            config["configurable"]["checkpoint_id"] = checkpoint_id
+            with span("history.load"):
+                checkpoint = await checkpointer.aget(config)
+            # 'channel_values' holds the state variables (like "messages")
+            messages = (checkpoint or {}).get("channel_values", {}).get("messages", [])
+            turns = message_turns(messages)
+            history_cache.put(cache_key, turns)
+
+        return JSONResponse(paginate(turns, limit, before), headers=headers)
 
     except Exception as e:
         print(f"Error fetching history: {e}")
-        return {"history": []}
+        return {"history": [], "next_before": None}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,199 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Add a Server-Timing header (and a log line) with the stage breakdown of every request
+DEBUG_TIMINGS = os.getenv("DEBUG_TIMINGS", "false").lower() == "true"
+
+# Seconds; covers a cached lookup (ms) up to a large PDF being embedded (minutes)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Tokens; one search_documents result is a few hundred to a few thousand
+TOKEN_BUCKETS = (0, 50, 100, 250, 500, 1000, 1500, 2000, 3000, 5000, 8000, 15000)
+
+# Stages recorded during the current request, when a breakdown was asked for
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Prometheus histogram with a single label, rendered in the text exposition format.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets: tuple = STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            # Non-cumulative here, summed up in render(); slower than the last bound only counts in +Inf
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{_number(bound)}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {_number(values[-2])}")
+            lines.append(f"{self.name}_count{{{label}}} {values[-1]}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+stage_seconds = Histogram(
+    "paperparrot_stage_duration_seconds",
+    "Time spent in one stage of a request (index.download, chat.llm, ...).",
+    "stage",
+)
+
+context_tokens = Histogram(
+    "paperparrot_context_tokens",
+    "Tokens of one search_documents result: retrieved, packed (sent to the model) and saved by packing.",
+    "kind",
+    buckets=TOKEN_BUCKETS,
+)
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Times the block into the stage histogram, and into the request's
+    breakdown when collect_timings() is active.
+    Works in coroutines and in worker threads (the context is copied there).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(stage, elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects every span() finished inside the block (including in tasks and
+    threads started from it) into the yielded list of (stage, seconds).
+    """
+    timings = []
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def timing_breakdown(timings: list) -> dict:
+    """
+    Total milliseconds per stage, in the order stages first finished.
+    """
+    breakdown = {}
+    for stage, seconds in timings:
+        breakdown[stage] = breakdown.get(stage, 0.0) + seconds * 1000
+    return breakdown
+
+
+def server_timing_header(timings: list) -> str:
+    return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in timing_breakdown(timings).items())
+
+
+# Statistics that only ever go up (per process): exported as Prometheus counters
+# (`_total` suffix) so rate()/increase() work. Every other numeric statistic is a gauge.
+COUNTER_STATS = frozenset({
+    # caches
+    "hits", "misses", "semantic_hits", "persistent_hits", "evicted", "evictions", "invalidations",
+    "searches", "coalesced", "errors", "lexical_only", "fused",
+    # embedding scheduler
+    "batches", "texts", "tokens", "rate_limited", "retries", "failures", "slow_batches",
+    # admission control
+    "admitted", "rejected", "rejected_full", "rejected_timeout", "wait_seconds_total",
+    # psycopg pool (get_stats() is cumulative)
+    "requests_num", "requests_queued", "requests_wait_ms", "requests_errors", "returns_bad",
+    "connections_num", "connections_ms", "connections_errors", "connections_lost", "usage_ms",
+})
+
+
+def samples(name: str, help: str, label: str, values: dict, kind: str = "gauge") -> list:
+    """
+    One sample per label value; values that aren't numbers are skipped.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for label_value, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f'{name}{{{label}="{_escape(label_value)}"}} {_number(value)}')
+    return lines if len(lines) > 2 else []
+
+
+def stat_families(prefix: str, what: str, label: str, stats: dict) -> list:
+    """
+    One metric per statistic key of {label value: {key: value}}: a counter named
+    <prefix>_<key>_total for COUNTER_STATS, a gauge named <prefix>_<key> otherwise.
+    """
+    lines = []
+    for key in sorted({key for values in stats.values() for key in values}):
+        values = {name: values.get(key) for name, values in stats.items()}
+        if key in COUNTER_STATS:
+            name = f"{prefix}_{key}" if key.endswith("_total") else f"{prefix}_{key}_total"
+            lines += samples(name, f"{what} {key}.", label, values, "counter")
+        else:
+            lines += samples(f"{prefix}_{key}", f"{what} {key}.", label, values, "gauge")
+    return lines
+
+
+def render_metrics(db_stats: dict, cache_stats: dict, scheduler_stats: dict = None,
+                   admission_stats: dict = None) -> str:
+    """
+    Prometheus text format: stage and context token histograms, pool utilization (from
+    DatabaseManager.stats()), every numeric cache statistic (from /api/cache-stats),
+    scheduler statistics ({scheduler name: stats}) and admission statistics
+    ({limiter name: stats}, queue depth and wait times). Counts that only go up
+    are counters, current values (sizes, in-flight, rates) are gauges.
+    """
+    lines = stage_seconds.render() + context_tokens.render()
+
+    pools = {name: stats for name, stats in db_stats.items() if isinstance(stats, dict) and name != "limits"}
+    lines += stat_families("paperparrot_db_pool", "Connection pool statistic", "pool", pools)
+    lines += samples("paperparrot_db_pool_limit", "Connections each pool may hold.", "pool", db_stats.get("limits", {}))
+    lines += stat_families("paperparrot_cache", "Cache statistic", "cache", cache_stats)
+    lines += stat_families("paperparrot_scheduler", "Scheduler statistic", "scheduler", scheduler_stats or {})
+    lines += stat_families("paperparrot_admission", "Admission control statistic", "limiter", admission_stats or {})
+    return "\n".join(lines) + "\n"
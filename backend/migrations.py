@@ -0,0 +1,760 @@
+import os
+import sys
+import time
+import hashlib
+import asyncio
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+from sqlalchemy import text, column, literal_column, bindparam
+from sqlalchemy.exc import OperationalError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# HNSW build parameters. Changing them only affects new builds: run
+# `python migrations.py migrate --rebuild-hnsw` to rebuild an existing index.
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+# Candidate list size per query. Filtered queries drop candidates from other
+# conversations after the scan, so keep this well above similarity_top_k.
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "100"))
+# Rows updated per backfill transaction
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+# Postgres text search configuration of the lexical (full-text) index
+TEXT_SEARCH_CONFIG = os.getenv("TEXT_SEARCH_CONFIG", "english")
+# Run pending migrations in a background task after startup instead of only reporting
+# them. Off by default: backfills and index builds on a large table take a long time,
+# so normally they are run with `python migrations.py migrate` before deploying.
+SCHEMA_AUTO_MIGRATE = os.getenv("SCHEMA_AUTO_MIGRATE", "false").lower() == "true"
+# Only one process migrates at a time (replicas starting together, the CLI)
+MIGRATION_LOCK_ID = 72_014_002
+
+# LlamaIndex adds the "data_" prefix to db.VECTOR_TABLE_NAME
+EMBEDDINGS_TABLE = "data_paperparrot_embeddings"
+MIGRATIONS_TABLE = "paperparrot_schema_migrations"
+# Columns promoted out of metadata_ so filters and deletes can use a btree index
+FILTER_COLUMNS = ("conversation_id", "file_id")
+# Partition key of the optional partitioned layout. An expression (not the
+# conversation_id column) because rows are routed before the trigger fills the
+# column, and it's exactly what the metadata filter renders, so both prune.
+PARTITION_KEY = "(metadata_->>'conversation_id')"
+
+
+def hnsw_kwargs() -> dict:
+    """
+    hnsw_kwargs for PGVectorStore. The store creates the same index (same name,
+    IF NOT EXISTS) when it creates a new table, and sets ef_search per query.
+    """
+    return {
+        "hnsw_m": HNSW_M,
+        "hnsw_ef_construction": HNSW_EF_CONSTRUCTION,
+        "hnsw_ef_search": HNSW_EF_SEARCH,
+        "hnsw_dist_method": "vector_cosine_ops",
+    }
+
+
+def hnsw_index_name(table: str = EMBEDDINGS_TABLE) -> str:
+    return f"{table}_embedding_idx"
+
+
+def filter_by_columns(stmt, table_class, conversation_id: str = None, file_id: str = None,
+                      partitioned: bool = False, **kwargs):
+    """
+    PGVectorStore customize_query_fn: filters on the indexed columns instead of
+    metadata_->>'...'. The values come from the retriever's vector_store_kwargs.
+    On the partitioned layout the partition key is filtered on instead, so the
+    planner only scans that conversation's partition.
+    """
+    if conversation_id is not None and partitioned:
+        stmt = stmt.where(literal_column(PARTITION_KEY) == bindparam("partition_key", conversation_id))
+    elif conversation_id is not None:
+        stmt = stmt.where(column("conversation_id") == conversation_id)
+    if file_id is not None:
+        stmt = stmt.where(column("file_id") == file_id)
+    return stmt
+
+
+def _autocommit(engine):
+    # CREATE/DROP INDEX CONCURRENTLY can't run inside a transaction
+    return engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+
+def _table_exists(conn, table: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:t) IS NOT NULL"), {"t": table}).scalar()
+
+
+def _index_state(conn, index: str):
+    """
+    Returns None if the index doesn't exist, otherwise (is_valid, reloptions).
+    """
+    row = conn.execute(text("""
+        SELECT i.indisvalid, c.reloptions
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+        WHERE c.oid = to_regclass(:idx)
+    """), {"idx": index}).first()
+    if row is None:
+        return None
+    options = dict(opt.split("=", 1) for opt in row.reloptions or [])
+    return row.indisvalid, options
+
+
+def _applied(conn) -> set:
+    if not _table_exists(conn, MIGRATIONS_TABLE):
+        return set()
+    return set(conn.execute(text(f"SELECT name FROM {MIGRATIONS_TABLE}")).scalars())
+
+
+def _is_partitioned(conn, table: str) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"
+    ), {"t": table}).scalar()
+
+
+def _insert_columns(conn, table: str) -> str:
+    """
+    Column list for copying rows between tables with the same layout. Generated
+    columns (e.g. a tsvector) are left out: the target recomputes them.
+    """
+    return ", ".join(conn.execute(text("""
+        SELECT quote_ident(column_name) FROM information_schema.columns
+        WHERE table_name = :t AND is_generated = 'NEVER' ORDER BY ordinal_position
+    """), {"t": table}).scalars())
+
+
+def _literal(value: str) -> str:
+    # DDL can't take bind parameters (FOR VALUES IN (...))
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _record(conn, name: str):
+    conn.execute(text(f"""
+        INSERT INTO {MIGRATIONS_TABLE} (name) VALUES (:name)
+        ON CONFLICT (name) DO UPDATE SET applied_at = now()
+    """), {"name": name})
+
+
+def _create_index_concurrently(conn, index: str, table: str, definition: str):
+    # A failed concurrent build leaves an INVALID index behind that IF NOT EXISTS would keep
+    state = _index_state(conn, index)
+    if state is not None and not state[0]:
+        print(f"Dropping invalid index {index}")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}"))
+    # Partitioned tables don't support CONCURRENTLY (the build blocks writes while it runs)
+    concurrently = "" if _is_partitioned(conn, table) else "CONCURRENTLY "
+    conn.execute(text(f"CREATE INDEX {concurrently}IF NOT EXISTS {index} ON {table} {definition}"))
+
+
+def _trigger_function(conn, table: str, text_search: bool):
+    """
+    (Re)creates the BEFORE INSERT trigger function that derives the extra
+    columns from what PGVectorStore writes (metadata_ and text).
+    """
+    text_search_line = (
+        f"NEW.text_search_tsv := to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(NEW.text, ''));"
+        if text_search else ""
+    )
+    conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION {table}_filter_columns() RETURNS trigger AS $$
+        BEGIN
+            NEW.conversation_id := NEW.metadata_->>'conversation_id';
+            NEW.file_id := NEW.metadata_->>'file_id';
+            {text_search_line}
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """))
+
+
+def _backfill(engine, table: str, assignments: str, needs_update: str, batch_size: int, label: str) -> int:
+    """
+    Runs `UPDATE table SET assignments` for rows matching needs_update. Walks
+    the primary key in ranges, one short transaction per batch, so it never
+    holds locks on the whole table. Returns rows updated.
+    """
+    with engine.connect() as conn:
+        max_id = conn.execute(text(f"SELECT coalesce(max(id), 0) FROM {table}")).scalar()
+
+    updated = 0
+    start = 0
+    while start < max_id:
+        stop = start + batch_size
+        with engine.begin() as conn:
+            result = conn.execute(text(
+                f"UPDATE {table} SET {assignments} WHERE id > :start AND id <= :stop AND ({needs_update})"
+            ), {"start": start, "stop": stop})
+            updated += result.rowcount
+        start = stop
+        print(f"Backfilled {label} of {table} up to id {min(stop, max_id)}/{max_id}")
+    return updated
+
+
+# --- Steps (each one is idempotent and recorded in MIGRATIONS_TABLE) ---
+
+def add_filter_columns(engine, table: str = EMBEDDINGS_TABLE):
+    """
+    Adds conversation_id/file_id and a trigger that fills them from metadata_,
+    so rows written by PGVectorStore (which only knows metadata_) get them too.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS conversation_id TEXT,
+            ADD COLUMN IF NOT EXISTS file_id TEXT
+        """))
+        _trigger_function(conn, table, text_search=False)
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_filter_columns ON {table}"))
+        conn.execute(text(f"""
+            CREATE TRIGGER {table}_filter_columns
+            BEFORE INSERT OR UPDATE OF metadata_ ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_filter_columns()
+        """))
+
+
+def backfill_filter_columns(engine, table: str = EMBEDDINGS_TABLE, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """
+    Copies conversation_id/file_id out of metadata_ for rows written before the trigger existed.
+    """
+    return _backfill(
+        engine, table,
+        "conversation_id = metadata_->>'conversation_id', file_id = metadata_->>'file_id'",
+        "conversation_id IS DISTINCT FROM metadata_->>'conversation_id' "
+        "OR file_id IS DISTINCT FROM metadata_->>'file_id'",
+        batch_size, "filter columns",
+    )
+
+
+def create_filter_indexes(engine, table: str = EMBEDDINGS_TABLE):
+    with _autocommit(engine) as conn:
+        for name in FILTER_COLUMNS:
+            _create_index_concurrently(conn, f"{table}_{name}_idx", table, f"({name})")
+
+
+def create_hnsw_index(engine, table: str = EMBEDDINGS_TABLE, m: int = HNSW_M,
+                      ef_construction: int = HNSW_EF_CONSTRUCTION, rebuild: bool = False):
+    """
+    Builds the HNSW index without blocking writes. With rebuild=True an existing
+    index is replaced by one built with the current m/ef_construction: the new one
+    is built under a temporary name first, so queries always have an index.
+    """
+    index = hnsw_index_name(table)
+    definition = (
+        f"USING hnsw (embedding vector_cosine_ops) "
+        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    )
+    with _autocommit(engine) as conn:
+        if not rebuild or _index_state(conn, index) is None:
+            _create_index_concurrently(conn, index, table, definition)
+            return
+        tmp = f"{index}_new"
+        _create_index_concurrently(conn, tmp, table, definition)
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}"))
+        conn.execute(text(f"ALTER INDEX {tmp} RENAME TO {index}"))
+
+
+def add_text_search_column(engine, table: str = EMBEDDINGS_TABLE):
+    """
+    Adds a tsvector of each chunk's text for the lexical side of hybrid retrieval.
+    A plain column filled by the insert trigger rather than a generated column:
+    adding a stored generated column would rewrite the whole table under an
+    exclusive lock, this one is backfilled in batches instead.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS text_search_tsv TSVECTOR"))
+        _trigger_function(conn, table, text_search=True)
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_filter_columns ON {table}"))
+        conn.execute(text(f"""
+            CREATE TRIGGER {table}_filter_columns
+            BEFORE INSERT OR UPDATE OF metadata_, text ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_filter_columns()
+        """))
+
+
+def backfill_text_search(engine, table: str = EMBEDDINGS_TABLE, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    return _backfill(
+        engine, table,
+        f"text_search_tsv = to_tsvector('{TEXT_SEARCH_CONFIG}', coalesce(text, ''))",
+        "text_search_tsv IS NULL",
+        batch_size, "text search vectors",
+    )
+
+
+def create_text_search_index(engine, table: str = EMBEDDINGS_TABLE):
+    with _autocommit(engine) as conn:
+        _create_index_concurrently(conn, f"{table}_text_search_idx", table, "USING gin (text_search_tsv)")
+
+
+# --- Optional layout: one list partition per conversation ---
+
+# Partitions this process has already created (saves a catalog lookup per insert batch).
+# Partitions are only dropped by `drop-empty-partitions`; if another process did that,
+# a stale entry only means the conversation's rows land in the default partition.
+_known_partitions = set()
+
+
+def partition_name(conversation_id: str, table: str = EMBEDDINGS_TABLE) -> str:
+    return f"{table}_p_{hashlib.sha1(conversation_id.encode()).hexdigest()[:16]}"
+
+
+def ensure_conversation_partition(engine, conversation_id: str, table: str = EMBEDDINGS_TABLE):
+    """
+    Creates the conversation's partition before its first rows are inserted
+    (they would land in the default partition otherwise). The partition is
+    built as a plain table and then attached: CREATE TABLE ... PARTITION OF
+    takes an ACCESS EXCLUSIVE lock on the parent, which would block retrieval
+    for every conversation, while ATTACH PARTITION only takes SHARE UPDATE
+    EXCLUSIVE (reads and writes go on) plus a short lock on the default
+    partition, which it checks for rows of the conversation. Indexes and the
+    filter-column trigger are cloned from the parent on attach.
+    """
+    name = partition_name(conversation_id, table)
+    if name in _known_partitions:
+        return
+    with engine.begin() as conn:
+        # Replicas indexing the conversation's first files at once create it only once
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+        if not _table_exists(conn, name):
+            conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)"))
+            # Rows already in the default partition would block the attach: move them over
+            columns = _insert_columns(conn, table)
+            conn.execute(text(f"""
+                WITH moved AS (
+                    DELETE FROM {table}_default WHERE {PARTITION_KEY} = :cid RETURNING {columns}
+                )
+                INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+            """), {"cid": conversation_id})
+            conn.execute(text(
+                f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES IN ({_literal(conversation_id)})"
+            ))
+    _known_partitions.add(name)
+
+
+def drop_conversation_partition(conn, conversation_id: str, table: str = EMBEDDINGS_TABLE):
+    """
+    Deletes a conversation's embeddings by truncating its partition: no
+    row-by-row delete, no dead tuples left for vacuum, and only that partition
+    is locked (detaching it would lock the parent, and CONCURRENTLY isn't
+    allowed with a default partition). The empty partition stays attached;
+    `drop-empty-partitions` removes those in a maintenance window. Runs in the
+    caller's transaction so it commits together with the checkpoint deletes.
+    """
+    name = partition_name(conversation_id, table)
+    if _table_exists(conn, name):
+        conn.execute(text(f"TRUNCATE {name}"))
+    # Stray rows routed to the default partition (prunes to it, so it's cheap)
+    conn.execute(text(f"DELETE FROM {table} WHERE {PARTITION_KEY} = :cid"), {"cid": conversation_id})
+
+
+def drop_empty_partitions(engine, table: str = EMBEDDINGS_TABLE, lock_timeout: str = "2s") -> int:
+    """
+    Detaches and drops the partitions of deleted conversations (left empty by
+    drop_conversation_partition). Each DETACH briefly takes an ACCESS EXCLUSIVE
+    lock on the parent, so this is a maintenance task, not part of a request;
+    a partition whose lock isn't granted within lock_timeout is skipped.
+    """
+    with engine.connect() as conn:
+        partitions = list(conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:t) AND c.relname LIKE :prefix"
+        ), {"t": table, "prefix": f"{table}_p_%"}).scalars())
+
+    dropped = 0
+    for name in partitions:
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"SET LOCAL lock_timeout = {_literal(lock_timeout)}"))
+                # The lock DETACH needs anyway, taken first so no insert lands between the check and the drop
+                conn.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+                if conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+                    continue
+                conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            _known_partitions.discard(name)
+            dropped += 1
+        except OperationalError as e:
+            print(f"Skipped {name}: {e}")
+    print(f"Dropped {dropped} empty partitions of {table}")
+    return dropped
+
+
+def partition_by_conversation(engine, table: str = EMBEDDINGS_TABLE) -> dict:
+    """
+    Migrates the single embeddings table to the partitioned layout:
+    1. creates an empty partitioned copy (same columns, indexes and trigger)
+    2. logs deletes on the old table while copying, then copies it one
+       conversation (one partition) per transaction
+    3. swaps the tables in one short transaction that blocks writes (not reads)
+       while it copies the rows inserted and drops the rows deleted during step 2
+    The old table is kept as {table}_legacy until drop_legacy_table() is run.
+    Requires the filter-column migrations (the copy walks the conversation_id index).
+    Restart the app afterwards so it starts creating per-conversation partitions;
+    rows inserted in between land in the default partition and are moved into
+    their own partition when it is created.
+    """
+    new = f"{table}_partitioned"
+    legacy = f"{table}_legacy"
+    deleted_log = f"{table}_deleted_during_partitioning"
+    _known_partitions.clear()
+
+    with engine.begin() as conn:
+        if _is_partitioned(conn, table):
+            print(f"{table} is already partitioned")
+            return schema_status(engine, table)
+        if "backfill_filter_columns" not in _applied(conn):
+            raise RuntimeError("Run `python migrations.py migrate` before partitioning")
+        if _table_exists(conn, legacy):
+            raise RuntimeError(f"{legacy} exists, drop it before partitioning again")
+
+        # 1. Partitioned parent, sharing the old id sequence so ids are preserved
+        conn.execute(text(f"DROP TABLE IF EXISTS {new}"))
+        conn.execute(text(
+            f"CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED) "
+            f"PARTITION BY LIST ({PARTITION_KEY})"
+        ))
+        conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {new} DEFAULT"))
+        # Indexes on the parent are created on every partition; a unique id index
+        # isn't allowed when the partition key is an expression, so id gets a plain one
+        conn.execute(text(f"CREATE INDEX {new}_id_idx ON {new} (id)"))
+        conn.execute(text(f"CREATE INDEX {new}_file_id_idx ON {new} (file_id)"))
+        conn.execute(text(
+            f"CREATE INDEX {new}_embedding_idx ON {new} USING hnsw (embedding vector_cosine_ops) "
+            f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+        ))
+        text_search = "create_text_search_index" in _applied(conn)
+        if text_search:
+            conn.execute(text(f"CREATE INDEX {new}_text_search_idx ON {new} USING gin (text_search_tsv)"))
+        conn.execute(text(f"""
+            CREATE TRIGGER {table}_filter_columns
+            BEFORE INSERT OR UPDATE OF metadata_, text ON {new}
+            FOR EACH ROW EXECUTE FUNCTION {table}_filter_columns()
+        """))
+
+        # 2. Remember deletes made while the copy runs
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {deleted_log} (id BIGINT PRIMARY KEY)"))
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {deleted_log}() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {deleted_log} (id) VALUES (OLD.id) ON CONFLICT DO NOTHING;
+                RETURN OLD;
+            END
+            $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {deleted_log} ON {table}"))
+        conn.execute(text(f"""
+            CREATE TRIGGER {deleted_log} AFTER DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {deleted_log}()
+        """))
+        copied_up_to = conn.execute(text(f"SELECT coalesce(max(id), 0) FROM {table}")).scalar()
+        conversations = list(conn.execute(text(
+            f"SELECT DISTINCT conversation_id FROM {table} WHERE conversation_id IS NOT NULL"
+        )).scalars())
+
+        columns = _insert_columns(conn, table)
+
+    def copy(conn, where: str, params: dict):
+        conn.execute(text(
+            f"INSERT INTO {new} ({columns}) SELECT {columns} FROM {table} WHERE {where}"
+        ), params)
+
+    def create_partition(conn, conversation_id: str):
+        conn.execute(text(
+            f"CREATE TABLE {partition_name(conversation_id, new)} PARTITION OF {new} "
+            f"FOR VALUES IN ({_literal(conversation_id)})"
+        ))
+
+    for i, conversation_id in enumerate(conversations):
+        with engine.begin() as conn:
+            create_partition(conn, conversation_id)
+            copy(conn, "conversation_id = :cid AND id <= :max_id", {"cid": conversation_id, "max_id": copied_up_to})
+        if (i + 1) % 100 == 0 or i + 1 == len(conversations):
+            print(f"Copied {i + 1}/{len(conversations)} conversations into {new}")
+    with engine.begin() as conn:
+        copy(conn, "conversation_id IS NULL AND id <= :max_id", {"max_id": copied_up_to})
+
+    # 3. Swap
+    with engine.begin() as conn:
+        conn.execute(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+        for conversation_id in conn.execute(text(
+            f"SELECT DISTINCT conversation_id FROM {table} WHERE id > :max_id AND conversation_id IS NOT NULL"
+        ), {"max_id": copied_up_to}).scalars():
+            if not _table_exists(conn, partition_name(conversation_id, new)):
+                create_partition(conn, conversation_id)
+        copy(conn, "id > :max_id", {"max_id": copied_up_to})
+        conn.execute(text(f"DELETE FROM {new} WHERE id IN (SELECT id FROM {deleted_log})"))
+        conn.execute(text(f"DROP TRIGGER {deleted_log} ON {table}"))
+        conn.execute(text(f"DROP TABLE {deleted_log}"))
+        conn.execute(text(f"DROP FUNCTION {deleted_log}()"))
+
+        # The old table (and its indexes) move out of the way, the new ones take their names
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+        for name in FILTER_COLUMNS + ("text_search",):
+            conn.execute(text(f"ALTER INDEX IF EXISTS {table}_{name}_idx RENAME TO {legacy}_{name}_idx"))
+        conn.execute(text(f"ALTER INDEX IF EXISTS {hnsw_index_name(table)} RENAME TO {hnsw_index_name(legacy)}"))
+        conn.execute(text(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {legacy}_pkey"))
+        conn.execute(text(f"ALTER TABLE {new} RENAME TO {table}"))
+        for name in ("id", "file_id", "embedding") + (("text_search",) if text_search else ()):
+            conn.execute(text(f"ALTER INDEX {new}_{name}_idx RENAME TO {table}_{name}_idx"))
+        # Partitions were created under the temporary parent's prefix; partition_name() expects the final one
+        for name in conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:t) AND c.relname LIKE :prefix"
+        ), {"t": table, "prefix": f"{new}_p_%"}).scalars():
+            conn.execute(text(f"ALTER TABLE {name} RENAME TO {table}{name[len(new):]}"))
+        # Dropping the legacy table must not drop the id sequence with it
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": legacy}).scalar()
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+        _record(conn, "partition_by_conversation")
+
+    _known_partitions.clear()
+    with engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {table}"))
+    return schema_status(engine, table)
+
+
+def drop_legacy_table(engine, table: str = EMBEDDINGS_TABLE):
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {table}_legacy"))
+
+
+# --- Runner ---
+
+def schema_status(engine, table: str = EMBEDDINGS_TABLE) -> dict:
+    """
+    Cheap catalog-only check of the migration state (no table scans).
+    filter_columns / text_search are True once those columns are backfilled
+    and indexed, i.e. once the retriever and deletes can switch to them.
+    """
+    with engine.connect() as conn:
+        exists = _table_exists(conn, table)
+        partitioned = exists and _is_partitioned(conn, table)
+        applied = _applied(conn)
+        # Every row of a partition has the same conversation_id, so it only needs the file_id index
+        indexes = {
+            name: _index_state(conn, f"{table}_{name}_idx")
+            for name in (("file_id",) if partitioned else FILTER_COLUMNS)
+        }
+        hnsw = _index_state(conn, hnsw_index_name(table))
+        text_search_index = _index_state(conn, f"{table}_text_search_idx")
+
+    indexes_valid = exists and all(state is not None and state[0] for state in indexes.values())
+    return {
+        "table_exists": exists,
+        "partitioned": partitioned,
+        "applied": sorted(applied),
+        "filter_columns": indexes_valid and "backfill_filter_columns" in applied,
+        "text_search": bool(text_search_index and text_search_index[0]) and "backfill_text_search" in applied,
+        "hnsw": {
+            "exists": hnsw is not None,
+            "valid": bool(hnsw and hnsw[0]),
+            "m": int(hnsw[1].get("m", 16)) if hnsw else None,
+            "ef_construction": int(hnsw[1].get("ef_construction", 64)) if hnsw else None,
+            "configured": {"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION, "ef_search": HNSW_EF_SEARCH},
+        },
+    }
+
+
+@contextmanager
+def migration_lock(engine, wait: bool = True):
+    """
+    Holds the session-level migration advisory lock on a dedicated connection for
+    the block. Yields False (without waiting) if wait is off and another process has it.
+    """
+    with engine.connect() as conn:
+        if wait:
+            conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            acquired = True
+        else:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID}).scalar()
+        conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                conn.commit()
+
+
+def migrate(engine, vector_store=None, table: str = EMBEDDINGS_TABLE,
+            batch_size: int = MIGRATION_BATCH_SIZE, rebuild_hnsw: bool = False, wait: bool = True) -> dict:
+    """
+    Runs every pending step in order and returns the new schema_status.
+    Holds the migration lock throughout; with wait=False it returns the current
+    status (with "skipped" set) if another process is already migrating.
+    """
+    with migration_lock(engine, wait) as acquired:
+        if not acquired:
+            status = schema_status(engine, table)
+            status["skipped"] = "another process is migrating"
+            return status
+        return _migrate(engine, vector_store, table, batch_size, rebuild_hnsw)
+
+
+def _migrate(engine, vector_store, table: str, batch_size: int, rebuild_hnsw: bool) -> dict:
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """))
+        exists = _table_exists(conn, table)
+        partitioned = exists and _is_partitioned(conn, table)
+        applied = _applied(conn)
+
+    if partitioned and rebuild_hnsw:
+        raise ValueError("--rebuild-hnsw isn't supported on the partitioned layout")
+
+    if not exists:
+        if vector_store is None:
+            raise RuntimeError(f"{table} does not exist")
+        # New database: let PGVectorStore create the table (and its HNSW index, cheap while empty)
+        from rag_utils import vector_table_class
+        vector_table_class(vector_store)
+
+    steps = [
+        ("add_filter_columns", lambda: add_filter_columns(engine, table)),
+        ("backfill_filter_columns", lambda: backfill_filter_columns(engine, table, batch_size)),
+        ("create_filter_indexes", lambda: create_filter_indexes(engine, table)),
+        ("create_hnsw_index", lambda: create_hnsw_index(engine, table)),
+        ("add_text_search_column", lambda: add_text_search_column(engine, table)),
+        ("backfill_text_search", lambda: backfill_text_search(engine, table, batch_size)),
+        ("create_text_search_index", lambda: create_text_search_index(engine, table)),
+    ]
+    for name, step in steps:
+        if name in applied:
+            continue
+        started = time.perf_counter()
+        print(f"Running migration {name} on {table}")
+        step()
+        with engine.begin() as conn:
+            _record(conn, name)
+        print(f"Finished migration {name} in {time.perf_counter() - started:.1f}s")
+
+    if rebuild_hnsw:
+        create_hnsw_index(engine, table, rebuild=True)
+    elif not partitioned:
+        # Indexes dropped by hand (or left invalid by a killed build) are recreated.
+        # The partitioned layout gets its indexes from partition_by_conversation.
+        create_filter_indexes(engine, table)
+        create_hnsw_index(engine, table)
+        create_text_search_index(engine, table)
+    return schema_status(engine, table)
+
+
+def migrations_pending(status: dict) -> bool:
+    return not status["filter_columns"] or not status["text_search"] or not status["hnsw"]["valid"]
+
+
+def apply_schema_status(database, status: dict):
+    """
+    Turns on the column-based filters/deletes on the DatabaseManager once they
+    are usable; until then the JSON-path filters keep working.
+    """
+    database.filter_columns = status["filter_columns"]
+    database.partitioned = status["partitioned"]
+    database.text_search = status["text_search"]
+
+
+def check_schema(database) -> dict:
+    """
+    Startup check called from main.lifespan. Only reads the schema state (it
+    never migrates, so startup doesn't wait for a backfill) and reports pending
+    migrations; main starts migrate_in_background when SCHEMA_AUTO_MIGRATE is on.
+    """
+    status = schema_status(database.engine)
+    if migrations_pending(status):
+        action = "running them in the background" if SCHEMA_AUTO_MIGRATE else "run `python migrations.py migrate`"
+        print(f"Schema migrations pending ({action}): {status}")
+    hnsw = status["hnsw"]
+    if hnsw["exists"] and (hnsw["m"], hnsw["ef_construction"]) != (HNSW_M, HNSW_EF_CONSTRUCTION):
+        print(f"HNSW index was built with m={hnsw['m']}, ef_construction={hnsw['ef_construction']}; "
+              f"run `python migrations.py migrate --rebuild-hnsw` to apply the configured values")
+    apply_schema_status(database, status)
+    return status
+
+
+def _resolve(future: asyncio.Future, result=None, error: BaseException = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def migrate_in_background(database) -> dict:
+    """
+    Runs pending migrations after startup (SCHEMA_AUTO_MIGRATE) and switches the
+    DatabaseManager to the new columns when done. Skips if another replica holds
+    the migration lock; that replica's work is picked up on the next start.
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def run():
+        try:
+            result = migrate(database.engine, database.vector_store, wait=False)
+        except Exception as e:
+            # Bound now: `e` is unset once the except block ends, before the callback runs
+            loop.call_soon_threadsafe(functools.partial(_resolve, done, error=e))
+        else:
+            loop.call_soon_threadsafe(functools.partial(_resolve, done, result=result))
+
+    # A daemon thread, not to_thread: shutdown must not wait for a long backfill.
+    # Every step is safe to interrupt; the next run resumes (or rebuilds an invalid index).
+    threading.Thread(target=run, name="schema-migration", daemon=True).start()
+    try:
+        status = await done
+    except Exception as e:
+        print(f"Background schema migration failed: {e}")
+        return None
+    if "skipped" in status:
+        print(f"Background schema migration skipped: {status['skipped']}")
+    elif database.is_open:
+        apply_schema_status(database, status)
+    return status
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate the paperparrot embeddings table")
+    parser.add_argument("command", choices=["status", "migrate", "partition", "drop-legacy", "drop-empty-partitions"])
+    parser.add_argument("--table", default=EMBEDDINGS_TABLE)
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument("--rebuild-hnsw", action="store_true")
+    args = parser.parse_args(argv)
+
+    from db import db
+    await db.open()
+    try:
+        if args.command == "status":
+            status = await asyncio.to_thread(schema_status, db.engine, args.table)
+        elif args.command == "partition":
+            def partition():
+                with migration_lock(db.engine):
+                    return partition_by_conversation(db.engine, args.table)
+            status = await asyncio.to_thread(partition)
+        elif args.command == "drop-empty-partitions":
+            def drop_empty():
+                with migration_lock(db.engine):
+                    drop_empty_partitions(db.engine, args.table)
+            await asyncio.to_thread(drop_empty)
+            status = await asyncio.to_thread(schema_status, db.engine, args.table)
+        elif args.command == "drop-legacy":
+            def drop_legacy():
+                with migration_lock(db.engine):
+                    drop_legacy_table(db.engine, args.table)
+            await asyncio.to_thread(drop_legacy)
+            status = await asyncio.to_thread(schema_status, db.engine, args.table)
+        else:
+            status = await asyncio.to_thread(
+                migrate, db.engine, db.vector_store, args.table, args.batch_size, args.rebuild_hnsw
+            )
+        print(status)
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+import os
+import threading
+from array import array
+from dotenv import load_dotenv
+from pydantic import PrivateAttr
+
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from caches import TTLCache
+from embedding_cache import EmbeddingCache, embedding_cache, cache_key
+from metrics import span
+
+load_dotenv()
+
+# In-memory query embeddings kept for the retriever (~6 KB each for 1536 dims)
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+# Also read/write query embeddings in the Postgres cache table so they survive restarts
+QUERY_EMBEDDING_CACHE_PERSIST = os.getenv("QUERY_EMBEDDING_CACHE_PERSIST", "false").lower() == "true"
+
+
+def normalize_embedding_text(text: str) -> str:
+    """
+    Whitespace-normalized text; case is kept because it can change the embedding.
+    """
+    return " ".join(text.split())
+
+
+class CachedQueryEmbedding(BaseEmbedding):
+    """
+    Wraps the LlamaIndex embed model used by the retriever so repeated queries
+    (across all conversations) don't pay an embedding API round trip.
+    Query embeddings are kept in a bounded in-memory LRU, and optionally in the
+    Postgres embedding cache table (under a separate "query" key space).
+    Document embeddings go straight to the wrapped model.
+    """
+
+    inner: BaseEmbedding
+    persist: bool = False
+    _memory: TTLCache = PrivateAttr()
+    _persistent: EmbeddingCache = PrivateAttr()
+    _persistent_hits: int = PrivateAttr(default=0)
+
+    def __init__(self, inner: BaseEmbedding, max_entries: int = QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+                 persist: bool = QUERY_EMBEDDING_CACHE_PERSIST, persistent_cache: EmbeddingCache = None):
+        super().__init__(
+            inner=inner,
+            persist=persist,
+            model_name=getattr(inner, "model_name", type(inner).__name__),
+            embed_batch_size=inner.embed_batch_size,
+        )
+        # Embeddings never go stale for a given model, so entries only leave by LRU
+        self._memory = TTLCache(max_entries, ttl=float("inf"))
+        self._persistent = persistent_cache or embedding_cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedQueryEmbedding"
+
+    def _key(self, text: str) -> str:
+        return cache_key(f"{self.model_name}#query", text)
+
+    def _lookup(self, key: str):
+        cached = self._memory.get(key)
+        if cached is not None:
+            return list(cached)
+        if self.persist:
+            try:
+                found = self._persistent.get_many_sync([key]).get(key)
+            except Exception as e:
+                print(f"Query embedding cache lookup failed: {e}")
+                found = None
+            if found is not None:
+                self._persistent_hits += 1
+                self._remember(key, found, store=False)
+                return found
+        return None
+
+    def _remember(self, key: str, embedding: list, store: bool = True):
+        # array('f') is ~7x smaller than a list of Python floats
+        self._memory.put(key, array("f", embedding))
+        if store and self.persist:
+            try:
+                self._persistent.put_many_sync(f"{self.model_name}#query", {key: embedding})
+            except Exception as e:
+                print(f"Query embedding cache store failed: {e}")
+
+    def _get_query_embedding(self, query: str) -> list:
+        text = normalize_embedding_text(query)
+        key = self._key(text)
+        embedding = self._lookup(key)
+        if embedding is None:
+            with span("chat.query_embedding"):
+                embedding = self.inner.get_query_embedding(text)
+            self._remember(key, embedding)
+        return embedding
+
+    async def _alookup(self, key: str):
+        cached = self._memory.get(key)
+        if cached is not None:
+            return list(cached)
+        if self.persist:
+            try:
+                found = (await self._persistent.get_many([key])).get(key)
+            except Exception as e:
+                print(f"Query embedding cache lookup failed: {e}")
+                found = None
+            if found is not None:
+                self._persistent_hits += 1
+                self._memory.put(key, array("f", found))
+                return found
+        return None
+
+    async def _aremember(self, key: str, embedding: list):
+        self._memory.put(key, array("f", embedding))
+        if self.persist:
+            try:
+                await self._persistent.put_many(f"{self.model_name}#query", {key: embedding})
+            except Exception as e:
+                print(f"Query embedding cache store failed: {e}")
+
+    async def _aget_query_embedding(self, query: str) -> list:
+        # Same as _get_query_embedding, through the async (psycopg pool) cache API
+        text = normalize_embedding_text(query)
+        key = self._key(text)
+        embedding = await self._alookup(key)
+        if embedding is None:
+            with span("chat.query_embedding"):
+                embedding = await self.inner.aget_query_embedding(text)
+            await self._aremember(key, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> list:
+        return self.inner.get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> list:
+        return await self.inner.aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: list) -> list:
+        return self.inner.get_text_embedding_batch(texts)
+
+    async def _aget_text_embeddings(self, texts: list) -> list:
+        return await self.inner.aget_text_embedding_batch(texts)
+
+    def stats(self) -> dict:
+        stats = self._memory.stats()
+        stats["persist"] = self.persist
+        stats["persistent_hits"] = self._persistent_hits
+        return stats
+
+
+_query_embed_model = None
+_query_embed_model_lock = threading.Lock()
+
+
+def get_query_embed_model() -> CachedQueryEmbedding:
+    """
+    Process-wide cached wrapper around the global LlamaIndex embed model, built on first use.
+    """
+    global _query_embed_model
+    with _query_embed_model_lock:
+        if _query_embed_model is None:
+            _query_embed_model = CachedQueryEmbedding(Settings.embed_model)
+        return _query_embed_model
+
+
+def query_embedding_cache_stats() -> dict:
+    if _query_embed_model is None:
+        return {"entries": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+    return _query_embed_model.stats()
@@ -1,78 +1,193 @@
-import os
-from llama_index.vector_stores.postgres import PGVectorStore
-from llama_index.core import StorageContext, VectorStoreIndex
-from sqlalchemy import text, create_engine
-from dotenv import load_dotenv
+from sqlalchemy import text, insert
 
-load_dotenv()
+from db import get_db
+from metrics import span
+from migrations import EMBEDDINGS_TABLE, PARTITION_KEY, drop_conversation_partition, ensure_conversation_partition
+
+class FileChangedError(Exception):
+    pass
 
 def get_vector_store():
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise ValueError("DATABASE_URL not set")
-
-    # Use the constructor directly, passing the connection string
-    vector_store = PGVectorStore(
-        connection_string=db_url,
-        async_connection_string=db_url.replace("postgresql://", "postgresql+asyncpg://"),
-        table_name="paperparrot_embeddings",
-        embed_dim=1536,
-        cache_ok=True # Optimization for frequent queries
-    )
-    return vector_store
-
-def delete_file_by_id(file_id: str):
+    """
+    Returns the long-lived PGVectorStore owned by the process-wide DatabaseManager.
+    """
+    return get_db().vector_store
+
+def get_shared_index():
+    """
+    Returns the long-lived VectorStoreIndex built on top of the shared vector store.
+    """
+    return get_db().index
+
+def vector_table_class(vector_store):
+    """
+    The SQLAlchemy table class PGVectorStore maps rows with, creating the table
+    if needed. The only place that touches PGVectorStore internals
+    (_initialize, _table_class): they aren't public API, which is why
+    llama-index-vector-stores-postgres is pinned to a minor version in
+    requirements.txt. Check this helper when upgrading it.
+    """
+    vector_store._initialize()
+    return vector_store._table_class
+
+def filter_column(name: str) -> str:
+    """
+    SQL expression for a conversation_id/file_id filter: the indexed column once
+    migrations.check_schema has enabled it, the metadata_ JSON path before that.
+    """
+    if get_db().filter_columns:
+        return name
+    return f"metadata_->>'{name}'"
+
+def conversation_filter_sql() -> str:
+    """
+    SQL expression compared against a conversation id in hand-written queries:
+    the partition key on the partitioned layout (so only that partition is
+    scanned), otherwise the conversation_id column or JSON path.
+    """
+    if get_db().partitioned:
+        return PARTITION_KEY
+    return filter_column("conversation_id")
+
+def hybrid_search_available() -> bool:
+    """
+    True once the text_search_tsv column has been backfilled and indexed.
+    """
+    return get_db().text_search
+
+def conversation_retriever_kwargs(conversation_id: str) -> dict:
+    """
+    as_retriever kwargs that restrict retrieval to one conversation's nodes.
+    """
+    db = get_db()
+    if db.filter_columns:
+        # Picked up by migrations.filter_by_columns (the vector store's customize_query_fn)
+        return {"vector_store_kwargs": {"conversation_id": conversation_id, "partitioned": db.partitioned}}
+    from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
+    return {"filters": MetadataFilters(
+        filters=[ExactMatchFilter(key="conversation_id", value=conversation_id)]
+    )}
+
+def prepare_conversation_storage(conversation_id: str):
+    """
+    Called before inserting a conversation's nodes. On the partitioned layout
+    the conversation needs its own partition first; otherwise a no-op.
+    """
+    db = get_db()
+    if db.partitioned:
+        ensure_conversation_partition(db.engine, conversation_id)
+
+def file_filter_sql(conversation_id: str = None) -> str:
+    """
+    WHERE clause (params :fid, :cid) matching one file's rows. With the file's
+    conversation_id a partitioned table only scans that conversation's partition.
+    """
+    where = f"{filter_column('file_id')} = :fid"
+    if get_db().partitioned and conversation_id is not None:
+        where += f" AND {PARTITION_KEY} = :cid"
+    return where
+
+def delete_file_by_id(file_id: str, conversation_id: str = None):
     """
     Deletes all nodes associated with a specific file_id directly via SQL.
+    Pass the file's conversation_id so a partitioned table only scans that conversation's partition.
     """
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise ValueError("DATABASE_URL not set")
+    # Reuse the shared engine instead of opening a new pool per deletion
+    engine = get_db().engine
 
-    # 1. Create a fresh, temporary engine just for this deletion
-    # This is safer than trying to steal the engine from LlamaIndex
-    engine = create_engine(db_url)
+    with span("delete_file.vectors"), engine.begin() as conn:
+        # LlamaIndex adds the "data_" prefix automatically (EMBEDDINGS_TABLE has it)
+        stmt = text(f"DELETE FROM {EMBEDDINGS_TABLE} WHERE {file_filter_sql(conversation_id)}")
+        conn.execute(stmt, {"fid": file_id, "cid": conversation_id})
 
-    # 2. Connect and Delete
-    with engine.begin() as conn:
-        # NOTICE THE TABLE NAME CHANGE: "data_paperparrot_embeddings"
-        # LlamaIndex adds the "data_" prefix automatically.
-        stmt = text("DELETE FROM data_paperparrot_embeddings WHERE metadata_->>'file_id' = :fid")
-        conn.execute(stmt, {"fid": file_id})
-        
-    # Engine automatically closes here
+def file_chunk_rows(file_id: str, conversation_id: str = None) -> list:
+    """
+    Rows (id, chunk_hash, text, file_name, page_number) of every stored chunk of a file.
+    text is only returned for chunks stored before chunk hashes were (chunk_hash is NULL).
+    """
+    with get_db().engine.connect() as conn:
+        stmt = text(f"""
+            SELECT id, metadata_->>'chunk_hash' AS chunk_hash,
+                   CASE WHEN metadata_->>'chunk_hash' IS NULL THEN text END AS text,
+                   metadata_->>'file_name' AS file_name, metadata_->>'page_number' AS page_number
+            FROM {EMBEDDINGS_TABLE} WHERE {file_filter_sql(conversation_id)}
+        """)
+        return conn.execute(stmt, {"fid": file_id, "cid": conversation_id}).all()
+
+def replace_file_chunks(file_id: str, conversation_id: str, expected_ids: list, delete_ids: list, nodes: list):
+    """
+    Deletes the rows in delete_ids and inserts the (already embedded) nodes, in one transaction.
+    Raises FileChangedError, changing nothing, if the file's rows are no longer
+    expected_ids (another update or delete of the file got there first).
+    """
+    from llama_index.core.schema import MetadataMode
+    from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+    db = get_db()
+    vector_store = db.vector_store
+    table_class = vector_table_class(vector_store)
+    params = {"fid": file_id, "cid": conversation_id}
+    # On the partitioned layout every statement names the partition key, so only this conversation's partition is scanned
+    partition = f" AND {PARTITION_KEY} = :cid" if db.partitioned else ""
+
+    with db.engine.begin() as conn:
+        # Updates of the same file run one after the other
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:fid))"), params)
+        current = conn.execute(text(
+            f"SELECT id FROM {EMBEDDINGS_TABLE} WHERE {file_filter_sql(conversation_id)} FOR UPDATE"
+        ), params).scalars().all()
+        if sorted(current) != sorted(expected_ids):
+            raise FileChangedError(f"File {file_id} changed while it was being updated, try again")
+
+        if delete_ids:
+            conn.execute(text(f"DELETE FROM {EMBEDDINGS_TABLE} WHERE id = ANY(:ids){partition}"),
+                         {"ids": list(delete_ids), "cid": conversation_id})
+        if nodes:
+            # Same row PGVectorStore.add writes, but inside our transaction
+            conn.execute(insert(table_class), [
+                {
+                    "node_id": node.node_id,
+                    "embedding": node.get_embedding(),
+                    "text": node.get_content(metadata_mode=MetadataMode.NONE),
+                    "metadata_": node_to_metadata_dict(node, remove_text=True, flat_metadata=vector_store.flat_metadata),
+                }
+                for node in nodes
+            ])
 
 def delete_conversation_by_id(conversation_id: str):
     """
     Deletes all embeddings associated with a specific conversation_id.
     """
-    db_url = os.getenv("DATABASE_URL")
-    if not db_url:
-        raise ValueError("DATABASE_URL not set")
-
-    engine = create_engine(db_url)
+    db = get_db()
 
-    with engine.begin() as conn:
-        stmt = text("DELETE FROM data_paperparrot_embeddings WHERE metadata_->>'conversation_id' = :cid")
-        conn.execute(stmt, {"cid": conversation_id})
+    with db.engine.begin() as conn:
+        with span("delete_conversation.vectors"):
+            if db.partitioned:
+                # Truncate the conversation's partition instead of deleting row by row
+                drop_conversation_partition(conn, conversation_id)
+            else:
+                stmt = text(f"DELETE FROM {EMBEDDINGS_TABLE} WHERE {filter_column('conversation_id')} = :cid")
+                conn.execute(stmt, {"cid": conversation_id})
 
         # --- Delete LangGraph Checkpoints ---
         # The 'thread_id' in these tables corresponds to our 'conversation_id'
-        
-        # 1. checkpoints
-        stmt_checkpoints = text("DELETE FROM checkpoints WHERE thread_id = :cid")
-        conn.execute(stmt_checkpoints, {"cid": conversation_id})
+        with span("delete_conversation.checkpoints"):
+            # 1. checkpoints
+            stmt_checkpoints = text("DELETE FROM checkpoints WHERE thread_id = :cid")
+            conn.execute(stmt_checkpoints, {"cid": conversation_id})
 
-        # 2. checkpoint_blobs
-        stmt_blobs = text("DELETE FROM checkpoint_blobs WHERE thread_id = :cid")
-        conn.execute(stmt_blobs, {"cid": conversation_id})
+            # 2. checkpoint_blobs
+            stmt_blobs = text("DELETE FROM checkpoint_blobs WHERE thread_id = :cid")
+            conn.execute(stmt_blobs, {"cid": conversation_id})
 
-        # 3. checkpoint_writes
-        stmt_writes = text("DELETE FROM checkpoint_writes WHERE thread_id = :cid")
-        conn.execute(stmt_writes, {"cid": conversation_id})
+            # 3. checkpoint_writes
+            stmt_writes = text("DELETE FROM checkpoint_writes WHERE thread_id = :cid")
+            conn.execute(stmt_writes, {"cid": conversation_id})
 
 def get_storage_context(vector_store):
+    from llama_index.core import StorageContext
     return StorageContext.from_defaults(vector_store=vector_store)
 
 def get_index(vector_store):
+    from llama_index.core import VectorStoreIndex
     return VectorStoreIndex.from_vector_store(vector_store=vector_store)
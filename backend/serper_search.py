@@ -0,0 +1,37 @@
+import os
+import requests
+from dotenv import load_dotenv
+from pydantic import PrivateAttr
+from langchain_community.utilities import GoogleSerperAPIWrapper
+
+load_dotenv()
+
+# Point at a stub server in tests and benchmarks
+SERPER_BASE_URL = os.getenv("SERPER_BASE_URL", "https://google.serper.dev")
+SERPER_TIMEOUT = float(os.getenv("SERPER_TIMEOUT", "10"))
+
+
+class SerperSearch(GoogleSerperAPIWrapper):
+    """
+    GoogleSerperAPIWrapper with a configurable endpoint, a request timeout and
+    a keep-alive session, so repeated searches reuse one TLS connection.
+    """
+
+    base_url: str = SERPER_BASE_URL
+    timeout: float = SERPER_TIMEOUT
+    _session: requests.Session = PrivateAttr(default_factory=requests.Session)
+
+    def _google_serper_api_results(self, search_term: str, search_type: str = "search", **kwargs) -> dict:
+        headers = {
+            "X-API-KEY": self.serper_api_key or "",
+            "Content-Type": "application/json",
+        }
+        params = {
+            "q": search_term,
+            **{key: value for key, value in kwargs.items() if value is not None},
+        }
+        response = self._session.post(
+            f"{self.base_url.rstrip('/')}/{search_type}", headers=headers, params=params, timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
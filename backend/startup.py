@@ -0,0 +1,169 @@
+import os
+import time
+import asyncio
+import importlib
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from metrics import span
+
+load_dotenv()
+
+# Build what the first requests need (agent, tokenizer, vector store, DB connections)
+# in the background after startup; /health/ready answers 503 until it is done
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# Connections opened ahead of the first request in each SQLAlchemy engine
+WARMUP_DB_CONNECTIONS = int(os.getenv("WARMUP_DB_CONNECTIONS", "1"))
+# Modules the warm-up imports, in order. Each one is timed on its own, so the
+# report shows the heavy libraries first and then what our modules add on top.
+WARMUP_MODULES = (
+    "llama_index.core",
+    "llama_index.vector_stores.postgres",
+    "llama_index.embeddings.openai",
+    "langchain.agents",
+    "langchain_openai",
+    "fitz",
+    "agent",
+    "indexing",
+    "hybrid_retrieval",
+    "query_embedding",
+    "serper_search",
+)
+
+
+def process_age():
+    """
+    Seconds since the process started (Linux only, None elsewhere).
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name; starttime (field 22) is the 20th of them
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupReport:
+    """
+    Where the time between process start and readiness went: imports before
+    the app started, every lifespan step and every warm-up step (module imports included).
+    """
+
+    def __init__(self):
+        self.status = "starting"  # starting -> warming_up -> ready
+        self.steps = {}  # step -> seconds, in the order they ran
+        self.errors = {}  # step -> error, for warm-up steps that failed
+        self.seconds_to_ready = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def begin(self):
+        # Interpreter start + importing main, before the lifespan runs
+        age = process_age()
+        if age is not None:
+            self.steps["import"] = age
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            with span(f"startup.{name}"):
+                yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - started
+
+    def mark_ready(self):
+        self.status = "ready"
+        self.seconds_to_ready = process_age()
+        took = f" in {self.seconds_to_ready:.1f}s" if self.seconds_to_ready is not None else ""
+        print(f"Ready{took}: {self.report()['steps_ms']}")
+
+    def report(self) -> dict:
+        return {
+            "status": self.status,
+            "seconds_to_ready": self.seconds_to_ready,
+            "steps_ms": {name: round(seconds * 1000, 1) for name, seconds in self.steps.items()},
+            "errors": dict(self.errors),
+        }
+
+
+# Process-wide report, filled in by main.lifespan and warm_up
+startup_report = StartupReport()
+
+
+async def _run_step(name: str, fn, *args):
+    """
+    Runs one warm-up step in a worker thread (imports and client setup are
+    CPU bound). A failed step is only reported: whatever it was building is built on first use instead.
+    """
+    try:
+        with startup_report.step(name):
+            await asyncio.to_thread(fn, *args)
+    except Exception as e:
+        print(f"Warm-up step {name} failed: {e}")
+        startup_report.errors[name] = str(e)
+
+
+def warm_tokenizers():
+    from indexing import CHUNK_SETTINGS, get_splitter
+    from embedding_scheduler import embedding_scheduler
+    from context_packing import count_tokens
+
+    for chunk_size, chunk_overlap in set(CHUNK_SETTINGS.values()):
+        get_splitter(chunk_size, chunk_overlap)
+    embedding_scheduler.count_tokens("warm up")
+    count_tokens("warm up")
+
+
+def warm_embed_models():
+    from llama_index.core import Settings
+    from embedding_scheduler import batch_embed_model
+    from query_embedding import get_query_embed_model
+
+    batch_embed_model(Settings.embed_model)
+    get_query_embed_model()
+
+
+async def open_connections(database, count: int):
+    """
+    Opens `count` connections in each SQLAlchemy engine (the psycopg pool
+    opens its own min_size), so the first requests skip the connect + TLS handshake.
+    """
+    await database.pool.wait()
+
+    def open_sync():
+        conns = [database.engine.connect() for _ in range(count)]
+        for conn in conns:
+            conn.exec_driver_sql("SELECT 1")
+            conn.close()
+
+    await asyncio.to_thread(open_sync)
+    conns = [await database.async_engine.connect() for _ in range(count)]
+    for conn in conns:
+        await conn.exec_driver_sql("SELECT 1")
+        await conn.close()
+
+
+async def warm_up(database, get_agent):
+    """
+    Does ahead of time what the first requests would otherwise do, then marks the service ready.
+    """
+    startup_report.status = "warming_up"
+    for module in WARMUP_MODULES:
+        await _run_step(f"import.{module}", importlib.import_module, module)
+    await _run_step("vector_store", lambda: database.index)
+    await _run_step("embed_models", warm_embed_models)
+    await _run_step("tokenizers", warm_tokenizers)
+    await _run_step("agent", get_agent)
+    try:
+        with startup_report.step("db_connections"):
+            await open_connections(database, WARMUP_DB_CONNECTIONS)
+    except Exception as e:
+        print(f"Warm-up step db_connections failed: {e}")
+        startup_report.errors["db_connections"] = str(e)
+    startup_report.mark_ready()
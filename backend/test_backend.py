@@ -1,8 +1,27 @@
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
-from main import app
+from unittest.mock import patch, MagicMock, AsyncMock
+from main import app, IndexFileRequest
+from caches import RetrievalCache, retrieval_cache
+from embedding_cache import EmbeddingCache, cache_key
+from query_embedding import CachedQueryEmbedding
+from index_jobs import IndexJob, IndexJobManager, JobQueueFullError
+from file_loader import download_file, load_file, load_pages, load_file_from_memory, shutdown_pdf_pool, FileTooLargeError
 from dataclasses import dataclass
+import asyncio
+import json
+import os
+import re
+import tempfile
+import time
+import fitz  # PyMuPDF
+import httpx
 import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langgraph.checkpoint.memory import InMemorySaver
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import NodeWithScore, TextNode
 
 client = TestClient(app)
 
@@ -11,52 +30,400 @@ def test_read_root():
     assert response.status_code == 200
     assert response.json() == {"message": "PaperParrot Backend is running"}
 
-@patch('main.requests.get')
-@patch('rag_utils.PGVectorStore')
-def test_index_file(mock_pg_vector, mock_requests_get):
-    # Mock download
-    mock_response = MagicMock()
-    mock_response.status_code = 200
-    mock_response.content = b"This is a test document content about PaperParrot."
-    mock_requests_get.return_value = mock_response
-    
-    # Mock VectorStore
-    mock_store = MagicMock()
-    mock_pg_vector.from_params.return_value = mock_store
-    
-    with patch('main.SimpleDirectoryReader') as mock_reader, \
-         patch('main.VectorStoreIndex') as mock_index, \
-         patch('main.get_vector_store') as mock_get_store:
-         
-        mock_get_store.return_value = mock_store
-        
-        # Mock documents
-        mock_doc = MagicMock()
-        mock_doc.metadata = {}  # Use real dict for metadata
-        mock_reader.return_value.load_data.return_value = [mock_doc]
-        
-        response = client.post("/api/index-file", json={
-            "file_url": "http://example.com/test.txt",
-            "file_id": "file_123",
-            "conversation_id": "conv_456"
-        })
-        
-        assert response.status_code == 200
-        assert response.json()["status"] == "success"
-        
-        # Verify metadata set
-        assert mock_doc.metadata["conversation_id"] == "conv_456"
-        assert mock_doc.metadata["file_id"] == "file_123"
+def make_spool(data: bytes, spool_threshold: int = 1024):
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    spool.write(data)
+    spool.seek(0)
+    return spool
+
+class MemoryJobStore:
+    """In-memory stand-in for IndexJobStore (no Postgres in unit tests)."""
+    def __init__(self):
+        self.rows = {}
+
+    async def setup(self):
+        pass
+
+    async def create(self, job):
+        self.rows[job.id] = job.to_dict()
+
+    async def update(self, job):
+        self.rows[job.id] = job.to_dict()
+
+    async def claim(self, job):
+        if self.rows[job.id]["status"] != "queued":
+            return False
+        self.rows[job.id]["status"] = "running"
+        return True
+
+    async def get(self, job_id):
+        return self.rows.get(job_id)
+
+    async def requeue_stale(self, stale_seconds):
+        return []
+
+INDEX_REQUEST = {
+    "file_name": "test.txt",
+    "file_url": "http://example.com/test.txt",
+    "file_id": "file_123",
+    "conversation_id": "conv_456"
+}
+
+@patch('main.index_jobs')
+def test_index_file(mock_jobs):
+    mock_jobs.submit = AsyncMock(return_value=IndexJob(**INDEX_REQUEST, id="job_1"))
+    response = client.post("/api/index-file", json=INDEX_REQUEST)
+    assert response.status_code == 202
+    assert response.json()["job_id"] == "job_1"
+
+    mock_jobs.submit.side_effect = JobQueueFullError("full")
+    response = client.post("/api/index-file", json=INDEX_REQUEST)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+
+@patch('main.index_jobs')
+def test_get_index_job(mock_jobs):
+    mock_jobs.get = AsyncMock(return_value={"id": "job_1", "status": "embedding", "chunks_embedded": 3})
+    response = client.get("/api/index-jobs/job_1")
+    assert response.status_code == 200
+    assert response.json()["status"] == "embedding"
+
+    mock_jobs.get = AsyncMock(return_value=None)
+    assert client.get("/api/index-jobs/missing").status_code == 404
+
+@patch('indexing.prepare_conversation_storage')
+@patch('indexing.insert_nodes', new_callable=AsyncMock)
+@patch('indexing.embed_nodes', new_callable=AsyncMock)
+@patch('indexing.download_file', new_callable=AsyncMock)
+def test_index_job_runs_in_background(mock_download, mock_embed, mock_insert, mock_prepare):
+    mock_embed.return_value = (0, 1)
+    async def fake_download(url, client=None, on_progress=None):
+        data = b"This is a test document content about PaperParrot."
+        on_progress(len(data))
+        return make_spool(data)
+    mock_download.side_effect = fake_download
+
+    async def run():
+        store = MemoryJobStore()
+        manager = IndexJobManager(store=store, workers=1, queue_size=1)
+        await manager.start()
+        job = await manager.submit(IndexFileRequest(**INDEX_REQUEST))
+        await manager.queue.join()
+        await manager.stop()
+        return store.rows[job.id]
+
+    row = asyncio.run(run())
+    assert row["status"] == "succeeded"
+    assert row["bytes_downloaded"] > 0
+    assert row["chunks_total"] == row["chunks_embedded"] == row["chunks_inserted"] == 1
+    assert row["cache_misses"] == 1
+
+    # Verify metadata set on every indexed node
+    nodes = mock_insert.call_args.args[0]
+    assert mock_embed.call_args.args[0] == nodes
+    assert nodes[0].metadata["conversation_id"] == "conv_456"
+    assert nodes[0].metadata["file_id"] == "file_123"
+    # The conversation's partition is prepared while the file downloads
+    mock_prepare.assert_called_once_with("conv_456")
+
+@patch('indexing.download_file', new_callable=AsyncMock)
+def test_index_job_failure_is_recorded(mock_download):
+    mock_download.side_effect = FileTooLargeError("File exceeds the 10 byte limit")
+
+    async def run():
+        store = MemoryJobStore()
+        manager = IndexJobManager(store=store, workers=1)
+        await manager.start()
+        job = await manager.submit(IndexFileRequest(**INDEX_REQUEST))
+        await manager.queue.join()
+        await manager.stop()
+        return store.rows[job.id]
+
+    row = asyncio.run(run())
+    assert row["status"] == "failed"
+    assert "limit" in row["error"]
+
+def test_recovered_index_job_only_inserts_missing_chunks():
+    from types import SimpleNamespace
+    from indexing import IndexItem, parse_stage
+
+    data = "\n\n".join(f"Section {i}. " + "Filler words here. " * 60 for i in range(12)).encode()
+    request = IndexFileRequest(**{**INDEX_REQUEST, "file_name": "draft.md"})
+    with patch.dict('indexing.CHUNK_SETTINGS', {".md": (128, 0)}):
+        parsed = IndexItem(request=request, spool=make_spool(data))
+        parse_stage(parsed)
+        # The job's process died after the first insert batch
+        inserted = [SimpleNamespace(id=f"row{i}", chunk_hash=node.metadata["chunk_hash"], text=None,
+                                    file_name="draft.md", page_number=None)
+                    for i, node in enumerate(parsed.nodes[:4])]
+
+        class StaleJobStore(MemoryJobStore):
+            async def requeue_stale(self, stale_seconds):
+                job = IndexJob(**{**INDEX_REQUEST, "file_name": "draft.md"}, id="job_stale")
+                self.rows[job.id] = job.to_dict()
+                return [{key: self.rows[job.id][key] for key in
+                         ("id", "file_name", "file_id", "file_url", "conversation_id", "mode")}]
+
+        async def run():
+            store = StaleJobStore()
+            manager = IndexJobManager(store=store, workers=1)
+            await manager.start()
+            await manager.queue.join()
+            await manager.stop()
+            return store.rows["job_stale"]
+
+        with patch('indexing.download_file', AsyncMock(return_value=make_spool(data))), \
+             patch('indexing.file_chunk_rows', return_value=inserted), \
+             patch('indexing.prepare_conversation_storage'), \
+             patch('indexing.embed_nodes', AsyncMock(side_effect=lambda nodes: (0, len(nodes)))), \
+             patch('indexing.insert_nodes', new_callable=AsyncMock) as insert, \
+             patch('indexing.replace_file_chunks') as replace:
+            row = asyncio.run(run())
+
+    assert row["status"] == "succeeded" and row["mode"] == "index"
+    insert.assert_not_called()
+    _, _, stored_ids, delete_ids, nodes = replace.call_args.args
+    assert stored_ids == [r.id for r in inserted] and delete_ids == []
+    assert [node.metadata["chunk_hash"] for node in nodes] == \
+        [node.metadata["chunk_hash"] for node in parsed.nodes[4:]]
+    assert row["chunks_unchanged"] == 4
+
+@patch('indexing.prepare_conversation_storage')
+@patch('indexing.insert_nodes', new_callable=AsyncMock)
+@patch('indexing.embed_nodes', new_callable=AsyncMock)
+@patch('indexing.download_file')
+def test_index_files_pipeline(mock_download, mock_embed, mock_insert, mock_prepare):
+    mock_embed.return_value = (0, 1)
+    async def slow_download(url, client=None, on_progress=None):
+        if "broken" in url:
+            raise ValueError("404")
+        await asyncio.sleep(0.2)
+        return make_spool(f"Contents of {url}".encode())
+    mock_download.side_effect = slow_download
+
+    files = [
+        {"file_name": f"paper{i}.txt", "file_id": f"file_{i}",
+         "file_url": f"http://example.com/{'broken' if i == 2 else i}.txt", "conversation_id": "conv_456"}
+        for i in range(4)
+    ]
+    started = time.monotonic()
+    response = client.post("/api/index-files", json={"files": files})
+    elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "partial"
+    assert [r["file_id"] for r in body["results"]] == ["file_0", "file_1", "file_2", "file_3"]
+    assert [r["status"] for r in body["results"]] == ["success", "success", "error", "success"]
+    assert mock_insert.call_count == 3
+    # downloads overlap instead of running back to back
+    assert elapsed < 0.55
+
+def test_embedding_cache_only_embeds_misses():
+    cache = EmbeddingCache(enabled=True)
+    stored = {}
+
+    async def get_many(keys):
+        return {k: stored[k] for k in keys if k in stored}
+
+    async def put_many(model_name, entries):
+        stored.update(entries)
+
+    embed_model = MagicMock()
+    embed_model.model_name = "fake-embed"
+    embed_model.aget_text_embedding_batch = AsyncMock(
+        side_effect=lambda texts: [[float(len(t))] for t in texts]
+    )
+
+    async def run():
+        with patch.object(cache, "get_many", side_effect=get_many), \
+             patch.object(cache, "put_many", side_effect=put_many):
+            first = await cache.embed_texts(["alpha", "beta", "alpha"], embed_model)
+            second = await cache.embed_texts(["beta", "gamma"], embed_model)
+        return first, second
+
+    (first_vecs, first_hits, first_misses), (second_vecs, second_hits, second_misses) = asyncio.run(run())
+    assert first_vecs == [[5.0], [4.0], [5.0]]
+    assert (first_hits, first_misses) == (1, 2)  # duplicate chunk embedded once
+    assert second_vecs == [[4.0], [5.0]]
+    assert (second_hits, second_misses) == (1, 1)
+    assert embed_model.aget_text_embedding_batch.call_args_list[-1].args[0] == ["gamma"]
+    assert cache.stats()["hits"] == 2
+    assert cache_key("fake-embed", "beta") != cache_key("other-model", "beta")
+
+def test_query_embedding_cache_skips_repeated_queries():
+    inner = MockEmbedding(embed_dim=4)
+    persistent = MagicMock()
+    persistent.get_many_sync.return_value = {}
+    model = CachedQueryEmbedding(inner, max_entries=2, persist=True, persistent_cache=persistent)
+
+    with patch.object(MockEmbedding, "_get_query_embedding", return_value=[0.5] * 4) as inner_call:
+        first = model.get_query_embedding("summarize this paper")
+        second = model.get_query_embedding("  summarize   this paper ")
+        assert first == second == [0.5] * 4
+        assert inner_call.call_count == 1
+        persistent.put_many_sync.assert_called_once()
+
+        # a warm Postgres entry is used when memory misses (e.g. after a restart)
+        persistent.get_many_sync.return_value = {model._key("key findings"): [0.25] * 4}
+        assert model.get_query_embedding("key findings") == [0.25] * 4
+        assert inner_call.call_count == 1
+
+    assert model.stats()["hits"] == 1
+    assert model.stats()["persistent_hits"] == 1
+    # documents are never served from the query cache
+    assert model._key("x") != cache_key(inner.model_name, "x")
+
+def test_query_embedding_cache_async_path_uses_persistent_cache():
+    inner = MockEmbedding(embed_dim=4)
+    persistent = MagicMock()
+    persistent.get_many = AsyncMock(return_value={})
+    persistent.put_many = AsyncMock()
+    model = CachedQueryEmbedding(inner, persist=True, persistent_cache=persistent)
+
+    async def scenario():
+        with patch.object(MockEmbedding, "_aget_query_embedding", AsyncMock(return_value=[0.5] * 4)) as inner_call:
+            assert await model.aget_query_embedding("summarize this paper") == [0.5] * 4
+            persistent.put_many.assert_awaited_once()
+            # The retriever embeds asynchronously, so a restart's warm Postgres entries must be found here too
+            persistent.get_many.return_value = {model._key("key findings"): [0.25] * 4}
+            assert await model.aget_query_embedding("key findings") == [0.25] * 4
+            assert inner_call.await_count == 1
+
+    asyncio.run(scenario())
+    persistent.get_many_sync.assert_not_called()
+    assert model.stats()["persistent_hits"] == 1
+
+def test_download_file_spools_and_enforces_limit():
+    payload = b"x" * 5000
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=payload))
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as http:
+            spool = await download_file("http://files.test/a.txt", spool_threshold=1024, client=http)
+            with spool:
+                assert spool._rolled  # past the threshold -> on disk
+                assert spool.read() == payload
+            with pytest.raises(FileTooLargeError):
+                await download_file("http://files.test/a.txt", max_bytes=100, client=http)
+
+    asyncio.run(run())
+
+@pytest.mark.parametrize("spool_threshold", [10, 10_000_000])
+def test_load_file_pdf_from_memory_and_disk(spool_threshold):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "Hello PaperParrot")
+    pdf_bytes = doc.tobytes()
+    with make_spool(pdf_bytes, spool_threshold) as spool:
+        assert "Hello PaperParrot" in load_file(spool, "paper.pdf")
+
+def test_load_pages_splits_large_pdf_across_processes():
+    doc = fitz.open()
+    for number in range(1, 8):
+        doc.new_page().insert_text((72, 72), f"Page marker {number}")
+    pdf_bytes = doc.tobytes()
+
+    with patch('file_loader.PDF_PARALLEL_MIN_PAGES', 4), \
+         patch('file_loader.PDF_PAGES_PER_TASK', 3), \
+         patch('file_loader.PDF_EXTRACT_WORKERS', 2):
+        try:
+            with make_spool(pdf_bytes, 10) as spool:
+                pages = load_pages(spool, "manual.pdf")
+        finally:
+            shutdown_pdf_pool()
+
+    assert [number for number, _ in pages] == list(range(1, 8))
+    assert all(f"Page marker {number}" in text for number, text in pages)
+
+def test_load_file_text_decoding():
+    text = "caf\u00e9 " * 50000  # multi-byte chars straddle read chunks
+    with make_spool(text.encode("utf-8")) as spool:
+        assert load_file(spool, "notes.md") == text
+    with make_spool("caf\u00e9".encode("latin-1")) as spool:
+        assert load_file(spool, "notes.txt") == "caf\u00e9"
+    with pytest.raises(ValueError):
+        load_file_from_memory(b"data", "archive.zip")
+
+def test_chunks_keep_file_identity_in_metadata():
+    from llama_index.core.schema import MetadataMode
+    from indexing import IndexItem, parse_stage, chunk_settings
+    from agent import format_snippets
+
+    text = " ".join(f"Sentence number {i} about parrots." for i in range(400))
+    with patch.dict('indexing.CHUNK_SETTINGS', {".md": (128, 16)}):
+        assert chunk_settings("notes.MD") == (128, 16)
+        item = IndexItem(request=IndexFileRequest(**{**INDEX_REQUEST, "file_name": "notes.md"}),
+                         spool=make_spool(text.encode()))
+        parse_stage(item)
+    assert len(item.nodes) > 10
+    node = item.nodes[0]
+    assert node.text.startswith("Sentence number 0")
+    assert node.get_content(metadata_mode=MetadataMode.EMBED) == node.text
+    assert node.metadata["file_name"] == "notes.md"
+
+    # One header per file; chunks indexed with the old preamble lose it
+    legacy = TextNode(text="The user uploaded a file called 'a.pdf'. The following is a chunk of the file 'a.pdf':\n\nOld chunk.",
+                      metadata={"file_id": "file_a", "file_name": "a.pdf", "page_number": 4})
+    rendered = format_snippets([NodeWithScore(node=n, score=1.0) for n in (item.nodes[0], legacy, item.nodes[1])])
+    assert rendered.count("=== File: notes.md ===") == 1 and rendered.count("=== File: a.pdf ===") == 1
+    assert rendered.index("Snippet 2 ---") < rendered.index("a.pdf")
+    assert "--- Document Snippet 3 (page 4) ---\nOld chunk." in rendered
+    assert "uploaded a file" not in rendered
+
+def test_update_file_only_embeds_changed_chunks():
+    from types import SimpleNamespace
+    from indexing import IndexItem, parse_stage, run_update_item, chunk_hash
+
+    def version(changed: set) -> bytes:
+        return "\n\n".join(
+            f"Section {i} {'was revised.' if i in changed else 'is unchanged.'} " + "Filler words here. " * 60
+            for i in range(12)
+        ).encode()
+
+    request = IndexFileRequest(**{**INDEX_REQUEST, "file_name": "draft.md"})
+    with patch.dict('indexing.CHUNK_SETTINGS', {".md": (128, 0)}):
+        old = IndexItem(request=request, spool=make_spool(version(set())))
+        parse_stage(old)
+        # Stored rows: hashed ones plus a legacy row without a hash, matched by its text
+        rows = [SimpleNamespace(id=f"row{i}", chunk_hash=node.metadata["chunk_hash"], text=None,
+                                file_name="draft.md", page_number=None) for i, node in enumerate(old.nodes)]
+        rows[0] = SimpleNamespace(id="row0", chunk_hash=None, text=old.nodes[0].text, file_name="draft.md", page_number=None)
+        assert chunk_hash(rows[0].text, "draft.md") == old.nodes[0].metadata["chunk_hash"]
+
+        embed = AsyncMock(side_effect=lambda nodes: (0, len(nodes)))
+        with patch('indexing.download_file', AsyncMock(return_value=make_spool(version({5})))), \
+             patch('indexing.file_chunk_rows', return_value=rows), \
+             patch('indexing.prepare_conversation_storage'), \
+             patch('indexing.embed_nodes', embed), \
+             patch('indexing.replace_file_chunks') as replace:
+            item = IndexItem(request=request)
+            assert asyncio.run(run_update_item(item))["status"] == "success"
+
+    file_id, conversation_id, stored_ids, delete_ids, nodes = replace.call_args.args
+    assert sorted(stored_ids) == sorted(row.id for row in rows)
+    assert 0 < len(nodes) == len(delete_ids) < len(rows) // 2
+    assert all("Section 5 was revised" in node.text or "Section 5" not in node.text for node in nodes)
+    assert sum(len(call.args[0]) for call in embed.call_args_list) == len(nodes)
+    assert item.chunks_unchanged == len(rows) - len(delete_ids)
+    assert item.chunks_deleted == len(delete_ids) and item.stage == "succeeded"
+
+@patch('main.index_jobs.submit', new_callable=AsyncMock)
+def test_update_file_endpoint(mock_submit):
+    mock_submit.return_value = IndexJob(**INDEX_REQUEST, mode="update")
+    response = client.post("/api/update-file", json=INDEX_REQUEST)
+    assert response.status_code == 202
+    assert response.json()["job_id"] == mock_submit.return_value.id
+    assert mock_submit.call_args.kwargs == {"mode": "update"}
 
 @dataclass
 class MockResponseFormat:
     final_answer: str
     did_search_internet: bool
 
-@patch('main.create_rag_agent')
-def test_chat(mock_create_agent):
+@patch('main.get_rag_agent')
+def test_chat(mock_get_agent):
     mock_agent = MagicMock()
-    mock_create_agent.return_value = mock_agent
+    mock_get_agent.return_value = mock_agent
     
     mock_response = {
         "structured_response": MockResponseFormat(
@@ -64,7 +431,7 @@ def test_chat(mock_create_agent):
             did_search_internet=False
         )
     }
-    mock_agent.invoke.return_value = mock_response
+    mock_agent.ainvoke = AsyncMock(return_value=mock_response)
     
     response = client.post("/api/chat", json={
         "message": "What is PaperParrot?",
@@ -74,6 +441,367 @@ def test_chat(mock_create_agent):
     assert response.status_code == 200
     assert response.json()["answer"] == "PaperParrot is a bird."
     assert response.json()["sources"] == "documents"
+    # The cached agent gets the conversation per call
+    assert mock_agent.ainvoke.call_args.kwargs["context"].conversation_id == "conv_456"
+    assert mock_agent.ainvoke.call_args.kwargs["config"]["configurable"]["thread_id"] == "conv_456"
+
+class ScriptedChatModel(BaseChatModel):
+    """Replays scripted AIMessages; streams tool call args in small pieces like a real provider."""
+    script: list
+    position: int = 0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _next_message(self):
+        message = self.script[self.position]
+        self.position += 1
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._next_message())])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._next_message()
+        for index, tool_call in enumerate(message.tool_calls):
+            args = json.dumps(tool_call["args"])
+            for start in range(0, len(args), 8):
+                first = start == 0
+                yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[{
+                    "name": tool_call["name"] if first else None,
+                    "args": args[start:start + 8],
+                    "id": tool_call["id"] if first else None,
+                    "index": index,
+                }]))
+
+def parse_sse(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+@patch('rag_utils.get_db')
+@patch('agent.get_shared_index')
+@patch('agent.init_chat_model')
+def test_chat_stream(mock_init_model, mock_get_index, mock_get_db):
+    mock_get_db.return_value.filter_columns = False
+    mock_get_db.return_value.partitioned = False
+    mock_get_db.return_value.text_search = False
+    mock_init_model.return_value = ScriptedChatModel(script=[
+        AIMessage(content="", tool_calls=[{"name": "search_documents", "args": {"query": "parrots"}, "id": "call_1"}]),
+        AIMessage(content="", tool_calls=[{"name": "ResponseFormat", "id": "call_2", "args": {
+            "did_search_internet": False, "final_answer": "PaperParrot is a bird."}}]),
+    ])
+    node = TextNode(text="Parrots are birds.", id_="node_1", metadata={"file_id": "file_123", "page_number": 2})
+    mock_get_index.return_value.as_retriever.return_value.retrieve.return_value = [NodeWithScore(node=node, score=0.9)]
+
+    retrieval_cache.clear()
+    app.state.checkpointer = InMemorySaver()
+    try:
+        response = client.post("/api/chat/stream", json={
+            "message": "What is PaperParrot?",
+            "conversation_id": "conv_456"
+        })
+    finally:
+        del app.state.checkpointer
+        del app.state.agent
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    kinds = [kind for kind, _ in events]
+    assert kinds.index("tool_start") < kinds.index("snippets") < kinds.index("tool_end") < kinds.index("token")
+    assert dict(events)["snippets"]["snippets"][0] == {"id": "node_1", "file_id": "file_123", "page_number": 2, "score": 0.9}
+    assert "".join(data["text"] for kind, data in events if kind == "token") == "PaperParrot is a bird."
+    assert events[-1] == ("final", {"answer": "PaperParrot is a bird.", "sources": "documents"})
+    # The retrieval filter comes from the runtime context (JSON path until the schema migration ran)
+    filters = mock_get_index.return_value.as_retriever.call_args.kwargs["filters"]
+    assert filters.filters[0].value == "conv_456"
+    # The stream held its admission slots until it ended
+    from admission import admission_stats
+    assert admission_stats()["chat"]["in_flight"] == 0
+    assert admission_stats()["conversation"]["keys"] == 0
+
+def test_chat_history_pagination_and_etag():
+    from langgraph.checkpoint.base import empty_checkpoint
+    from langchain_core.messages import HumanMessage, ToolMessage
+
+    saver = InMemorySaver()
+    messages = []
+    for i in range(3):
+        messages += [
+            HumanMessage(content=f"question {i}", id=f"h{i}"),
+            AIMessage(content="", id=f"t{i}", tool_calls=[{"name": "search_documents", "args": {"query": "q"}, "id": f"c{i}"}]),
+            ToolMessage(content="--- Document Snippet 1 ---", tool_call_id=f"c{i}", id=f"s{i}"),
+            AIMessage(content="", id=f"a{i}", tool_calls=[{"name": "ResponseFormat", "args": {"final_answer": f"answer {i}"}, "id": f"r{i}"}]),
+        ]
+    config = {"configurable": {"thread_id": "conv_hist", "checkpoint_ns": ""}}
+
+    def save_checkpoint(messages, version):
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = {"messages": messages}
+        checkpoint["channel_versions"] = {"messages": version}
+        asyncio.run(saver.aput(config, checkpoint, {}, {"messages": version}))
+
+    save_checkpoint(messages, 1)
+
+    app.state.checkpointer = saver
+    try:
+        response = client.get("/api/chat/conv_hist/history", params={"limit": 4})
+        body = response.json()
+        # Only human/assistant turns, newest page first, oldest turn first within the page
+        assert [turn["content"] for turn in body["history"]] == ["question 1", "answer 1", "question 2", "answer 2"]
+        assert body["next_before"] == "h1"
+
+        older = client.get("/api/chat/conv_hist/history", params={"limit": 4, "before": "h1"}).json()
+        assert [turn["id"] for turn in older["history"]] == ["h0", "a0"]
+        assert older["next_before"] is None
+
+        # Without a limit (the frontend's call) the whole history comes back
+        everything = client.get("/api/chat/conv_hist/history").json()
+        assert len(everything["history"]) == 6 and everything["next_before"] is None
+
+        # Unchanged history: 304 without a body
+        etag = response.headers["etag"]
+        with patch.object(saver, "aget", wraps=saver.aget) as mock_aget:
+            not_modified = client.get("/api/chat/conv_hist/history", params={"limit": 4},
+                                      headers={"If-None-Match": etag})
+            assert not_modified.status_code == 304
+            mock_aget.assert_not_called()
+
+        # A new checkpoint changes the ETag
+        save_checkpoint(messages + [HumanMessage(content="question 3", id="h3")], 2)
+        changed = client.get("/api/chat/conv_hist/history", params={"limit": 4}, headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.json()["history"][-1]["content"] == "question 3"
+    finally:
+        del app.state.checkpointer
+
+def test_compact_thread_keeps_recent_turns():
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import HumanMessage, ToolMessage
+    from langgraph.graph import StateGraph, MessagesState, START
+    from checkpoint_retention import compact_thread, SUMMARY_MESSAGE_ID
+
+    builder = StateGraph(MessagesState)
+    builder.add_node("model", lambda state: {})
+    builder.add_edge(START, "model")
+    graph = builder.compile(checkpointer=InMemorySaver())
+    config = {"configurable": {"thread_id": "conv_long"}}
+    messages = []
+    for i in range(4):
+        messages += [
+            HumanMessage(content=f"question {i}", id=f"h{i}"),
+            AIMessage(content="", id=f"t{i}", tool_calls=[{"name": "search_documents", "args": {"query": "q"}, "id": f"c{i}"}]),
+            ToolMessage(content="snippet " * 100, tool_call_id=f"c{i}", id=f"s{i}"),
+            AIMessage(content=f"answer {i}", id=f"a{i}"),
+        ]
+    asyncio.run(graph.aupdate_state(config, {"messages": messages}))
+
+    summarizer = GenericFakeChatModel(messages=iter([AIMessage(content="User asked questions 0 and 1.")]))
+    # Too recent: left alone
+    assert not asyncio.run(compact_thread(graph, summarizer, "conv_long", keep_turns=2, idle_seconds=3600))
+    # Dry run reports it without touching the thread
+    assert asyncio.run(compact_thread(graph, summarizer, "conv_long", keep_turns=2, idle_seconds=0, dry_run=True))
+    assert len(asyncio.run(graph.aget_state(config)).values["messages"]) == 16
+
+    assert asyncio.run(compact_thread(graph, summarizer, "conv_long", keep_turns=2, idle_seconds=0))
+    compacted = asyncio.run(graph.aget_state(config)).values["messages"]
+    assert compacted[0].id == SUMMARY_MESSAGE_ID
+    assert compacted[0].content == "User asked questions 0 and 1."
+    assert [msg.id for msg in compacted[1:]] == ["h2", "t2", "s2", "a2", "h3", "t3", "s3", "a3"]
+
+@patch('main.checkpoint_retention')
+def test_checkpoint_retention_endpoints(mock_retention):
+    mock_retention.run_once = AsyncMock(return_value={"dry_run": True, "checkpoints": 12, "writes": 30, "blobs": 8})
+    mock_retention.stats.return_value = {"runs": 0}
+    response = client.post("/api/checkpoint-retention/run", json={})
+    assert response.status_code == 200
+    assert response.json()["checkpoints"] == 12
+    # Dry run unless asked otherwise
+    mock_retention.run_once.assert_called_with(dry_run=True, compact=False)
+    assert client.get("/api/checkpoint-retention").json() == {"runs": 0}
+
+def test_hybrid_retriever_fast_path_and_fusion():
+    from collections import namedtuple
+    from llama_index.core.vector_stores.utils import node_to_metadata_dict
+    from hybrid_retrieval import HybridRetriever, is_exact_lookup, hybrid_stats
+
+    Row = namedtuple("Row", "node_id text metadata_ rank exact")
+    def row(node_id, exact):
+        node = TextNode(text=f"text of {node_id}", id_=node_id, metadata={"file_id": "file_1"})
+        return Row(node_id, node.text, node_to_metadata_dict(node, remove_text=True), 0.5, exact)
+
+    engine = MagicMock()
+    conn = engine.connect.return_value.__enter__.return_value
+    vector_retriever = MagicMock()
+    vector_retriever.retrieve.return_value = [
+        NodeWithScore(node=TextNode(text="v", id_=node_id), score=0.8) for node_id in ["n3", "n2", "n4"]
+    ]
+    retriever = HybridRetriever(vector_retriever, engine, "conv_1", "conversation_id", similarity_top_k=3)
+
+    assert is_exact_lookup("ERR_4711")
+    assert is_exact_lookup('"connection reset"')
+    assert not is_exact_lookup("what are the main findings of the paper")
+
+    # Exact lookup with a full-text hit: no vector search, no query embedding
+    conn.execute.return_value.all.return_value = [row("n1", True), row("n2", False)]
+    before = hybrid_stats.lexical_only
+    results = retriever.retrieve("ERR_4711")
+    assert [r.node.node_id for r in results] == ["n1"]
+    assert results[0].node.get_content() == "text of n1"
+    vector_retriever.retrieve.assert_not_called()
+    assert hybrid_stats.lexical_only == before + 1
+    params = conn.execute.call_args.args[1]
+    assert params["cid"] == "conv_1" and params["any_terms"] == "ERR_4711"
+
+    # Natural-language question: both sides, fused with RRF (n2 is in both lists)
+    conn.execute.return_value.all.return_value = [row("n1", True), row("n2", False)]
+    results = retriever.retrieve("how are connection errors handled")
+    vector_retriever.retrieve.assert_called_once()
+    assert [r.node.node_id for r in results] == ["n2", "n1", "n3"]
+
+def test_web_search_cache_coalesces_concurrent_queries():
+    from concurrent.futures import ThreadPoolExecutor
+    from web_search import WebSearchCache
+    from serper_search import SerperSearch
+    from benchmarks.fakes import StubSerperServer
+
+    with StubSerperServer(delay=0.2, api_key="test-key") as stub:
+        cache = WebSearchCache(SerperSearch(base_url=stub.url, serper_api_key="test-key"), persist=False)
+
+        # Nine users asking about the same topic at once: one upstream request
+        queries = ["Trending  topic", "trending topic", "TRENDING TOPIC "] * 3
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            results = list(pool.map(cache.search, queries))
+        assert len(set(results)) == 1 and "Result 1 about" in results[0]
+        assert sum(stub.requests.values()) == 1
+        assert cache.stats()["coalesced"] >= 1
+
+        # Later calls are served from the cache
+        assert cache.search("trending topic") == results[0]
+        assert sum(stub.requests.values()) == 1
+
+        # Errors reach every waiter and are not cached
+        stub.fail_next = 1
+        with pytest.raises(Exception):
+            cache.search("flaky query")
+        assert "flaky query" in cache.search("flaky query")
+        assert stub.requests["flaky query"] == 2
+        assert cache.stats()["searches"] == 3
+
+def test_embedding_scheduler_adapts_to_rate_limits():
+    from llama_index.embeddings.openai import OpenAIEmbedding
+    from embedding_scheduler import EmbeddingScheduler, batch_embed_model
+    from benchmarks.fakes import StubEmbeddingServer, VOCABULARY
+
+    texts = [[" ".join(VOCABULARY[(f * 7 + i + j) % len(VOCABULARY)] for j in range(10)) for i in range(30)]
+             for f in range(3)]
+    # 900 tokens to embed under a 300 tokens / 0.25s limit
+    with StubEmbeddingServer(tokens_per_minute=300, window=0.25) as server:
+        # Default client retries: the scheduler sends its batches through a copy without them
+        model = OpenAIEmbedding(api_base=f"{server.url}/v1", api_key="x")
+        scheduler = EmbeddingScheduler(batch_tokens=150, concurrency=8, max_concurrency=8,
+                                       retry_base_delay=0.05, latency_target=0, max_attempts=50)
+        scheduler.count_tokens = server.count_tokens
+
+        async def run():
+            # Three files indexed at once share the scheduler
+            return await asyncio.gather(*(scheduler.embed(file_texts, model) for file_texts in texts))
+
+        results = asyncio.run(run())
+
+    expected = server.embedding
+    assert [[round(v, 5) for v in vector] for vector in results[1][:3]] == \
+        [[round(v, 5) for v in expected.get_text_embedding(text)] for text in texts[1][:3]]
+    stats = scheduler.stats()
+    assert stats["texts"] == 90 and stats["failures"] == 0
+    assert stats["rate_limited"] == server.rate_limited > 0
+    assert stats["retries"] == stats["rate_limited"]
+    assert stats["concurrency_limit"] < 8
+    # Only failed batches were re-sent: every text was embedded exactly once
+    assert server.inputs == 90
+    # The shared model (and with it the query path) keeps its own retries
+    assert model.max_retries == 10 and batch_embed_model(model).max_retries == 0
+    assert batch_embed_model(model) is batch_embed_model(model)
+    assert batch_embed_model(model).model_name == model.model_name
+
+    # Errors that retrying can't fix fail the caller right away
+    bad_model = MagicMock(embed_batch_size=10)
+    bad_model.aget_text_embedding_batch = AsyncMock(side_effect=ValueError("input too long"))
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.embed(["x"], bad_model))
+    assert bad_model.aget_text_embedding_batch.call_count == 1
+
+@patch('agent.init_chat_model')
+def test_benchmark_stand_ins_drive_the_agent(mock_init_model):
+    from web_search import WebSearchCache
+    from serper_search import SerperSearch
+    from benchmarks.fakes import ScriptedAgentModel, StubSerperServer, StubFileServer
+
+    mock_init_model.return_value = ScriptedAgentModel()
+    with StubSerperServer() as serper, StubFileServer() as files:
+        url = files.add("notes.txt", b"Parrots are birds.", "text/plain")
+        assert httpx.get(url).text == "Parrots are birds."
+        assert httpx.get(f"{files.url}/missing").status_code == 404
+
+        cache = WebSearchCache(SerperSearch(base_url=serper.url, serper_api_key="test-key"), persist=False)
+        app.state.checkpointer = InMemorySaver()
+        try:
+            with patch('agent.web_search_cache', cache):
+                response = client.post("/api/chat", json={
+                    "message": "Search the internet for parrots", "conversation_id": "conv_bench"})
+        finally:
+            del app.state.checkpointer
+            del app.state.agent
+
+    assert response.status_code == 200
+    assert response.json()["sources"] == "internet"
+    assert "Result 1 about Search the internet for parrots." in response.json()["answer"]
+    assert sum(serper.requests.values()) == 1
+
+def test_metrics_endpoint_and_timing_breakdown():
+    from metrics import span, collect_timings, timing_breakdown
+
+    async def work():
+        with span("test.stage"):
+            await asyncio.sleep(0.01)
+        # Spans in worker threads count towards the request that started them
+        def in_thread():
+            with span("test.thread"):
+                pass
+        await asyncio.to_thread(in_thread)
+
+    with collect_timings() as timings:
+        asyncio.run(work())
+    assert list(timing_breakdown(timings)) == ["test.stage", "test.thread"]
+
+    body = client.get("/metrics").text
+    assert '# TYPE paperparrot_stage_duration_seconds histogram' in body
+    assert 'paperparrot_stage_duration_seconds_bucket{stage="test.stage",le="0.005"} 0' in body
+    assert 'paperparrot_stage_duration_seconds_bucket{stage="test.stage",le="+Inf"} 1' in body
+    assert 'paperparrot_cache_hit_rate{cache="retrieval_cache"}' in body
+    # Monotonic statistics are counters (rate() works on them), current values stay gauges
+    assert '# TYPE paperparrot_cache_hits_total counter' in body
+    assert 'paperparrot_cache_hits_total{cache="retrieval_cache"}' in body
+    assert '# TYPE paperparrot_cache_entries gauge' in body
+    assert '# TYPE paperparrot_admission_wait_seconds_total counter' in body
+    assert '# TYPE paperparrot_admission_in_flight gauge' in body
+    assert 'paperparrot_cache_hits{' not in body
+
+@patch('main.DEBUG_TIMINGS', True)
+@patch('main.get_rag_agent')
+def test_debug_timings_header(mock_get_agent):
+    mock_get_agent.return_value.ainvoke = AsyncMock(return_value={
+        "structured_response": MockResponseFormat(final_answer="Hi.", did_search_internet=False)})
+    response = client.post("/api/chat", json={"message": "Hi", "conversation_id": "conv_456"})
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("chat.total;dur=")
 
 @patch('main.delete_file_by_id')
 def test_delete_file(mock_delete):
@@ -83,4 +811,435 @@ def test_delete_file(mock_delete):
     })
     
     assert response.status_code == 200
-    mock_delete.assert_called_with("file_123")
+    mock_delete.assert_called_with("file_123", "conv_456")
+
+def test_retrieval_cache_invalidation():
+    cache = RetrievalCache(max_entries=3, ttl=60)
+    generation = cache.generation("conv_1")
+    cache.put_results("conv_1", "What are the  Key findings?", ["node_a"], generation)
+    cache.put_results("conv_2", "key findings", ["node_b"], cache.generation("conv_2"))
+
+    # normalized query hits
+    assert cache.get_results("conv_1", "what are the key findings?") == ["node_a"]
+    assert cache.get_results("conv_1", "something else") is None
+
+    # invalidation only drops that conversation
+    cache.invalidate("conv_1")
+    assert cache.get_results("conv_1", "what are the key findings?") is None
+    assert cache.get_results("conv_2", "key findings") == ["node_b"]
+
+    # a retrieval that started before the invalidation is not cached
+    cache.put_results("conv_1", "late", ["stale"], generation)
+    assert cache.get_results("conv_1", "late") is None
+
+    # LRU eviction
+    for i in range(4):
+        cache.put_results("conv_3", f"q{i}", [i], cache.generation("conv_3"))
+    assert cache.get_results("conv_2", "key findings") is None
+    assert cache.stats()["evictions"] == 2
+    assert cache.stats()["hits"] == 2
+
+    # Invalidation counters are bounded; a dropped conversation never reads lower than its own counter
+    from caches import Generations
+    generations = Generations(max_entries=2)
+    before = generations.get("conv_a")
+    for conversation_id in ("conv_a", "conv_b", "conv_c"):
+        generations.bump(conversation_id)
+    assert len(generations) == 2
+    assert generations.get("conv_a") == 1 != before
+    assert generations.get("conv_new") == 1 < generations.get("conv_c")
+
+@patch('main.delete_conversation_by_id')
+def test_delete_conversation_invalidates_retrieval_cache(mock_delete):
+    retrieval_cache.put_results("conv_789", "q", ["node"], retrieval_cache.generation("conv_789"))
+    response = client.post("/api/delete-conversation", json={"conversation_id": "conv_789"})
+    assert response.status_code == 200
+    mock_delete.assert_called_with("conv_789")
+    assert retrieval_cache.get_results("conv_789", "q") is None
+
+@patch('rag_utils.get_db')
+def test_filter_columns_switch(mock_get_db):
+    from sqlalchemy import select, table, column
+    from rag_utils import conversation_retriever_kwargs, delete_file_by_id
+    from migrations import filter_by_columns
+
+    # Before the migration: JSON-path filter and delete
+    mock_get_db.return_value.filter_columns = False
+    mock_get_db.return_value.partitioned = False
+    assert conversation_retriever_kwargs("conv_1")["filters"].filters[0].value == "conv_1"
+    delete_file_by_id("file_1")
+    conn = mock_get_db.return_value.engine.begin.return_value.__enter__.return_value
+    assert "metadata_->>'file_id' = :fid" in str(conn.execute.call_args.args[0])
+
+    # After: the indexed columns
+    mock_get_db.return_value.filter_columns = True
+    kwargs = conversation_retriever_kwargs("conv_1")
+    assert kwargs == {"vector_store_kwargs": {"conversation_id": "conv_1", "partitioned": False}}
+    delete_file_by_id("file_1")
+    assert "WHERE file_id = :fid" in str(conn.execute.call_args.args[0])
+
+    stmt = filter_by_columns(select(column("id")).select_from(table("t")), None, **kwargs["vector_store_kwargs"])
+    assert "WHERE conversation_id = :conversation_id_1" in str(stmt)
+
+@patch('rag_utils.get_db')
+def test_partitioned_layout(mock_get_db):
+    from sqlalchemy import select, table, column
+    from rag_utils import conversation_retriever_kwargs, delete_conversation_by_id, delete_file_by_id
+    from migrations import filter_by_columns, partition_name, ensure_conversation_partition, _known_partitions
+
+    mock_get_db.return_value.filter_columns = True
+    mock_get_db.return_value.partitioned = True
+    conn = mock_get_db.return_value.engine.begin.return_value.__enter__.return_value
+    conn.execute.return_value.scalar.return_value = True  # the partition exists
+
+    # Retrieval filters on the partition key so only one partition is scanned
+    kwargs = conversation_retriever_kwargs("conv_1")["vector_store_kwargs"]
+    stmt = filter_by_columns(select(column("id")).select_from(table("t")), None, **kwargs)
+    assert "WHERE (metadata_->>'conversation_id') = :partition_key" in str(stmt)
+
+    # Deleting a conversation truncates its partition (locking only that partition) instead of deleting rows
+    delete_conversation_by_id("conv_1")
+    statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+    name = partition_name("conv_1")
+    assert f"TRUNCATE {name}" in statements
+    assert not any("DETACH" in statement for statement in statements)
+    assert partition_name("conv_1") == name != partition_name("conv_2")
+
+    # A new partition is built on its own and attached, never created with PARTITION OF
+    engine = MagicMock()
+    new_conn = engine.begin.return_value.__enter__.return_value
+    new_conn.execute.return_value.scalar.return_value = False
+    ensure_conversation_partition(engine, "conv_2")
+    statements = [str(call.args[0]) for call in new_conn.execute.call_args_list]
+    assert any(f"ATTACH PARTITION {partition_name('conv_2')}" in statement for statement in statements)
+    assert not any("PARTITION OF" in statement for statement in statements)
+    _known_partitions.discard(partition_name("conv_2"))
+
+    # Deleting a file prunes to its conversation's partition
+    delete_file_by_id("file_1", "conv_1")
+    assert "file_id = :fid AND (metadata_->>'conversation_id') = :cid" in str(conn.execute.call_args.args[0])
+
+    # Updating a file deletes its stale chunks from the conversation's partition only
+    from rag_utils import replace_file_chunks
+    conn.execute.reset_mock()
+    conn.execute.return_value.scalars.return_value.all.return_value = ["id_1", "id_2"]
+    with patch('rag_utils.vector_table_class'):
+        replace_file_chunks("file_1", "conv_1", ["id_2", "id_1"], ["id_2"], [])
+    delete = next(call for call in conn.execute.call_args_list if str(call.args[0]).startswith("DELETE"))
+    assert str(delete.args[0]) == "DELETE FROM data_paperparrot_embeddings WHERE id = ANY(:ids) AND (metadata_->>'conversation_id') = :cid"
+    assert delete.args[1] == {"ids": ["id_2"], "cid": "conv_1"}
+
+@pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="needs a Postgres database (TEST_DATABASE_URL)")
+def test_partition_ddl_does_not_block_other_conversations():
+    from sqlalchemy import create_engine, text
+    from migrations import ensure_conversation_partition, drop_conversation_partition, partition_name, _known_partitions
+
+    table = "paperparrot_partition_lock_test"
+    # Anything that waits for a lock held by the open read below fails instead of hanging
+    engine = create_engine(os.environ["TEST_DATABASE_URL"], connect_args={"options": "-c lock_timeout=2s"})
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+        conn.execute(text(f"CREATE TABLE {table} (id BIGSERIAL, metadata_ JSONB, text TEXT) "
+                          f"PARTITION BY LIST ((metadata_->>'conversation_id'))"))
+        conn.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+        conn.execute(text(f"CREATE INDEX {table}_id_idx ON {table} (id)"))
+    try:
+        ensure_conversation_partition(engine, "conv_a", table)
+        with engine.begin() as conn:
+            for conversation_id in ("conv_a", "conv_b"):  # conv_b has no partition yet: lands in the default one
+                conn.execute(text(f"INSERT INTO {table} (metadata_, text) VALUES (CAST(:m AS JSONB), 'chunk')"),
+                             {"m": json.dumps({"conversation_id": conversation_id})})
+
+        with engine.connect() as reader:
+            # A retrieval on conv_a is in progress
+            assert reader.execute(text(
+                f"SELECT count(*) FROM {table} WHERE (metadata_->>'conversation_id') = 'conv_a'")).scalar() == 1
+            ensure_conversation_partition(engine, "conv_b", table)
+            with engine.begin() as conn:
+                assert conn.execute(text(f"SELECT count(*) FROM {partition_name('conv_b', table)}")).scalar() == 1
+                drop_conversation_partition(conn, "conv_b", table)
+            reader.rollback()
+
+        with engine.connect() as conn:
+            assert conn.execute(text(
+                f"SELECT count(*) FROM {table} WHERE (metadata_->>'conversation_id') = 'conv_b'")).scalar() == 0
+    finally:
+        for conversation_id in ("conv_a", "conv_b"):
+            _known_partitions.discard(partition_name(conversation_id, table))
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+        engine.dispose()
+
+def test_db_stats_before_open():
+    response = client.get("/api/db-stats")
+    assert response.status_code == 200
+    assert response.json()["open"] is False
+
+def test_split_budget():
+    from db import split_budget
+    sizes = split_budget(12)
+    assert sizes == {"checkpointer": 6, "sync_engine": 3, "async_engine": 3}
+    assert sum(split_budget(7).values()) == 7
+    with pytest.raises(ValueError):
+        split_budget(2)
+
+def test_import_main_skips_heavy_dependencies():
+    import subprocess, sys
+    code = (
+        "import sys, main; "
+        "print('loaded:', [m for m in ('llama_index.core', 'langchain.agents', 'langgraph.checkpoint.postgres.aio', "
+        "'fitz', 'langchain_community') if m in sys.modules])"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert "loaded: []" in result.stdout
+
+def test_readiness_waits_for_warm_up():
+    from startup import startup_report, warm_up
+    status = startup_report.status
+    try:
+        startup_report.status = "warming_up"
+        assert client.get("/health/ready").status_code == 503
+
+        database = MagicMock()
+        database.pool.wait = AsyncMock()
+        database.async_engine.connect = AsyncMock()
+        with patch("startup.WARMUP_MODULES", ("json",)), \
+             patch("startup.warm_embed_models"), patch("startup.warm_tokenizers"):
+            asyncio.run(warm_up(database, MagicMock(side_effect=RuntimeError("no key"))))
+
+        response = client.get("/health/ready")
+        assert response.status_code == 200
+        report = response.json()
+        assert {"import.json", "vector_store", "agent", "db_connections"} <= set(report["steps_ms"])
+        # A failed step is reported but doesn't keep the service from becoming ready
+        assert report["errors"] == {"agent": "no key"}
+    finally:
+        startup_report.status = status
+        startup_report.errors.clear()
+
+def test_admission_limiter_queues_then_rejects():
+    from admission import AdmissionLimiter, AdmissionRejected
+
+    async def scenario():
+        limiter = AdmissionLimiter("test", max_concurrent=1, max_queue=1, timeout=0.2)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.stats()["queued"] == 1
+
+        # Queue full: rejected right away with a Retry-After hint
+        with pytest.raises(AdmissionRejected) as full:
+            await limiter.acquire()
+        assert full.value.status_code == 503 and full.value.retry_after >= 1
+
+        # Releasing hands the slot to the waiter instead of freeing it
+        limiter.release(0.05)
+        await waiter
+        assert limiter.in_flight == 1 and limiter.queued == 0
+
+        # Nobody releases: the next waiter hits its deadline
+        with pytest.raises(AdmissionRejected):
+            await limiter.acquire()
+        limiter.release()
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["in_flight"] == 0
+    assert (stats["admitted"], stats["rejected_full"], stats["rejected_timeout"]) == (2, 1, 1)
+
+@patch('main.get_rag_agent')
+def test_chats_on_one_conversation_are_serialized(mock_get_agent):
+    from admission import AdmissionLimiter, KeyedLimiter
+    running = {}
+    overlaps = []
+
+    async def ainvoke(inputs, config, context):
+        thread = config["configurable"]["thread_id"]
+        overlaps.append(running.get(thread, 0))
+        running[thread] = running.get(thread, 0) + 1
+        await asyncio.sleep(0.05)
+        running[thread] -= 1
+        return {"structured_response": MockResponseFormat(final_answer="ok", did_search_internet=False)}
+
+    mock_get_agent.return_value.ainvoke = ainvoke
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            chats = [http.post("/api/chat", json={"message": "hi", "conversation_id": conversation_id})
+                     for conversation_id in ("conv_a", "conv_a", "conv_a", "conv_b")]
+            return await asyncio.gather(*chats)
+
+    with patch("admission.chat_limiter", AdmissionLimiter("chat", 4, 4, 5)), \
+         patch("admission.conversation_limiter", KeyedLimiter("conversation", 1, 1, 5)) as conversations:
+        responses = asyncio.run(burst())
+        assert conversations.stats()["keys"] == 0
+
+    statuses = sorted(response.status_code for response in responses)
+    # conv_a: one runs, one waits, the third finds its conversation's queue full
+    assert statuses == [200, 200, 200, 429]
+    rejected = next(response for response in responses if response.status_code == 429)
+    assert int(rejected.headers["Retry-After"]) >= 1
+    assert overlaps == [0, 0, 0]
+
+    metrics = client.get("/metrics").text
+    assert 'paperparrot_admission_queued{limiter="chat"}' in metrics
+    assert 'paperparrot_admission_max_queue{limiter="index_jobs"}' in metrics
+
+@patch('main.get_rag_agent')
+def test_chat_stream_releases_admission_when_cancelled(mock_get_agent):
+    from admission import AdmissionLimiter, KeyedLimiter
+    from main import chat_stream, ChatRequest
+
+    chats = AdmissionLimiter("chat", 1, 1, 5)
+    conversations = KeyedLimiter("conversation", 1, 1, 5)
+    with patch("admission.chat_limiter", chats), patch("admission.conversation_limiter", conversations), \
+         patch("main.cached_answer", AsyncMock(side_effect=asyncio.CancelledError)):
+        # The client went away during the answer cache lookup, before the stream started
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(chat_stream(ChatRequest(message="hi", conversation_id="conv_gone")))
+
+    assert chats.stats()["in_flight"] == 0
+    assert conversations.stats()["keys"] == 0
+
+@patch('query_embedding.get_query_embed_model')
+@patch('agent.init_chat_model')
+def test_answer_cache_reuses_answers_until_files_change(mock_init_model, mock_embed_model):
+    from answer_cache import answer_cache
+    vectors = {"What is PaperParrot?": [1.0, 0.0, 0.0], "what is   paperparrot": [0.99, 0.1, 0.0],
+               "Who made it?": [0.0, 1.0, 0.0]}
+    mock_embed_model.return_value.aget_query_embedding = AsyncMock(side_effect=lambda q: vectors[q])
+
+    def answer(text, call_id):
+        return AIMessage(content="", tool_calls=[{"name": "ResponseFormat", "id": call_id, "args": {
+            "did_search_internet": False, "final_answer": text}}])
+    model = ScriptedChatModel(script=[answer("PaperParrot is a bird.", "call_1"), answer("It reads PDFs.", "call_2")])
+    mock_init_model.return_value = model
+
+    def ask(question):
+        return client.post("/api/chat", json={"message": question, "conversation_id": "conv_cache"})
+
+    app.state.checkpointer = InMemorySaver()
+    answer_cache.enabled = True
+    try:
+        first = ask("What is PaperParrot?")
+        # A paraphrase against the same files: answered without calling the model
+        second = ask("what is   paperparrot")
+        assert model.position == 1
+        history = client.get("/api/chat/conv_cache/history").json()["history"]
+
+        # Indexing or deleting a file in the conversation drops its answers
+        answer_cache.invalidate("conv_cache")
+        third = ask("what is   paperparrot")
+        assert model.position == 2
+        streamed = client.post("/api/chat/stream", json={"message": "What is PaperParrot?", "conversation_id": "conv_cache"})
+        assert model.position == 2
+
+        # An answer computed while the files changed isn't stored under the new generation
+        stale = asyncio.run(answer_cache.lookup("conv_cache", "Who made it?", mock_embed_model.return_value))
+        answer_cache.invalidate("conv_cache")
+        answer_cache.store(stale, {"answer": "Nobody.", "sources": "documents"})
+        assert answer_cache.stats()["entries"] == 0
+    finally:
+        answer_cache.enabled = False
+        answer_cache.clear()
+        del app.state.checkpointer
+        del app.state.agent
+
+    assert first.json() == second.json() == {"answer": "PaperParrot is a bird.", "sources": "documents"}
+    assert "X-Answer-Cache" not in first.headers and second.headers["X-Answer-Cache"] == "hit"
+    assert third.json()["answer"] == "It reads PDFs."
+    assert parse_sse(streamed.text) == [("token", {"text": "It reads PDFs."}),
+                                        ("final", {"answer": "It reads PDFs.", "sources": "documents"})]
+    # The cached turn is still part of the conversation
+    assert [(turn["role"], turn["content"]) for turn in history] == [
+        ("user", "What is PaperParrot?"), ("assistant", "PaperParrot is a bird."),
+        ("user", "what is   paperparrot"), ("assistant", "PaperParrot is a bird."),
+    ]
+    assert answer_cache.stats()["semantic_hits"] >= 1
+
+def test_context_packing_merges_dedupes_and_fits_budget():
+    from llama_index.core import Document
+    from context_packing import pack_nodes, pack_context, count_tokens
+    from indexing import get_splitter
+    from agent import format_snippets
+    from metrics import context_tokens
+
+    text = " ".join(f"Sentence number {i} about parrots." for i in range(60))
+    document = Document(text=text, metadata={"file_id": "file_a", "file_name": "a.md", "page_number": 1})
+    chunks = get_splitter(64, 16).get_nodes_from_documents([document])
+    assert len(chunks) >= 4 and chunks[1].start_char_idx < chunks[0].end_char_idx
+    other = TextNode(text="Parrots can live for decades.", metadata={"file_id": "file_b", "file_name": "b.md"})
+    results = [
+        NodeWithScore(node=chunks[0], score=0.9),
+        NodeWithScore(node=chunks[1], score=0.8),  # overlaps chunk 0
+        NodeWithScore(node=chunks[0], score=0.7),  # same chunk again (e.g. lexical and vector hits)
+        NodeWithScore(node=other, score=0.6),
+        NodeWithScore(node=chunks[3], score=0.2),  # weak tail
+    ]
+
+    packed = pack_nodes(results, budget=1000)
+    assert [r.node.metadata["file_id"] for r in packed] == ["file_a", "file_b"]
+    merged = packed[0].node.get_content()
+    assert merged == text[chunks[0].start_char_idx:chunks[1].end_char_idx]
+    assert packed[0].node.node_id == chunks[0].node_id and packed[0].score == 0.9
+
+    # Fused (RRF) scores aren't similarities: without the cutoff the weak tail stays
+    packed = pack_nodes(results, budget=1000, min_score_ratio=None)
+    assert [r.node.metadata["file_id"] for r in packed] == ["file_a", "file_b", "file_a"]
+
+    # A tight budget keeps the best snippet, cut at a word boundary
+    packed = pack_nodes(results, budget=60)
+    assert len(packed) == 1 and packed[0].node.get_content().endswith(" …")
+    assert count_tokens(packed[0].node.get_content()) <= 60
+
+    context_tokens.clear()
+    _, context = pack_context(results, format_snippets, budget=60)
+    assert context.count("Document Snippet") == 1
+    metrics = client.get("/metrics").text
+    assert 'paperparrot_context_tokens_count{kind="saved"} 1' in metrics
+    # Counted while packing, without rendering the unpacked results
+    retrieved = float(re.search(r'paperparrot_context_tokens_sum\{kind="retrieved"\} (\S+)', metrics).group(1))
+    assert abs(retrieved - count_tokens(format_snippets(results))) < 0.2 * retrieved
+    assert count_tokens(format_snippets(results)) - count_tokens(context) > 100
+
+def test_schema_check_never_migrates_and_migrate_takes_the_lock():
+    import migrations
+    pending = {"filter_columns": False, "text_search": False, "partitioned": False,
+               "hnsw": {"exists": True, "valid": False, "m": 16, "ef_construction": 64}}
+    database = MagicMock()
+    with patch("migrations.schema_status", return_value=dict(pending)), \
+         patch("migrations.SCHEMA_AUTO_MIGRATE", True), patch("migrations._migrate") as mock_migrate:
+        # Startup only reports; the backfill is left to the background task / CLI
+        assert migrations.migrations_pending(migrations.check_schema(database))
+        mock_migrate.assert_not_called()
+        assert database.filter_columns is False
+
+        # Another replica holds the migration lock: the background run skips
+        engine = MagicMock()
+        engine.connect.return_value.__enter__.return_value.execute.return_value.scalar.return_value = False
+        status = migrations.migrate(engine, wait=False)
+        assert status["skipped"] and not mock_migrate.called
+
+        engine.connect.return_value.__enter__.return_value.execute.return_value.scalar.return_value = True
+        migrations.migrate(engine, wait=False)
+        mock_migrate.assert_called_once()
+        statements = [str(c.args[0]) for c in engine.connect.return_value.__enter__.return_value.execute.call_args_list]
+        assert statements[-1] == "SELECT pg_advisory_unlock(:id)"
+
+def test_background_migration_reports_failures(capsys):
+    import migrations
+    database = MagicMock()
+
+    async def run():
+        # Resolved from the migration thread; a lost callback would hang here
+        return await asyncio.wait_for(migrations.migrate_in_background(database), timeout=5)
+
+    with patch("migrations.migrate", side_effect=RuntimeError("lock timeout")):
+        assert asyncio.run(run()) is None
+    assert "Background schema migration failed: lock timeout" in capsys.readouterr().out
+
+    done = {"filter_columns": True, "text_search": True, "partitioned": False, "hnsw": {"valid": True}}
+    with patch("migrations.migrate", return_value=done):
+        assert asyncio.run(run()) == done
+    assert database.filter_columns is True and database.text_search is True
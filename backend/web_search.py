@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import text as sql_text
+
+from caches import TTLCache, normalize_query
+from db import get_db
+from metrics import span
+
+load_dotenv()
+
+WEB_SEARCH_CACHE_ENABLED = os.getenv("WEB_SEARCH_CACHE_ENABLED", "true").lower() == "true"
+WEB_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("WEB_SEARCH_CACHE_MAX_ENTRIES", "2048"))
+# Search results go stale, unlike embeddings: keep them for 15 minutes by default
+WEB_SEARCH_CACHE_TTL = float(os.getenv("WEB_SEARCH_CACHE_TTL", "900"))
+# Also keep results in Postgres, so they are shared between instances and survive restarts
+WEB_SEARCH_CACHE_PERSIST = os.getenv("WEB_SEARCH_CACHE_PERSIST", "false").lower() == "true"
+# How long a caller waits for an identical in-flight search before giving up
+WEB_SEARCH_WAIT_TIMEOUT = float(os.getenv("WEB_SEARCH_WAIT_TIMEOUT", "30"))
+
+CACHE_TABLE = "paperparrot_search_cache"
+
+GET_SQL = f"SELECT result FROM {CACHE_TABLE} WHERE key = :key AND expires_at > now()"
+PUT_SQL = f"""
+    INSERT INTO {CACHE_TABLE} (key, query, result, expires_at)
+    VALUES (:key, :query, :result, now() + make_interval(secs => :ttl))
+    ON CONFLICT (key) DO UPDATE SET result = EXCLUDED.result, fetched_at = now(), expires_at = EXCLUDED.expires_at
+"""
+EXPIRE_SQL = f"DELETE FROM {CACHE_TABLE} WHERE expires_at <= now()"
+
+
+class _Flight:
+    """
+    One search in progress; callers asking for the same query wait on it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WebSearchCache(TTLCache):
+    """
+    search_internet results keyed by the search settings and normalized query.
+    Concurrent identical queries are coalesced: the first caller runs the search,
+    the others wait for its result (or its error, which is never cached).
+    With persist=True results are also read from / written to a Postgres table.
+    Without a client, a SerperSearch is built for the first search.
+    """
+
+    def __init__(self, client=None, max_entries: int = WEB_SEARCH_CACHE_MAX_ENTRIES, ttl: float = WEB_SEARCH_CACHE_TTL,
+                 persist: bool = WEB_SEARCH_CACHE_PERSIST, enabled: bool = WEB_SEARCH_CACHE_ENABLED):
+        super().__init__(max_entries, ttl)
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.persist = persist
+        self.enabled = enabled
+        self.searches = 0
+        self.coalesced = 0
+        self.persistent_hits = 0
+        self.errors = 0
+        self._flights = {}  # key -> _Flight
+        self._last_expiry = 0.0
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # langchain_community is slow to import: not needed until someone searches
+                    from serper_search import SerperSearch
+                    self._client = SerperSearch()
+        return self._client
+
+    async def setup(self):
+        if not (self.enabled and self.persist):
+            return
+        async with get_db().pool.connection() as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    fetched_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    expires_at TIMESTAMPTZ NOT NULL
+                )
+            """)
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {CACHE_TABLE}_expires_idx ON {CACHE_TABLE} (expires_at)")
+            await conn.execute(EXPIRE_SQL)
+
+    def cache_key(self, query: str) -> str:
+        client = self.client
+        settings = "|".join(str(getattr(client, name, "")) for name in ("type", "gl", "hl", "k", "tbs"))
+        return f"{settings}|{normalize_query(query)}"
+
+    def search(self, query: str) -> str:
+        if not self.enabled:
+            self.searches += 1
+            with span("chat.web_search"):
+                return self.client.run(query)
+
+        key = self.cache_key(query)
+        result = self.get(key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(WEB_SEARCH_WAIT_TIMEOUT):
+                raise TimeoutError(f"Timed out waiting for an identical search: {query}")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            # The previous leader may have finished between our lookup and taking the lock
+            result = self.get(key)
+            if result is None:
+                result = self._load(key)
+            if result is None:
+                self.searches += 1
+                with span("chat.web_search"):
+                    result = self.client.run(query)
+                self._store(key, query, result)
+            self.put(key, result)
+            flight.result = result
+            return result
+        except Exception as e:
+            self.errors += 1
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _load(self, key: str):
+        if not self.persist:
+            return None
+        try:
+            with get_db().engine.connect() as conn:
+                result = conn.execute(sql_text(GET_SQL), {"key": key}).scalar()
+        except Exception as e:
+            print(f"Web search cache lookup failed: {e}")
+            return None
+        if result is not None:
+            self.persistent_hits += 1
+        return result
+
+    def _store(self, key: str, query: str, result: str):
+        if not self.persist:
+            return
+        try:
+            with get_db().engine.begin() as conn:
+                conn.execute(sql_text(PUT_SQL), {"key": key, "query": query, "result": result, "ttl": self.ttl})
+                if time.monotonic() - self._last_expiry >= self.ttl:
+                    self._last_expiry = time.monotonic()
+                    conn.execute(sql_text(EXPIRE_SQL))
+        except Exception as e:
+            print(f"Web search cache store failed: {e}")
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update({
+            "enabled": self.enabled,
+            "persist": self.persist,
+            "ttl": self.ttl,
+            "searches": self.searches,
+            "coalesced": self.coalesced,
+            "persistent_hits": self.persistent_hits,
+            "errors": self.errors,
+            "in_flight": len(self._flights),
+        })
+        return stats
+
+
+# Process-wide instance used by the search_internet tool, set up in main.lifespan
+web_search_cache = WebSearchCache()
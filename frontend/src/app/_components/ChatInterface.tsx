@@ -12,6 +12,9 @@ import TextareaAutosize from "react-textarea-autosize";
 import FilesModal from "./FilesModal";
 import { customToast } from "./toast";
 
+// How often the upload flow checks on a file's indexing job
+const INDEX_JOB_POLL_INTERVAL_MS = 1000;
+
 interface ChatInterfaceProps {
   conversationId: string; // This is now REQUIRED
 }
@@ -155,7 +158,8 @@ export function ChatInterface({ conversationId }: ChatInterfaceProps) {
 
   const handleSendChat = (e: React.FormEvent) => {
     e.preventDefault();
-    if (!userChatInput.trim() || isAgentThinking) return;
+    // Files still being indexed wouldn't be found yet
+    if (!userChatInput.trim() || isAgentThinking || isProcessingFiles) return;
 
     // Much simpler! No check for missing ID, no creation logic.
     sendMessageMutation.mutate({
@@ -169,6 +173,17 @@ export function ChatInterface({ conversationId }: ChatInterfaceProps) {
     deleteFileMutation.mutate({ id: fileId });
   };
 
+  // Indexing runs in the background on the Python API: poll the job until it's done
+  const waitForIndexJob = async (fileId: string, jobId: string) => {
+    for (;;) {
+      const job = await utils.client.file.getIndexJob.query({ fileId, jobId });
+      if (job.status === "succeeded" || job.status === "failed") return job;
+      await new Promise((resolve) =>
+        setTimeout(resolve, INDEX_JOB_POLL_INTERVAL_MS),
+      );
+    }
+  };
+
   const processUploadedFiles = async (
     uploadedFiles: { key: string; url: string; name: string }[],
     toastId: string,
@@ -180,7 +195,7 @@ export function ChatInterface({ conversationId }: ChatInterfaceProps) {
 
     try {
       // Simply iterate. We KNOW conversationId exists and is valid.
-      await Promise.all(
+      const createdFiles = await Promise.all(
         uploadedFiles.map((file) =>
           processUploadedFileMutation.mutateAsync({
             name: file.name,
@@ -190,7 +205,39 @@ export function ChatInterface({ conversationId }: ChatInterfaceProps) {
           }),
         ),
       );
-      customToast.success("Processing done!", toastId);
+      void utils.file.getByConversation.invalidate({ conversationId });
+
+      let indexed = 0;
+      customToast.loading(
+        `Indexing files (0/${createdFiles.length})...`,
+        toastId,
+      );
+      const jobs = await Promise.all(
+        createdFiles.map(async (file) => {
+          const job = await waitForIndexJob(file.id, file.indexJobId);
+          indexed += 1;
+          customToast.loading(
+            `Indexing files (${indexed}/${createdFiles.length})...`,
+            toastId,
+          );
+          return { name: file.name, ...job };
+        }),
+      );
+
+      const failed = jobs.filter((job) => job.status === "failed");
+      if (failed.length) {
+        customToast.error(
+          failed
+            .map(
+              (job) =>
+                `Failed to index ${job.name}: ${job.error ?? "unknown error"}`,
+            )
+            .join("\n"),
+          toastId,
+        );
+      } else {
+        customToast.success("Processing done!", toastId);
+      }
     } catch (e) {
       customToast.error("Error processing files.", toastId);
     } finally {
@@ -272,7 +319,9 @@ export function ChatInterface({ conversationId }: ChatInterfaceProps) {
             />
             <button
               type="submit"
-              disabled={!userChatInput.trim() || isAgentThinking}
+              disabled={
+                !userChatInput.trim() || isAgentThinking || isProcessingFiles
+              }
               className="rounded-lg bg-indigo-600 px-3 text-gray-300 hover:bg-indigo-700 disabled:cursor-not-allowed disabled:opacity-50"
             >
               <Send size={20} />
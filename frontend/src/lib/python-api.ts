@@ -5,11 +5,66 @@ export type ChatResponse = {
   sources: "internet" | "documents";
 };
 
+export type ChatStreamEvent =
+  | { event: "tool_start"; data: { tool: string; input: unknown } }
+  | { event: "tool_end"; data: { tool: string } }
+  | {
+      event: "snippets";
+      data: {
+        snippets: {
+          id: string;
+          file_id: string | null;
+          page_number: number | null;
+          score: number | null;
+        }[];
+      };
+    }
+  | { event: "token"; data: { text: string } }
+  | { event: "final"; data: ChatResponse }
+  | { event: "error"; data: { detail: string } };
+
 export type IndexFileResponse = {
-  status: "success" | "error";
+  status: "queued";
+  job_id: string;
   message: string;
 };
 
+export type IndexJobResponse = {
+  id: string;
+  file_id: string;
+  mode: "index" | "update";
+  status:
+    | "queued"
+    | "running"
+    | "downloading"
+    | "parsing"
+    | "comparing"
+    | "embedding"
+    | "inserting"
+    | "succeeded"
+    | "failed";
+  bytes_downloaded: number;
+  chunks_total: number;
+  chunks_embedded: number;
+  chunks_inserted: number;
+  cache_hits: number;
+  cache_misses: number;
+  chunks_unchanged: number;
+  chunks_deleted: number;
+  error: string | null;
+};
+
+export type IndexFilesResponse = {
+  status: "success" | "partial" | "error";
+  results: {
+    file_id: string;
+    status: "success" | "error";
+    message: string;
+    embedding_cache_hits?: number;
+    embedding_cache_misses?: number;
+  }[];
+};
+
 export type DeleteFileResponse = {
   status: "success" | "error";
   message: string;
@@ -22,9 +77,12 @@ export type DeleteConversationResponse = {
 
 export type ChatHistoryResponse = {
   history: {
+    id?: string;
     role: "user" | "assistant";
     content: string;
   }[];
+  // Pass as `before` to load the previous page; null when there is nothing older
+  next_before?: string | null;
 };
 
 // Remove the slash before 'api' because the variable might already have one
@@ -44,6 +102,40 @@ export const pythonApi = {
     return res.json() as Promise<ChatResponse>;
   },
 
+  chatStream: async (
+    conversationId: string,
+    message: string,
+    onEvent: (event: ChatStreamEvent) => void,
+  ): Promise<void> => {
+    const res = await fetch(`${BASE_URL}/api/chat/stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ conversation_id: conversationId, message }),
+    });
+    if (!res.ok || !res.body) throw new Error("Failed to send message");
+
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += value;
+      // SSE events are separated by a blank line
+      let boundary = buffer.indexOf("\n\n");
+      while (boundary !== -1) {
+        const block = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        const lines = block.split("\n");
+        const event = lines.find((l) => l.startsWith("event: "))?.slice(7);
+        const data = lines.find((l) => l.startsWith("data: "))?.slice(6);
+        if (event && data) {
+          onEvent({ event, data: JSON.parse(data) } as ChatStreamEvent);
+        }
+        boundary = buffer.indexOf("\n\n");
+      }
+    }
+  },
+
   indexFile: async (
     fileName: string,
     fileId: string,
@@ -64,6 +156,52 @@ export const pythonApi = {
     return res.json() as Promise<IndexFileResponse>;
   },
 
+  updateFile: async (
+    fileName: string,
+    fileId: string,
+    fileUrl: string,
+    conversationId: string,
+  ): Promise<IndexFileResponse> => {
+    const res = await fetch(`${BASE_URL}/api/update-file`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        file_name: fileName,
+        file_id: fileId,
+        file_url: fileUrl,
+        conversation_id: conversationId,
+      }),
+    });
+    if (!res.ok) throw new Error("Failed to update file");
+    return res.json() as Promise<IndexFileResponse>;
+  },
+
+  getIndexJob: async (jobId: string): Promise<IndexJobResponse> => {
+    const res = await fetch(`${BASE_URL}/api/index-jobs/${jobId}`);
+    if (!res.ok) throw new Error("Failed to fetch index job");
+    return res.json() as Promise<IndexJobResponse>;
+  },
+
+  indexFiles: async (
+    conversationId: string,
+    files: { fileName: string; fileId: string; fileUrl: string }[],
+  ): Promise<IndexFilesResponse> => {
+    const res = await fetch(`${BASE_URL}/api/index-files`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        files: files.map((file) => ({
+          file_name: file.fileName,
+          file_id: file.fileId,
+          file_url: file.fileUrl,
+          conversation_id: conversationId,
+        })),
+      }),
+    });
+    if (!res.ok) throw new Error("Failed to index files");
+    return res.json() as Promise<IndexFilesResponse>;
+  },
+
   deleteFile: async (
     fileId: string,
     conversationId: string,
@@ -96,8 +234,15 @@ export const pythonApi = {
 
   getChatHistory: async (
     conversationId: string,
+    page?: { limit?: number; before?: string },
   ): Promise<ChatHistoryResponse> => {
-    const res = await fetch(`${BASE_URL}/api/chat/${conversationId}/history`);
+    const params = new URLSearchParams();
+    if (page?.limit) params.set("limit", String(page.limit));
+    if (page?.before) params.set("before", page.before);
+    const query = params.size ? `?${params.toString()}` : "";
+    const res = await fetch(
+      `${BASE_URL}/api/chat/${conversationId}/history${query}`,
+    );
     if (!res.ok) throw new Error("Failed to fetch chat history");
     return res.json() as Promise<ChatHistoryResponse>;
   },
@@ -1,4 +1,5 @@
 import { z } from "zod";
+import { TRPCError } from "@trpc/server";
 
 import { createTRPCRouter, protectedProcedure } from "~/server/api/trpc";
 import { files, conversations } from "~/server/db/schema";
@@ -42,14 +43,50 @@ export const fileRouter = createTRPCRouter({
         throw new Error("Failed to create file in db");
       }
 
-      await pythonApi.indexFile(
+      // Indexing runs as a background job: the client polls getIndexJob
+      // until the file is searchable (or indexing failed)
+      const { job_id } = await pythonApi.indexFile(
         input.name,
         createdFile.id,
         input.url,
         input.conversationId,
       );
 
-      return createdFile;
+      return { ...createdFile, indexJobId: job_id };
+    }),
+
+  getIndexJob: protectedProcedure
+    .input(z.object({ fileId: z.string(), jobId: z.string() }))
+    .query(async ({ ctx, input }) => {
+      // Only the owner of the file may see its indexing job
+      const file = await ctx.db.query.files.findFirst({
+        where: eq(files.id, input.fileId),
+        with: {
+          conversation: true,
+        },
+      });
+
+      if (!file || file.conversation.userId !== ctx.session.user.id) {
+        throw new TRPCError({
+          code: "NOT_FOUND",
+          message: "File not found or unauthorized",
+        });
+      }
+
+      const job = await pythonApi.getIndexJob(input.jobId);
+      if (job.file_id !== input.fileId) {
+        throw new TRPCError({
+          code: "NOT_FOUND",
+          message: "Index job not found",
+        });
+      }
+
+      return {
+        status: job.status,
+        error: job.error,
+        chunksTotal: job.chunks_total,
+        chunksInserted: job.chunks_inserted,
+      };
     }),
 
   delete: protectedProcedure